@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+# usage: hash-benchmark.py [--iterations N] [--generate SIZE_MB] [files...]
+#
+# Micro-benchmark comparing hashutils against the 64 KiB read loop
+# the release / nightly / migration scripts used to carry around.
+# Point it at real release tarballs and RPMs; if no files are given,
+# --generate creates a random file of the given size instead.  Each
+# method is run --iterations times and the best time is reported, so
+# the first (cold cache) run is effectively a warm-up.
+#
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import hashutils
+
+
+def legacy_compute_hashes(filename):
+    """The historical implementation, for comparison"""
+    retval = {}
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            md5.update(data)
+            sha1.update(data)
+            sha256.update(data)
+    retval['md5'] = md5.hexdigest()
+    retval['sha1'] = sha1.hexdigest()
+    retval['sha256'] = sha256.hexdigest()
+    return retval
+
+
+def best_time(iterations, func):
+    best = None
+    result = None
+    for i in range(iterations):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+
+def report(name, total_bytes, elapsed):
+    print('%-28s %8.2f s %10.1f MB/s' % (name, elapsed,
+                                         total_bytes / (1024.0 * 1024.0) / elapsed))
+
+
+parser = argparse.ArgumentParser(description='Compare hashing implementations')
+parser.add_argument('--iterations', help='Runs per method (default: 3)',
+                    type=int, default=3)
+parser.add_argument('--generate', help='Size in MB of a random test file to use if no files are given',
+                    type=int, default=1024)
+parser.add_argument('--workers', help='Processes for the many-file test (default: #cpus)',
+                    type=int)
+parser.add_argument('files', nargs='*', help='Files to hash')
+args = parser.parse_args()
+
+generated = None
+files = args.files
+if len(files) == 0:
+    fd, generated = tempfile.mkstemp(prefix='hash-benchmark-')
+    with os.fdopen(fd, 'wb') as f:
+        for i in range(args.generate):
+            f.write(os.urandom(1024 * 1024))
+    files = [generated]
+
+try:
+    total_bytes = sum(os.stat(filename).st_size for filename in files)
+    print('%d file(s), %.1f MB total, best of %d' %
+          (len(files), total_bytes / (1024.0 * 1024.0), args.iterations))
+
+    legacy_time, legacy = best_time(args.iterations,
+                                    lambda: dict((f, legacy_compute_hashes(f)) for f in files))
+    report('legacy (64 KiB reads)', total_bytes, legacy_time)
+
+    new_time, new = best_time(args.iterations,
+                              lambda: dict((f, hashutils.compute_hashes(f)) for f in files))
+    report('hashutils.compute_hashes', total_bytes, new_time)
+
+    many_time, many = best_time(args.iterations,
+                                lambda: hashutils.compute_hashes_many(files, max_workers=args.workers))
+    report('hashutils (parallel files)', total_bytes, many_time)
+
+    if legacy != new or legacy != many:
+        print('ERROR: digests do not match!')
+        sys.exit(1)
+finally:
+    if generated != None:
+        os.remove(generated)
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+# Shared file hashing for the release, nightly tarball, and migration
+# scripts.  All of them publish md5 / sha1 / sha256 sums for
+# (potentially multi-GB) tarballs and RPMs, so hashing shows up in
+# the run time of every one of them.
+#
+# Large files are mapped rather than read through a small buffer, and
+# each algorithm runs in its own thread over the mapping (hashlib
+# drops the GIL while hashing large buffers), so computing three
+# digests costs about as much as computing the slowest one.  Many
+# files can be hashed at once in a pool of processes with
+# compute_hashes_many().
+#
+
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import unittest
+import concurrent.futures
+
+
+default_algorithms = ['md5', 'sha1', 'sha256']
+
+# 4 MiB; a multiple of any page size we are likely to run into
+_chunk_size = 4 * 1024 * 1024
+
+_constructors = {}
+
+
+def register_algorithm(name, constructor):
+    """Register a hash algorithm
+
+    constructor must return an object with the hashlib update() /
+    hexdigest() interface.  Anything hashlib.new() understands
+    (sha512, blake2b, ...) does not need to be registered.
+
+    """
+    _constructors[name] = constructor
+
+
+def new_hashers(algorithms=None):
+    """Create a dictionary of algorithm name to new hash object"""
+    if algorithms == None:
+        algorithms = default_algorithms
+    hashers = {}
+    for name in algorithms:
+        if name in _constructors:
+            hashers[name] = _constructors[name]()
+        else:
+            hashers[name] = hashlib.new(name)
+    return hashers
+
+
+def _hash_buffer(hasher, buf):
+    for offset in range(0, len(buf), _chunk_size):
+        hasher.update(buf[offset:offset + _chunk_size])
+
+
+def compute_hashes(filename, algorithms=None):
+    """Compute digests of a file
+
+    Returns a dictionary of algorithm name to hex digest, for each of
+    algorithms (default: md5, sha1, and sha256).
+
+    """
+    hashers = new_hashers(algorithms)
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return dict((name, h.hexdigest()) for name, h in hashers.items())
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                if len(hashers) == 1 or size <= _chunk_size:
+                    for h in hashers.values():
+                        _hash_buffer(h, view)
+                else:
+                    threads = []
+                    for h in hashers.values():
+                        t = threading.Thread(target=_hash_buffer, args=(h, view))
+                        t.start()
+                        threads.append(t)
+                    for t in threads:
+                        t.join()
+            finally:
+                view.release()
+
+    return dict((name, h.hexdigest()) for name, h in hashers.items())
+
+
+def compute_hashes_many(filenames, algorithms=None, max_workers=None):
+    """Compute digests of many files in parallel
+
+    Hashes each file in filenames with compute_hashes() in a pool of
+    up to max_workers processes (default: the number of CPUs).
+    Returns a dictionary of filename to the compute_hashes() result.
+
+    """
+    retval = {}
+    if len(filenames) == 0:
+        return retval
+    if max_workers == None:
+        max_workers = os.cpu_count()
+    max_workers = max(1, min(max_workers, len(filenames)))
+    if max_workers == 1:
+        for filename in filenames:
+            retval[filename] = compute_hashes(filename, algorithms)
+        return retval
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for filename in filenames:
+            futures[executor.submit(compute_hashes, filename, algorithms)] = filename
+        for future in concurrent.futures.as_completed(futures):
+            retval[futures[future]] = future.result()
+    return retval
+
+
+class HashingReader(object):
+    """File object wrapper that hashes everything read through it
+
+    Wrap a file opened for binary reading and hand the wrapper to
+    something that consumes it (an S3 upload, a copy, ...); the
+    digests of the bytes actually consumed are then available from
+    hexdigests() without reading the file a second time.  The wrapper
+    deliberately does not offer seek() / tell(), so consumers (like
+    boto3's transfer manager) read it exactly once, in order.
+
+    """
+
+    def __init__(self, fileobj, algorithms=None):
+        self._fileobj = fileobj
+        self._hashers = new_hashers(algorithms)
+        self.bytes_read = 0
+
+
+    def readable(self):
+        return True
+
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            for h in self._hashers.values():
+                h.update(data)
+            self.bytes_read += len(data)
+        return data
+
+
+    def hexdigests(self):
+        """Dictionary of algorithm name to hex digest of the data read so far"""
+        return dict((name, h.hexdigest()) for name, h in self._hashers.items())
+
+
+######################################################################
+#
+# Unit Test Code
+#
+######################################################################
+class compute_hashes_tests(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        for filename in os.listdir(self._tempdir):
+            os.remove(os.path.join(self._tempdir, filename))
+        os.rmdir(self._tempdir)
+
+
+    def _write(self, name, data):
+        filename = os.path.join(self._tempdir, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+
+    def _expected(self, data, algorithms=default_algorithms):
+        return dict((name, hashlib.new(name, data).hexdigest()) for name in algorithms)
+
+
+    def test_empty(self):
+        filename = self._write('empty', b'')
+        self.assertEqual(compute_hashes(filename), self._expected(b''))
+
+
+    def test_multi_chunk(self):
+        data = os.urandom(_chunk_size * 2 + 12345)
+        filename = self._write('big', data)
+        self.assertEqual(compute_hashes(filename), self._expected(data))
+
+
+    def test_extra_algorithms(self):
+        data = b'I love me some unit tests.\n'
+        filename = self._write('small', data)
+        algorithms = ['sha512', 'blake2b']
+        self.assertEqual(compute_hashes(filename, algorithms),
+                         self._expected(data, algorithms))
+
+
+    def test_reader(self):
+        data = os.urandom(_chunk_size + 12345)
+        filename = self._write('reader', data)
+        with open(filename, 'rb') as f:
+            reader = HashingReader(f)
+            while reader.read(64 * 1024):
+                pass
+        self.assertEqual(reader.bytes_read, len(data))
+        self.assertEqual(reader.hexdigests(), self._expected(data))
+
+
+    def test_many(self):
+        expected = {}
+        for i in range(4):
+            data = os.urandom(1024 * i)
+            expected[self._write('file-%d' % (i), data)] = self._expected(data)
+        self.assertEqual(compute_hashes_many(list(expected.keys()), max_workers=2),
+                         expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
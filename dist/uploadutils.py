@@ -13,7 +13,7 @@ import re
 import os
 import json
 import tarfile
-import hashlib
+import hashutils
 from io import StringIO
 import datetime
 import unittest
@@ -28,24 +28,16 @@ def __unique_assign(releaseinfo, key, value):
                         (key, releaseinfo[key], value))
 
 
-def __compute_hashes(filename):
-    """Helper function to compute MD5 and SHA1 hashes"""
-    retval = {}
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
+def __upload_file(s3_client, filename, s3_bucket, target_name):
+    """Upload a file, returning the MD5, SHA1, and SHA256 hashes
+
+    The hashes are computed from the bytes as they are uploaded, so
+    the file is only read once.
+    """
     with open(filename, 'rb') as f:
-        while True:
-            data = f.read(64 * 1024)
-            if not data:
-                break
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
-    retval['md5'] = md5.hexdigest()
-    retval['sha1'] = sha1.hexdigest()
-    retval['sha256'] = sha256.hexdigest()
-    return retval
+        reader = hashutils.HashingReader(f)
+        s3_client.upload_fileobj(reader, s3_bucket, target_name)
+    return reader.hexdigests()
 
 
 def __query_yes_no(question, default="yes"):
@@ -250,7 +242,8 @@ def upload_files(s3_client, s3_bucket, s3_key_prefix, release_info, files, promp
 
     for filename in files:
         info = os.stat(filename)
-        hashes = __compute_hashes(filename)
+        target_name = '%s/%s' % (branch_key_path, os.path.basename(filename))
+        hashes = __upload_file(s3_client, filename, s3_bucket, target_name)
         fileinfo = {}
         fileinfo['sha1'] = hashes['sha1']
         fileinfo['sha256'] = hashes['sha256']
@@ -258,10 +251,6 @@ def upload_files(s3_client, s3_bucket, s3_key_prefix, release_info, files, promp
         fileinfo['size'] = info.st_size
         buildinfo['files'][os.path.basename(filename)] = fileinfo
 
-    for filename in files:
-        target_name = '%s/%s' % (branch_key_path, os.path.basename(filename))
-        s3_client.upload_file(filename, s3_bucket, target_name)
-
     buildinfo_str = json.dumps(buildinfo)
     s3_client.put_object(Bucket = s3_bucket, Key = build_filename,
                          Body = buildinfo_str)
@@ -276,10 +265,12 @@ def _test_stat(filename):
     info = posix.stat_result((0, 0, 0, 0, 0, 0, 987654, 0, 0, 0))
     return info
 
-def _test_compute_hashes(filename):
+def _test_upload_file(s3_client, filename, s3_bucket, target_name):
+    s3_client.upload_file(filename, s3_bucket, target_name)
     retval = {}
     retval['md5'] = "ABC"
     retval['sha1'] = "ZYX"
+    retval['sha256'] = "QRS"
     return retval
 
 
@@ -517,7 +508,7 @@ class upload_files_tests(unittest.TestCase):
 
 
     @mock.patch('os.stat', _test_stat)
-    @mock.patch('__main__.__compute_hashes', _test_compute_hashes)
+    @mock.patch('__main__.__upload_file', _test_upload_file)
     def test_new_buildinfo(self):
         releaseinfo = {}
         releaseinfo['project'] = 'open-mpi'
@@ -562,7 +553,7 @@ class upload_files_tests(unittest.TestCase):
 
 
     @mock.patch('os.stat', _test_stat)
-    @mock.patch('__main__.__compute_hashes', _test_compute_hashes)
+    @mock.patch('__main__.__upload_file', _test_upload_file)
     def test_existing_buildinfo_nooverlap(self):
         releaseinfo = {}
         releaseinfo['project'] = 'open-mpi'
@@ -588,7 +579,7 @@ class upload_files_tests(unittest.TestCase):
 
 
     @mock.patch('os.stat', _test_stat)
-    @mock.patch('__main__.__compute_hashes', _test_compute_hashes)
+    @mock.patch('__main__.__upload_file', _test_upload_file)
     def test_existing_buildinfo_overlap_ok(self):
         releaseinfo = {}
         releaseinfo['project'] = 'open-mpi'
@@ -613,7 +604,7 @@ class upload_files_tests(unittest.TestCase):
 
 
     @mock.patch('os.stat', _test_stat)
-    @mock.patch('__main__.__compute_hashes', _test_compute_hashes)
+    @mock.patch('__main__.__upload_file', _test_upload_file)
     def test_existing_buildinfo_overlap_fail(self):
         releaseinfo = {}
         releaseinfo['project'] = 'open-mpi'
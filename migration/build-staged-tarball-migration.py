@@ -35,24 +35,13 @@ import tarfile
 import argparse
 import time
 import json
-import hashlib
 import shutil
+import sys
 
-def compute_hashes(filename):
-    """Helper function to compute MD5 and SHA1 hashes"""
-    retval = {}
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    with open(filename, 'rb') as f:
-        while True:
-            data = f.read(64 * 1024)
-            if not data:
-                break
-            md5.update(data)
-            sha1.update(data)
-    retval['md5'] = md5.hexdigest()
-    retval['sha1'] = sha1.hexdigest()
-    return retval
+# hashing is shared with the release scripts in dist/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'dist'))
+import hashutils
 
 
 def do_migrate(input_path, output_path):
@@ -140,7 +129,7 @@ def do_migrate(input_path, output_path):
                         # directory in the tarball instead.
                         builddata['build_unix_time'] = tar.getmembers()[0].mtime
 
-                hashes = compute_hashes(full_filename)
+                hashes = hashutils.compute_hashes(full_filename, ['md5', 'sha1'])
                 info = os.stat(full_filename)
                 builddata['files'][name] = {}
                 builddata['files'][name]['sha1'] = hashes['sha1']
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+
+import BuilderUtils
+import unittest
+import logging
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from git import Repo
+
+
+logger = logging.getLogger('Builder.AutogenCache')
+
+
+class AutogenCache(object):
+    """Content-addressed cache of autogen outputs
+
+    Running autogen (autoconf, automake, libtoolize, and friends) on
+    a large project takes minutes, but its output only depends on the
+    autotools inputs of the source tree and the versions of the
+    autotools.  The cache key is a hash of:
+
+      * the list of files in the git index, including submodules
+        (autogen scans the tree for components)
+      * the contents of every file that is not plain source code
+        (see is_source()).  autogen can read almost anything besides
+        configure.ac and *.m4 (automake include fragments, bundled
+        tarballs, helper scripts), so rather than list what it
+        reads, only what it surely doesn't is left out.  Contents
+        are the blob ids from the git index, so that nothing needs to
+        be read and so that VERSION rewrites by update_version_file()
+        (which only touch the working tree) do not change the key
+      * any extra strings from the caller (tool versions, etc.)
+
+    The outputs of autogen are found by comparing snapshots of the
+    tree before and after autogen, and are stored as a tarball per
+    key under cache_path.  Entries are evicted least recently used
+    first once the cache is bigger than max_size bytes.  A lock file
+    in the cache directory makes it safe to share the cache between
+    concurrent builds.
+
+    """
+
+    # basenames (fnmatch patterns, case sensitive) of source files
+    # whose contents can't change autogen output.  Files in a config/
+    # directory are always inputs.
+    source_patterns = ['*.c', '*.h', '*.cc', '*.cpp', '*.cxx', '*.hpp', '*.hh',
+                       '*.f', '*.F', '*.f77', '*.F77', '*.f90', '*.F90',
+                       '*.f08', '*.F08', '*.java', '*.cu']
+
+    def __init__(self, cache_path, max_size):
+        self._cache_path = cache_path
+        self._max_size = max_size
+        if not os.path.exists(self._cache_path):
+            os.makedirs(self._cache_path)
+
+
+    def _lock(self, shared=False):
+        return BuilderUtils.file_lock(os.path.join(self._cache_path, 'lock'), shared=shared)
+
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_path, key)
+
+
+    def is_source(self, path):
+        """Is the file at path (relative to the source tree) plain source code?"""
+        components = path.split('/')
+        if 'config' in components[:-1]:
+            return False
+        for pattern in self.source_patterns:
+            if fnmatch.fnmatchcase(components[-1], pattern):
+                return True
+        return False
+
+
+    def compute_key(self, source_tree, extra=[]):
+        """Compute the cache key for source_tree
+
+        extra is a list of strings describing anything else autogen
+        output depends on (tool versions, autogen command, ...).
+
+        """
+        output = Repo(source_tree).git.ls_files('-s', '-z', '--recurse-submodules')
+        key = hashlib.sha256()
+        # ls-files output is sorted by path
+        for entry in output.split('\0'):
+            if entry == '':
+                continue
+            info, path = entry.split('\t', 1)
+            mode, blob, stage = info.split()
+            if self.is_source(path):
+                key.update(('%s\n' % (path)).encode('utf-8', 'surrogateescape'))
+            else:
+                key.update(('%s %s %s\n' % (mode, blob, path)).encode('utf-8', 'surrogateescape'))
+        for item in extra:
+            key.update(('extra %s\n' % (item)).encode('utf-8', 'surrogateescape'))
+        return key.hexdigest()
+
+
+    def snapshot(self, source_tree):
+        """Record the state of every file in source_tree (minus .git)"""
+        state = {}
+        for root, dirs, files in os.walk(source_tree):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                if name == '.git':
+                    continue
+                pathname = os.path.join(root, name)
+                info = os.lstat(pathname)
+                state[os.path.relpath(pathname, source_tree)] = (info.st_mtime_ns, info.st_size)
+        return state
+
+
+    def restore(self, key, source_tree):
+        """Restore the outputs for key into source_tree
+
+        Returns True if the key was in the cache (and the outputs were
+        restored), False otherwise.  Restored files get the current
+        time as their modification time, so that make does not
+        consider them older than the freshly checked out inputs.
+
+        """
+        entry_path = self._entry_path(key)
+        with self._lock(shared=True):
+            manifest_file = os.path.join(entry_path, 'manifest.json')
+            if not os.path.exists(manifest_file):
+                return False
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            with tarfile.open(os.path.join(entry_path, 'outputs.tar'), 'r') as tar:
+                tar.extractall(source_tree)
+            # mark as recently used
+            os.utime(manifest_file)
+
+        for name in manifest['deleted']:
+            pathname = os.path.join(source_tree, name)
+            if os.path.lexists(pathname):
+                os.remove(pathname)
+        now = time.time()
+        for name in manifest['files']:
+            pathname = os.path.join(source_tree, name)
+            if not os.path.islink(pathname):
+                os.utime(pathname, (now, now))
+        logger.debug("-> restored %d autogen outputs for %s" % (len(manifest['files']), key))
+        return True
+
+
+    def store(self, key, source_tree, before):
+        """Store the outputs of autogen for key
+
+        before is the snapshot() of source_tree taken before autogen
+        ran.  Every file that is new or changed since is stored.
+
+        """
+        after = self.snapshot(source_tree)
+        files = sorted(name for name, state in after.items() if before.get(name) != state)
+        deleted = sorted(name for name in before if not name in after)
+
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self._cache_path)
+        try:
+            with tarfile.open(os.path.join(tmp_path, 'outputs.tar'), 'w') as tar:
+                for name in files:
+                    tar.add(os.path.join(source_tree, name), arcname=name, recursive=False)
+            size = os.path.getsize(os.path.join(tmp_path, 'outputs.tar'))
+            with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+                json.dump({ 'key' : key, 'files' : files, 'deleted' : deleted,
+                            'size' : size }, f)
+            with self._lock():
+                entry_path = self._entry_path(key)
+                if os.path.exists(entry_path):
+                    shutil.rmtree(entry_path)
+                os.rename(tmp_path, entry_path)
+                self._evict()
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        logger.debug("-> stored %d autogen outputs (%d bytes) for %s" % (len(files), size, key))
+
+
+    def _evict(self):
+        # called with the lock held.  Drop least recently used entries
+        # until the cache fits in max_size.
+        entries = []
+        total = 0
+        for name in os.listdir(self._cache_path):
+            manifest_file = os.path.join(self._cache_path, name, 'manifest.json')
+            if name.startswith('.') or not os.path.exists(manifest_file):
+                continue
+            with open(manifest_file, 'r') as f:
+                size = json.load(f)['size']
+            entries.append((os.stat(manifest_file).st_mtime, name, size))
+            total += size
+        for mtime, name, size in sorted(entries):
+            if total <= self._max_size:
+                break
+            logger.debug("-> evicting autogen cache entry %s" % (name))
+            shutil.rmtree(os.path.join(self._cache_path, name))
+            total -= size
+
+
+class AutogenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._tree = os.path.join(self._tempdir, 'tree')
+        self._repo = Repo.init(self._tree)
+        self._write('configure.ac', 'AC_INIT\n')
+        self._write('VERSION', 'major=1\ntarball_version=\n')
+        self._write('src/foo.c', 'int foo;\n')
+        self._write('src/Makefile.am', 'lib_LTLIBRARIES = libfoo.la\n')
+        self._repo.index.add(['configure.ac', 'VERSION', 'src/foo.c', 'src/Makefile.am'])
+        self._repo.index.commit('initial')
+        self._cache = AutogenCache(os.path.join(self._tempdir, 'cache'), 1024 * 1024)
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def _write(self, name, data):
+        pathname = os.path.join(self._tree, name)
+        if not os.path.isdir(os.path.dirname(pathname)):
+            os.makedirs(os.path.dirname(pathname))
+        with open(pathname, 'w') as f:
+            f.write(data)
+
+
+    def _commit(self, name, data):
+        self._write(name, data)
+        self._repo.index.add([name])
+        self._repo.index.commit('update ' + name)
+
+
+    def test_key(self):
+        key = self._cache.compute_key(self._tree)
+        # nightly VERSION rewrite (working tree only) and source changes
+        self._write('VERSION', 'major=1\ntarball_version=nightly\n')
+        self._commit('src/foo.c', 'int foo = 1;\n')
+        self.assertEqual(self._cache.compute_key(self._tree), key)
+        self.assertNotEqual(self._cache.compute_key(self._tree, ['autoconf 2.71']), key)
+        # autotools input changes, including ones without an obvious name
+        self._commit('src/Makefile.am', 'lib_LTLIBRARIES = libbar.la\n')
+        self.assertNotEqual(self._cache.compute_key(self._tree), key)
+        key = self._cache.compute_key(self._tree)
+        self._commit('src/Makefile.ompi-rules', 'V = 1\n')
+        self.assertNotEqual(self._cache.compute_key(self._tree), key)
+        # new source files change the file list
+        key = self._cache.compute_key(self._tree)
+        self._commit('src/bar.c', 'int bar;\n')
+        self.assertNotEqual(self._cache.compute_key(self._tree), key)
+
+
+    def test_store_restore(self):
+        key = self._cache.compute_key(self._tree)
+        self.assertFalse(self._cache.restore(key, self._tree))
+
+        before = self._cache.snapshot(self._tree)
+        time.sleep(0.01)
+        self._write('configure', '#!/bin/sh\n')
+        self._write('src/Makefile.in', 'all:\n')
+        self._cache.store(key, self._tree, before)
+
+        os.remove(os.path.join(self._tree, 'configure'))
+        os.remove(os.path.join(self._tree, 'src/Makefile.in'))
+        self.assertTrue(self._cache.restore(key, self._tree))
+        with open(os.path.join(self._tree, 'src/Makefile.in'), 'r') as f:
+            self.assertEqual(f.read(), 'all:\n')
+        self.assertTrue(os.path.exists(os.path.join(self._tree, 'configure')))
+
+
+    def test_evict(self):
+        self._cache = AutogenCache(os.path.join(self._tempdir, 'cache'), 25000)
+        for i in range(3):
+            before = self._cache.snapshot(self._tree)
+            self._write('output-%d' % (i), 'x' * 4000)
+            self._cache.store('key-%d' % (i), self._tree, before)
+            os.utime(os.path.join(self._tempdir, 'cache', 'key-%d' % (i), 'manifest.json'),
+                     (i, i))
+        # each entry is a 10k tar file; only the newest two fit
+        self.assertEqual(sorted(d for d in os.listdir(os.path.join(self._tempdir, 'cache'))
+                                if d.startswith('key-')),
+                         ['key-1', 'key-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
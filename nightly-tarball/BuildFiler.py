@@ -5,11 +5,33 @@
 # Additional copyrights may follow
 #
 
+import BuilderUtils
 import logging
+import errno
+import io
+import json
+import os
+import sys
+import threading
+import concurrent.futures
+
+# hashing is shared with the release scripts in dist/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'dist'))
+import hashutils
 
 
 logger = logging.getLogger('Builder.S3BuildFiler')
 
+# request accounting may happen from download_many_to_streams()
+# threads; counting is cheap, so one lock for everyone is fine.
+_stats_lock = threading.Lock()
+
+
+def _new_request_stats():
+    return { 'requests' : {}, 'uploaded_bytes' : 0, 'downloaded_bytes' : 0,
+             'dedup_hits' : 0, 'dedup_saved_bytes' : 0 }
+
 
 class BuildFiler(object):
     """Abstraction for interacting with storage (S3, local, etc.)
@@ -20,6 +42,108 @@ class BuildFiler(object):
 
     """
 
+    def __init__(self):
+        """Set up request accounting; implementations must call this"""
+        self._request_stats = _new_request_stats()
+        self._dedup_index_file = None
+
+
+    def record_request(self, operation, uploaded_bytes=0, downloaded_bytes=0):
+        """Account for a request to the storage backend
+
+        Implementations call this once per backend operation (a
+        transfer-manager upload or download counts as one, however
+        many parts it uses), so that the Builder can report request
+        counts and bytes moved.
+
+        """
+        with _stats_lock:
+            stats = self._request_stats
+            stats['requests'][operation] = stats['requests'].get(operation, 0) + 1
+            stats['uploaded_bytes'] += uploaded_bytes
+            stats['downloaded_bytes'] += downloaded_bytes
+
+
+    def get_request_stats(self):
+        """Get request accounting since the last reset_request_stats()
+
+        Returns a dictionary with 'requests' (operation name to
+        count), 'uploaded_bytes', and 'downloaded_bytes' keys, plus
+        'dedup_hits' and 'dedup_saved_bytes' (uploads avoided by
+        enable_dedup() and the bytes they would have sent).
+
+        """
+        with _stats_lock:
+            stats = self._request_stats
+            return { 'requests' : dict(stats['requests']),
+                     'uploaded_bytes' : stats['uploaded_bytes'],
+                     'downloaded_bytes' : stats['downloaded_bytes'],
+                     'dedup_hits' : stats['dedup_hits'],
+                     'dedup_saved_bytes' : stats['dedup_saved_bytes'] }
+
+
+    def reset_request_stats(self):
+        """Zero the request accounting"""
+        with _stats_lock:
+            self._request_stats = _new_request_stats()
+
+
+    def enable_dedup(self, index_file):
+        """Skip uploads of content that is already stored
+
+        In dedup mode, upload_from_file_with_hashes() hashes the file
+        first and stores its sha256 in the object's properties.  If
+        the target already holds that content, the upload is skipped;
+        if another object does, it is copied on the remote side
+        (copy()) rather than uploaded.  index_file is a local JSON
+        index of remote filename to sha256 / size of what this filer
+        uploaded, so that most checks need no request; objects not in
+        the index are checked with get_properties().  The index can be
+        shared by concurrent builders (it is updated under a lock).
+
+        """
+        self._dedup_index_file = index_file
+
+
+    def _dedup_enabled(self):
+        return self._dedup_index_file != None
+
+
+    def _load_dedup_index(self):
+        try:
+            with open(self._dedup_index_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _update_dedup_index(self, filename, entry):
+        # entry None removes filename from the index
+        with BuilderUtils.file_lock(self._dedup_index_file + '.lock'):
+            index = self._load_dedup_index()
+            if entry == None:
+                if not filename in index:
+                    return
+                del index[filename]
+            else:
+                index[filename] = entry
+            tmp_file = self._dedup_index_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_file, self._dedup_index_file)
+
+
+    def forget_dedup(self, filename):
+        """Drop filename from the dedup index
+
+        Implementations call this from delete(), so the index never
+        claims a deleted object still exists.
+
+        """
+        if self._dedup_enabled():
+            self._update_dedup_index(filename, None)
+
+
     def download_to_stream(self, filename):
         """Download to stream
 
@@ -31,6 +155,48 @@ class BuildFiler(object):
         raise NotImplementedError
 
 
+    def download_many_to_streams(self, filenames, max_workers=16):
+        """Download many objects to streams at once
+
+        Calls download_to_stream() for every name in filenames from a
+        pool of up to max_workers threads, so that fetching N small
+        objects (like build history files) costs roughly one round
+        trip instead of N.  Each object is read completely in the
+        worker thread.  Returns a tuple of two dictionaries: filename
+        to stream for the downloads that worked, and filename to
+        exception for the ones that did not.
+
+        """
+        streams = {}
+        errors = {}
+        if len(filenames) == 0:
+            return (streams, errors)
+
+        def fetch(filename):
+            stream = self.download_to_stream(filename)
+            try:
+                data = stream.read()
+            finally:
+                stream.close()
+            if isinstance(data, bytes):
+                return io.BytesIO(data)
+            return io.StringIO(data)
+
+        workers = max(1, min(max_workers, len(filenames)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for filename in filenames:
+                futures[executor.submit(fetch, filename)] = filename
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                try:
+                    streams[filename] = future.result()
+                except Exception as e:
+                    logger.debug("-> download of %s failed: %s" % (filename, str(e)))
+                    errors[filename] = e
+        return (streams, errors)
+
+
     def upload_from_stream(self, filename, data, properties = {}):
         """Upload from a stream
 
@@ -60,6 +226,108 @@ class BuildFiler(object):
         raise NotImplementedError
 
 
+    def upload_from_fileobj(self, fileobj, remote_filename, properties = {}):
+        """Upload from a file object
+
+        Upload everything read from the (binary) file object fileobj
+        to the remote filename.  fileobj is read once, front to back,
+        and may not be seekable.
+
+        """
+        raise NotImplementedError
+
+
+    def get_properties(self, filename):
+        """Get the properties (metadata) stored with a remote object
+
+        Raises IOError with errno ENOENT if the object does not exist.
+        """
+        raise NotImplementedError
+
+
+    def copy(self, source_filename, remote_filename, properties = {}):
+        """Copy a remote object without transferring it through us"""
+        raise NotImplementedError
+
+
+    def _dedup_upload(self, local_filename, remote_filename, properties, algorithms):
+        if algorithms == None:
+            algorithms = hashutils.default_algorithms
+        hashes = hashutils.compute_hashes(local_filename,
+                                          list(set(algorithms) | set(['sha256'])))
+        digest = hashes['sha256']
+        size = os.path.getsize(local_filename)
+        properties = dict(properties)
+        properties['sha256'] = digest
+        entry = { 'sha256' : digest, 'size' : size }
+        retval = dict((name, hashes[name]) for name in algorithms)
+
+        def saved(how):
+            logger.debug("-> %s: %s (%d bytes not uploaded)" % (how, remote_filename, size))
+            with _stats_lock:
+                self._request_stats['dedup_hits'] += 1
+                self._request_stats['dedup_saved_bytes'] += size
+
+        index = self._load_dedup_index()
+        if index.get(remote_filename) == entry:
+            saved('unchanged (index)')
+            return retval
+
+        try:
+            if self.get_properties(remote_filename).get('sha256') == digest:
+                self._update_dedup_index(remote_filename, entry)
+                saved('unchanged')
+                return retval
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        for filename, other in index.items():
+            if other != entry or filename == remote_filename:
+                continue
+            try:
+                self.copy(filename, remote_filename, properties)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # index is stale
+                self._update_dedup_index(filename, None)
+                continue
+            self._update_dedup_index(remote_filename, entry)
+            saved('copied from %s' % (filename))
+            return retval
+
+        with open(local_filename, 'rb') as f:
+            self.upload_from_fileobj(f, remote_filename, properties)
+        self._update_dedup_index(remote_filename, entry)
+        return retval
+
+
+    def upload_from_file_with_hashes(self, local_filename, remote_filename,
+                                     properties = {}, algorithms = None):
+        """Upload a file and return its hashes
+
+        Upload the local_file to the remote filename, computing the
+        hashes of the file (md5, sha1, and sha256 by default) from the
+        same bytes that are sent, so the file is only read once.
+        Returns a dictionary of algorithm name to hex digest.  In dedup
+        mode (see enable_dedup()), the file is hashed before the
+        upload, which is skipped if the content is already stored.
+
+        """
+        if self._dedup_enabled():
+            return self._dedup_upload(local_filename, remote_filename,
+                                      properties, algorithms)
+        with open(local_filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            reader = hashutils.HashingReader(f, algorithms)
+            self.upload_from_fileobj(reader, remote_filename, properties)
+        if reader.bytes_read != size:
+            raise IOError('Uploaded %d bytes of %s, expected %d' %
+                          (reader.bytes_read, local_filename, size))
+        return reader.hexdigests()
+
+
     def delete(self, filename):
         """Delete file"""
         raise NotImplementedError
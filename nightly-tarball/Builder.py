@@ -7,48 +7,43 @@
 #
 
 import argparse
+import hashlib
+import contextlib
+import cProfile
+import pstats
 import logging
 import os
 import json
-import hashlib
 import time
 import datetime
 import shutil
 import subprocess
+import tempfile
 import fileinput
+import multiprocessing
+import queue
 import Coverity
+import FailedBuildArchiver
 import BuilderUtils
+import MirrorCache
+import MetricsExporter
 import smtplib
 from email.mime.text import MIMEText
-from git import Repo, exc
+from git import Repo, Git, exc
 from enum import Enum
 
 
-def compute_hashes(filename):
-    """Helper function to compute MD5 and SHA1 hashes"""
-    retval = {}
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
-    with open(filename, 'rb') as f:
-        while True:
-            data = f.read(64 * 1024)
-            if not data:
-                break
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
-    retval['md5'] = md5.hexdigest()
-    retval['sha1'] = sha1.hexdigest()
-    retval['sha256'] = sha256.hexdigest()
-    return retval
-
-
 # a note on paths used in the Builder...
 #
 # config['scratch_path']	: <scratch_path>
 # config['project_path']	: <scratch_path>/<project_short_name>
+# config['mirror_path']	: <scratch_path>/mirrors
+# config['trash_path']	: <scratch_path>/trash
+# config['run_report_file']	: <scratch_path>/<project_short_name>-run-report.json
+# config['upload_index_file']	: <scratch_path>/<project_short_name>-upload-index.json
 # current_build['build_root']	: <scratch_path>/<project_short_name>/<branch>-<build_time>/
+#				  (or <tmpfs_path>/<project_short_name>/<branch>-<build_time>/,
+#				  see choose_build_root_parent())
 # current_build['source_tree']	: <scratch_path>/<project_short_name>/<branch>-<build_time>/[repo]
 class Builder(object):
     """Build one or more branches of a git repo
@@ -61,7 +56,39 @@ class Builder(object):
 
     _base_options = { 'email_log_level' : 'INFO',
                       'console_log_level' : 'CRITICAL',
-                      'scratch_path' : '${TMPDIR}' }
+                      'scratch_path' : '${TMPDIR}',
+                      'max_parallel_builds' : 1,
+                      'use_mirror_cache' : True,
+                      'history_fetch_workers' : 16,
+                      'cleanup_workers' : 4,
+                      'background_cleanup' : True,
+                      'metrics_textfile_dir' : None,
+                      'profile' : False,
+                      'profile_top_n' : 40,
+                      'clone_mode' : 'full',
+                      'configure_cache' : None,
+                      'job_slots' : None,
+                      'tmpfs_path' : None,
+                      'tmpfs_margin' : 1.25,
+                      'tmpfs_min_free_memory' : 2 * 1024 * 1024 * 1024,
+                      'failed_build_compressor' : None,
+                      'failed_build_exclude' : None,
+                      'failed_build_include' : None,
+                      'extra_artifact_formats' : [],
+                      'upload_dedup' : False }
+
+    clone_modes = ['full', 'shallow', 'blobless']
+
+    # extra_artifact_formats name : (compressor command, suffix).  The
+    # compressors must write to stdout and take -T<threads>.
+    artifact_formats = { 'xz' : (['xz', '-c', '-6'], '.tar.xz'),
+                         'zst' : (['zstd', '-q', '-c', '-19'], '.tar.zst') }
+
+    # (suffix, decompressor command) of tarballs the build step can
+    # produce, in order of preference as a source for recompression
+    # and for Coverity
+    artifact_sources = [('.tar.gz', ['gzip', '-dc']),
+                        ('.tar.bz2', ['bzip2', '-dc'])]
 
     class BuildResult(Enum) :
         SUCCESS = 1
@@ -69,7 +96,7 @@ class Builder(object):
         SKIPPED = 3
 
 
-    def __init__(self, config, filer):
+    def __init__(self, config, filer, args=None, mirror_cache=None):
         """Create a Builder object
 
         Create a builder object, which will build most simple
@@ -80,6 +107,12 @@ class Builder(object):
         that functions provided by a subclass of Builder call into the
         Builder functions to do the actual work.
 
+        args is the command line to parse (default: sys.argv).  A
+        long-running process creating many builders (see Scheduler)
+        passes its own, and can share a MirrorCache between them with
+        mirror_cache (by default, each builder creates its own); it
+        should also close() every builder when done with it.
+
         """
         self._logger = None
         self._current_build = {}
@@ -89,7 +122,7 @@ class Builder(object):
         self._parser = argparse.ArgumentParser(description='Nightly build script for Open MPI related projects')
         self.add_arguments(self._parser)
         # copy arguments into options, assuming they were specified
-        for key, value in vars(self._parser.parse_args()).items():
+        for key, value in vars(self._parser.parse_args(args)).items():
             if not value == None:
                 self._config[key] = value
         # special case hack...  expand out scratch_path
@@ -97,6 +130,24 @@ class Builder(object):
         self._config['project_path'] = os.path.join(self._config['scratch_path'],
                                                     self._config['project_short_name'])
         self._config['builder_tools'] = os.path.dirname(os.path.realpath(__file__))
+        if not 'mirror_path' in self._config:
+            self._config['mirror_path'] = os.path.join(self._config['scratch_path'], 'mirrors')
+        if not 'trash_path' in self._config:
+            self._config['trash_path'] = os.path.join(self._config['scratch_path'], 'trash')
+        if not 'run_report_file' in self._config:
+            self._config['run_report_file'] = os.path.join(self._config['scratch_path'],
+                                                           '%s-run-report.json' %
+                                                           (self._config['project_short_name']))
+        if not 'upload_index_file' in self._config:
+            self._config['upload_index_file'] = os.path.join(self._config['scratch_path'],
+                                                             '%s-upload-index.json' %
+                                                             (self._config['project_short_name']))
+        # identifies this run to shared scratch state (like the mirror
+        # cache); parallel build children inherit it.
+        self._run_id = '%d-%d' % (os.getpid(), int(time.time()))
+        self._mirror_cache = None
+        self._coverity_queue = None
+        self._profiler = None
 
         # special hack for OMPI being inconsistent in short names....
         if not 'project_very_short_name' in self._config:
@@ -105,6 +156,27 @@ class Builder(object):
         if not os.path.exists(self._config['scratch_path']):
             os.makedirs(self._config['scratch_path'])
 
+        # one CPU budget for every command run by this builder,
+        # including parallel builds and Coverity jobs.  'auto' sizes
+        # it to the machine.
+        if self._config['job_slots'] != None and BuilderUtils.get_jobserver() == None:
+            if self._config['job_slots'] == 'auto':
+                slots = os.cpu_count()
+            else:
+                slots = int(self._config['job_slots'])
+            BuilderUtils.set_jobserver(BuilderUtils.JobServer(slots))
+
+        # artifacts whose content is already stored are not uploaded
+        # again (see BuildFiler.enable_dedup())
+        if self._config['upload_dedup']:
+            self._filer.enable_dedup(self._config['upload_index_file'])
+
+        if mirror_cache != None:
+            self._mirror_cache = mirror_cache
+        elif self._config['use_mirror_cache']:
+            self._mirror_cache = MirrorCache.MirrorCache(self._config['mirror_path'],
+                                                         self._run_id)
+
         # logging initialization.  Logging will work after this point.
         self._logger = logging.getLogger("Builder")
         # while we use the handler levels to limit output, the
@@ -118,13 +190,16 @@ class Builder(object):
         else:
             self._logger.setLevel(logging.INFO)
 
-        ch = logging.StreamHandler()
-        ch.setLevel(self._config['console_log_level'])
-        ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-        self._logger.addHandler(ch)
+        self._ch = logging.StreamHandler()
+        self._ch.setLevel(self._config['console_log_level'])
+        self._ch.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        self._logger.addHandler(self._ch)
 
-        self._config['log_file'] = os.path.join(self._config['scratch_path'],
-                                                'builder-output-%d.log' % (int(time.time())))
+        # unique, even for builders created in the same second
+        fd, self._config['log_file'] = tempfile.mkstemp(prefix='builder-output-%d-' % (int(time.time())),
+                                                        suffix='.log',
+                                                        dir=self._config['scratch_path'])
+        os.close(fd)
 
         self._fh = logging.FileHandler(self._config['log_file'], 'w')
         self._fh.setLevel(self._config['email_log_level'])
@@ -133,12 +208,26 @@ class Builder(object):
 
 
     def __del__(self):
+        self.close()
+
+
+    def close(self):
+        """Release the builder's log handlers and log file
+
+        Handlers are attached to the shared Builder logger, so they
+        would otherwise pile up in a process that creates many
+        builders.  Safe to call more than once.
+
+        """
         # delete the log file, since it doesn't auto-clean (we're only
         # using it for email, so no one will miss it)
         if self._logger != None:
+            self._logger.removeHandler(self._ch)
             self._logger.removeHandler(self._fh)
             self._fh.close()
-            os.remove(self._config['log_file'])
+            if os.path.exists(self._config['log_file']):
+                os.remove(self._config['log_file'])
+            self._logger = None
 
 
     def add_arguments(self, parser):
@@ -160,6 +249,12 @@ class Builder(object):
         self._parser.add_argument('--scratch-path',
                                   help='Directory to use as base of build tree.',
                                   type=str)
+        self._parser.add_argument('--max-parallel-builds',
+                                  help='Number of branches to build concurrently (default: 1).',
+                                  type=int)
+        self._parser.add_argument('--profile',
+                                  help='Profile the builder and write the results next to the log files.',
+                                  action='store_true', default=None)
 
 
     def run(self):
@@ -171,42 +266,102 @@ class Builder(object):
         helper function run_single_build() to execute each build.  The
         only real logic in this function (other than iterating over
         keys and calling single_build) is to write the summary output
-        / send emails).
+        / send emails).  Returns a dictionary of branch name to the
+        Builder.BuildResult of its build.
 
         """
+        with self.profiled(self.get_profile_filename()):
+            return self.run_builds()
+
+
+    def run_builds(self):
+        """Helper function for run(), which may need to wrap it in a profiler"""
         self._logger.info("Branches: %s", str(self._config['branches'].keys()))
+        run_start = time.time()
         good_builds = []
         failed_builds = []
         skipped_builds = []
 
-        for branch_name in self._config['branches']:
+        branches = list(self._config['branches'].keys())
+        if self._config['max_parallel_builds'] > 1:
+            outcomes = self.run_parallel_builds(branches)
+        else:
+            outcomes = self.run_serial_builds(branches)
+
+        # report in configuration order, not completion order, so that
+        # the email looks the same no matter how the builds were run.
+        # Branches that never ran (because an earlier build threw an
+        # exception) are not reported, same as the serial case.
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            result = outcomes[branch_name]['result']
+            if result == Builder.BuildResult.SUCCESS:
+                good_builds.append(branch_name)
+            elif result == Builder.BuildResult.FAILED:
+                failed_builds.append(branch_name)
+            elif result == Builder.BuildResult.SKIPPED:
+                skipped_builds.append(branch_name)
+
+        # wait for background Coverity runs, which live in the project
+        # directory
+        coverity_results = []
+        if self._coverity_queue != None:
+            coverity_results = self._coverity_queue.wait()
+
+        try:
+            self.write_run_report(run_start, branches, outcomes, coverity_results)
+        except Exception as e:
+            self._logger.error("Failed to write run report: %s" % (str(e)))
+        if self._config['metrics_textfile_dir'] != None:
             try:
-                result = self.run_single_build(branch_name)
-                if result == Builder.BuildResult.SUCCESS:
-                    good_builds.append(branch_name)
-                elif result == Builder.BuildResult.FAILED:
-                    failed_builds.append(branch_name)
-                elif result == Builder.BuildResult.SKIPPED:
-                    skipped_builds.append(branch_name)
+                self.write_metrics(run_start, branches, outcomes, coverity_results)
             except Exception as e:
-                self._logger.error("run_single_build(%s) threw exception %s: %s" %
-                                   (branch_name, str(type(e)), str(e)))
-                failed_builds.append(branch_name)
-                # if run_single_build throws an exception, we should
-                # not continue trying to run, but should just do the
-                # cleanup work
-                break
+                self._logger.error("Failed to write metrics: %s" % (str(e)))
+
+        # each build only cleans up its own build root, so that
+        # concurrent builds do not step on each other.  Get rid of
+        # anything else left behind in the project directory.
+        project_paths = [self._config['project_path']]
+        if self._config['tmpfs_path'] != None:
+            project_paths.append(os.path.join(self._config['tmpfs_path'],
+                                              self._config['project_short_name']))
+        for project_path in project_paths:
+            if not os.path.exists(project_path):
+                continue
+            try:
+                self.remove_tree(project_path)
+            except Exception as e:
+                self._logger.error("Failed to remove %s: %s" %
+                                   (project_path, str(e)))
 
         # Generate results output for email
         body = "Successful builds: %s\n" % (str(good_builds))
         body += "Skipped builds: %s\n" % (str(skipped_builds))
         body += "Failed builds: %s\n" % (str(failed_builds))
+        body += self.generate_precheck_summary(branches, outcomes)
+        body += self.generate_scratch_tier_summary(branches, outcomes)
+        body += self.generate_timing_summary(branches, outcomes)
+        body += self.generate_dedup_summary(branches, outcomes)
+        for result in coverity_results:
+            body += "Coverity %s: %s (%d seconds)\n" % (result['name'],
+                                                       'SUCCESS' if result['success'] else 'FAILED',
+                                                       result['seconds'])
         if len(failed_builds) > 0:
             subject = "%s nightly build: FAILURE" % (self._config['project_name'])
         else:
             subject = "%s nightly build: SUCCESS" % (self._config['project_name'])
         body += "\n=== Build output ===\n\n"
         body += open(self._config['log_file'], 'r').read()
+        for branch_name in branches:
+            branch_log_file = self.get_branch_log_filename(branch_name)
+            if os.path.exists(branch_log_file):
+                body += open(branch_log_file, 'r').read()
+                os.remove(branch_log_file)
+        if len(coverity_results) > 0:
+            body += "\n=== Coverity output ===\n\n"
+            for result in coverity_results:
+                body += result['output']
         body += "\nYour friendly daemon,\nCyrador\n"
 
         msg = MIMEText(body)
@@ -218,6 +373,389 @@ class Builder(object):
         s.sendmail(self._config['email_from'], [self._config['email_dest']], msg.as_string())
         s.quit()
 
+        return dict((branch_name, outcome['result']) for branch_name, outcome in outcomes.items())
+
+
+    def write_run_report(self, run_start, branches, outcomes, coverity_results):
+        """Write a machine-readable summary of this run
+
+        Writes the result, revision, phase timings, and per-command
+        resource usage of every build, plus the results of any
+        Coverity jobs, as JSON to config['run_report_file'] (replacing
+        the report from the previous run).
+
+        """
+        report = { 'project' : self._config['project_short_name'],
+                   'run_id' : self._run_id,
+                   'start_time' : int(run_start),
+                   'end_time' : int(time.time()),
+                   'builds' : {},
+                   'coverity' : [] }
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            outcome = outcomes[branch_name]
+            build = { 'result' : outcome['result'].name,
+                      'error' : outcome['error'] }
+            build.update(outcome['report'])
+            report['builds'][branch_name] = build
+        for result in coverity_results:
+            report['coverity'].append({ 'name' : result['name'],
+                                        'success' : result['success'],
+                                        'seconds' : result['seconds'],
+                                        'resource_usage' : result.get('resource_usage') })
+
+        tmp_file = self._config['run_report_file'] + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self._config['run_report_file'])
+
+
+    def write_metrics(self, run_start, branches, outcomes, coverity_results):
+        """Export metrics for this run
+
+        Writes an OpenMetrics text file named
+        nightly_<project_short_name>.prom to
+        config['metrics_textfile_dir'] (for example, the node_exporter
+        textfile collector directory), replacing the file from the
+        previous run.
+
+        """
+        now = time.time()
+        exporter = MetricsExporter.MetricsExporter()
+        project = { 'project' : self._config['project_short_name'] }
+
+        exporter.add('nightly_build_run_timestamp_seconds', int(now), project,
+                     help='Time the last nightly run finished')
+        exporter.add('nightly_build_run_duration_seconds', round(now - run_start, 3), project,
+                     help='Duration of the last nightly run')
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            labels = dict(project, branch=branch_name)
+            result = outcomes[branch_name]['result']
+            report = outcomes[branch_name]['report']
+            for possible in Builder.BuildResult:
+                exporter.add('nightly_build_result', possible == result,
+                             dict(labels, result=possible.name),
+                             help='Result of the last build of the branch')
+            for phase, seconds in report.get('timings', {}).items():
+                exporter.add('nightly_build_phase_seconds', seconds,
+                             dict(labels, phase=phase),
+                             help='Duration of each phase of the last build')
+            for artifact, data in report.get('artifacts', {}).items():
+                exporter.add('nightly_build_artifact_bytes', data['size'],
+                             dict(labels, artifact=artifact),
+                             help='Size of each artifact of the last build')
+            # a crashed parallel build child has an empty report
+            filer_stats = report.get('filer_stats')
+            if filer_stats != None:
+                exporter.add('nightly_build_uploaded_bytes', filer_stats['uploaded_bytes'], labels,
+                             help='Bytes uploaded to storage by the last build')
+                exporter.add('nightly_build_downloaded_bytes', filer_stats['downloaded_bytes'], labels,
+                             help='Bytes downloaded from storage by the last build')
+                exporter.add('nightly_build_dedup_saved_bytes', filer_stats.get('dedup_saved_bytes', 0),
+                             labels,
+                             help='Upload bytes the last build saved by deduplication')
+                for operation, count in filer_stats['requests'].items():
+                    exporter.add('nightly_build_storage_requests', count,
+                                 dict(labels, operation=operation),
+                                 help='Storage requests made by the last build')
+            if 'last_success_time' in report:
+                exporter.add('nightly_build_last_success_timestamp_seconds',
+                             report['last_success_time'], labels,
+                             help='Time of the last successful build of the branch')
+                exporter.add('nightly_build_last_success_age_seconds',
+                             int(now) - report['last_success_time'], labels,
+                             help='Age of the last successful build of the branch')
+        for result in coverity_results:
+            labels = dict(project, job=result['name'])
+            exporter.add('nightly_build_coverity_success', result['success'], labels,
+                         help='Whether the Coverity job succeeded')
+            exporter.add('nightly_build_coverity_seconds', result['seconds'], labels,
+                         help='Duration of the Coverity job')
+
+        exporter.write_textfile(os.path.join(self._config['metrics_textfile_dir'],
+                                             'nightly_%s.prom' % (self._config['project_short_name'])))
+
+
+    def generate_precheck_summary(self, branches, outcomes):
+        """Helper function to describe clones avoided by the remote ref check"""
+        precheck_skips = []
+        time_saved = 0
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            precheck = outcomes[branch_name]['report'].get('precheck')
+            if precheck == None or not precheck['skipped_clone']:
+                continue
+            precheck_skips.append(branch_name)
+            if precheck['time_saved'] != None:
+                time_saved += precheck['time_saved']
+        if len(precheck_skips) == 0:
+            return ''
+        return ("Unchanged at remote (clone skipped): %s (~%d seconds of checkout saved)\n"
+                % (str(precheck_skips), time_saved))
+
+
+    def generate_scratch_tier_summary(self, branches, outcomes):
+        """Helper function to describe where each build root was placed"""
+        if self._config['tmpfs_path'] == None:
+            return ''
+        tiers = []
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            tier = outcomes[branch_name]['report'].get('scratch_tier')
+            if tier != None:
+                tiers.append('%s: %s' % (branch_name, tier))
+        if len(tiers) == 0:
+            return ''
+        return "Build root placement: %s\n" % (', '.join(tiers))
+
+
+    def generate_dedup_summary(self, branches, outcomes):
+        """Helper function to describe what upload deduplication saved"""
+        if not self._config['upload_dedup']:
+            return ''
+        hits = 0
+        saved_bytes = 0
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            filer_stats = outcomes[branch_name]['report'].get('filer_stats', {})
+            hits += filer_stats.get('dedup_hits', 0)
+            saved_bytes += filer_stats.get('dedup_saved_bytes', 0)
+        return "\nUpload dedup: %d artifact(s) already stored, %d bytes not uploaded\n" % (hits, saved_bytes)
+
+
+    def generate_timing_summary(self, branches, outcomes):
+        """Helper function to tabulate per-phase timings of each build"""
+        timings = {}
+        phases = []
+        for branch_name in branches:
+            if not branch_name in outcomes:
+                continue
+            branch_timings = outcomes[branch_name]['report'].get('timings')
+            if branch_timings == None or len(branch_timings) == 0:
+                continue
+            timings[branch_name] = branch_timings
+            for phase in branch_timings:
+                if not phase in phases:
+                    phases.append(phase)
+        if len(timings) == 0:
+            return ''
+
+        width = max(len(phase) for phase in phases)
+        columns = [max(len(branch_name), 8) for branch_name in timings]
+        summary = "\nTimings (seconds):\n"
+        summary += '  %-*s' % (width, 'phase')
+        for branch_name, column in zip(timings, columns):
+            summary += '  %*s' % (column, branch_name)
+        summary += '\n'
+        for phase in phases:
+            summary += '  %-*s' % (width, phase)
+            for branch_name, column in zip(timings, columns):
+                if phase in timings[branch_name]:
+                    summary += '  %*.1f' % (column, timings[branch_name][phase])
+                else:
+                    summary += '  %*s' % (column, '-')
+            summary += '\n'
+        return summary
+
+
+    def run_serial_builds(self, branches):
+        """Run the builds for branches one at a time
+
+        Returns a dictionary of branch name to outcome (see
+        run_parallel_builds()).  If run_single_build() throws an
+        exception, the remaining builds are not started.
+
+        """
+        outcomes = {}
+        for branch_name in branches:
+            try:
+                result = self.run_single_build(branch_name)
+                outcomes[branch_name] = { 'result' : result, 'error' : None,
+                                          'report' : self.get_build_report() }
+                self.submit_coverity(branch_name, outcomes[branch_name]['report'])
+            except Exception as e:
+                self._logger.error("run_single_build(%s) threw exception %s: %s" %
+                                   (branch_name, str(type(e)), str(e)))
+                outcomes[branch_name] = { 'result' : Builder.BuildResult.FAILED,
+                                          'error' : str(e),
+                                          'report' : self.get_build_report() }
+                # if run_single_build throws an exception, we should
+                # not continue trying to run, but should just do the
+                # cleanup work
+                break
+        return outcomes
+
+
+    def run_parallel_builds(self, branches):
+        """Run the builds for branches in a pool of child processes
+
+        Up to config['max_parallel_builds'] branches are built at the
+        same time.  Each build runs in a forked child process, so it
+        has its own copy of _current_build, its own working directory
+        (the build steps chdir() around quite a bit), and its own log
+        file (see get_branch_log_filename()).  Outcomes are passed
+        back to the parent through a queue.  As in the serial case, if
+        a build throws an exception, no more builds are started, but
+        builds already running are allowed to finish.
+
+        """
+        max_parallel = self._config['max_parallel_builds']
+        ctx = multiprocessing.get_context('fork')
+        result_queue = ctx.Queue()
+        pending = list(branches)
+        running = {}
+        outcomes = {}
+        abort = False
+
+        while len(running) > 0 or (len(pending) > 0 and not abort):
+            while not abort and len(pending) > 0 and len(running) < max_parallel:
+                branch_name = pending.pop(0)
+                self._logger.debug("Starting child build for %s" % (branch_name))
+                child = ctx.Process(target=self._run_child_build,
+                                    args=(branch_name, result_queue))
+                child.start()
+                running[branch_name] = child
+
+            try:
+                outcome = result_queue.get(timeout=5)
+            except queue.Empty:
+                # a child that died without reporting (OOM killer,
+                # signal, ...) will never post an outcome, so look
+                # for them rather than waiting forever.
+                for branch_name, child in list(running.items()):
+                    if not child.is_alive() and child.exitcode != 0:
+                        child.join()
+                        del running[branch_name]
+                        self._logger.error("build for %s died with exit code %s" %
+                                           (branch_name, str(child.exitcode)))
+                        outcomes[branch_name] = { 'result' : Builder.BuildResult.FAILED,
+                                                  'error' : 'child exited with %s' % (str(child.exitcode)),
+                                                  'report' : {} }
+                        abort = True
+                continue
+
+            branch_name = outcome['branch_name']
+            running.pop(branch_name).join()
+            outcomes[branch_name] = { 'result' : Builder.BuildResult[outcome['result']],
+                                      'error' : outcome['error'],
+                                      'report' : outcome['report'] }
+            self.submit_coverity(branch_name, outcome['report'])
+            if outcome['error'] != None:
+                self._logger.error("run_single_build(%s) threw exception: %s" %
+                                   (branch_name, outcome['error']))
+                abort = True
+
+        return outcomes
+
+
+    def _run_child_build(self, branch_name, result_queue):
+        """Body of a forked child build
+
+        Redirect the email log stream to a per-branch file (the parent
+        stitches them together when building the email), run the
+        build, and report the outcome to the parent.  Never raises.
+
+        """
+        self._logger.removeHandler(self._fh)
+        self._fh = logging.FileHandler(self.get_branch_log_filename(branch_name), 'w')
+        self._fh.setLevel(self._config['email_log_level'])
+        self._fh.setFormatter(logging.Formatter('%(message)s'))
+        self._logger.addHandler(self._fh)
+
+        outcome = { 'branch_name' : branch_name,
+                    'result' : Builder.BuildResult.FAILED.name,
+                    'error' : None,
+                    'report' : {} }
+        try:
+            with self.profiled(self.get_profile_filename(branch_name)):
+                outcome['result'] = self.run_single_build(branch_name).name
+        except Exception as e:
+            outcome['error'] = '%s: %s' % (str(type(e)), str(e))
+        outcome['report'] = self.get_build_report()
+        self._fh.flush()
+        result_queue.put(outcome)
+
+
+    def get_build_report(self):
+        """Helper function to summarize the current build for run()
+
+        Returns a (picklable) dictionary of the bits of _current_build
+        that run() needs to write the summary, since in parallel mode
+        _current_build only exists in the child process.
+
+        """
+        report = {}
+        for key in ['revision', 'precheck', 'coverity_job', 'timings', 'resource_usage',
+                    'artifacts', 'autogen_cache', 'configure_cache', 'scratch_tier',
+                    'failed_archive', 'recompression']:
+            if key in self._current_build:
+                report[key] = self._current_build[key]
+        report['filer_stats'] = self._filer.get_request_stats()
+        build_history = self._current_build.get('build_history')
+        if build_history != None and len(build_history) > 0:
+            # the build history only holds successful builds
+            report['last_success_time'] = max(build_history.keys())
+        return report
+
+
+    def get_branch_log_filename(self, branch_name):
+        """Helper function to name the per-branch log of a parallel build"""
+        return '%s-%s' % (self._config['log_file'], branch_name)
+
+
+    def get_profile_filename(self, branch_name=None):
+        """Helper function to name profiler output
+
+        Returns the base name (without extension) of the profile of
+        the whole run, or of the child process building branch_name in
+        a parallel build.
+
+        """
+        base = os.path.splitext(self._config['log_file'])[0]
+        if branch_name == None:
+            return base
+        return '%s-%s' % (base, branch_name)
+
+
+    @contextlib.contextmanager
+    def profiled(self, filename):
+        """Context manager to run the body under cProfile if profiling is enabled
+
+        With config['profile'] set, profiles the body and writes the
+        raw profile to <filename>.prof (for pstats, snakeviz, etc.)
+        and the top config['profile_top_n'] functions by cumulative
+        and by internal time to <filename>.txt.  A forked child build
+        stops the profiler it inherited from the parent and starts its
+        own, so each parallel build gets its own profile.
+
+        """
+        if not self._config['profile']:
+            yield
+            return
+
+        if self._profiler != None:
+            self._profiler.disable()
+        profiler = cProfile.Profile()
+        self._profiler = profiler
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._profiler = None
+            profiler.dump_stats(filename + '.prof')
+            with open(filename + '.txt', 'w') as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats('cumulative').print_stats(self._config['profile_top_n'])
+                stats.sort_stats('tottime').print_stats(self._config['profile_top_n'])
+            self._logger.info("Profile written to %s.prof" % (filename))
+
 
     def run_single_build(self, branch_name):
         """Run a single branch build
@@ -228,8 +766,11 @@ class Builder(object):
 
         """
         self._logger.info("\nStarting build for " + branch_name)
+        self._filer.reset_request_stats()
         self._current_build = { "status" : 0,
-                                "branch_name" : branch_name }
+                                "branch_name" : branch_name,
+                                "timings" : {},
+                                "resource_usage" : {} }
         retval = Builder.BuildResult.SUCCESS
 
         remote_repository = self._config['repository']
@@ -237,27 +778,59 @@ class Builder(object):
         now = time.time()
         self._current_build['build_unix_time'] = int(now)
         self._current_build['build_time'] = self.generate_build_time(now)
-        build_root = os.path.join(self._config['project_path'],
-                                  branch_name + "-" + self._current_build['build_time'])
-        source_tree = os.path.join(build_root,
-                                   os.path.basename(remote_repository))
-
         self._current_build['remote_repository'] = remote_repository
-        self._current_build['build_root'] = build_root
-        self._current_build['source_tree'] = source_tree
         self._current_build['branch'] = branch_name
 
-        build_history = self.get_build_history()
+        with self.timed('build_history'):
+            build_history = self.get_build_history()
         if len(build_history) > 0:
             # this is really kind of awful, but build_history keys are
             # unix timestamps of the build.  Find the last timestamp,
             # and that's the last build.  Then look at the revision to
             # get the revision id of that build.
-            last_version = build_history[sorted(build_history.keys())[-1:][0]]['revision']
+            last_build = build_history[sorted(build_history.keys())[-1:][0]]
+            last_version = last_build['revision']
         else:
+            last_build = {}
             last_version = ''
-
-        self.prepare_source_tree()
+        self._current_build['build_history'] = build_history
+
+        # Most nights, most branches have not changed.  Ask the remote
+        # for the branch HEAD before paying for a clone.
+        self._current_build['precheck'] = { 'skipped_clone' : False,
+                                            'time_saved' : None }
+        with self.timed('precheck'):
+            remote_revision = self.get_remote_revision()
+        if (last_version != '' and remote_revision != None
+            and remote_revision.startswith(last_version)):
+            self._logger.info("Build for revision %s already exists, skipping.",
+                              last_version)
+            self._current_build['revision'] = last_version
+            self._current_build['precheck']['skipped_clone'] = True
+            self._current_build['precheck']['time_saved'] = last_build.get('source_tree_seconds')
+            with self.timed('remote_cleanup'):
+                self.remote_cleanup(build_history)
+            return Builder.BuildResult.SKIPPED
+
+        build_root = os.path.join(self.choose_build_root_parent(build_history),
+                                  branch_name + "-" + self._current_build['build_time'])
+        self._current_build['build_root'] = build_root
+        self._current_build['source_tree'] = os.path.join(build_root,
+                                                          os.path.basename(remote_repository))
+        # build_root (and maybe its parent) does not exist yet
+        if self._current_build['scratch_tier'] == 'tmpfs':
+            monitor = BuilderUtils.PeakUsageMonitor(self._config['tmpfs_path'])
+        else:
+            monitor = BuilderUtils.PeakUsageMonitor(self._config['scratch_path'])
+        monitor.start()
+        try:
+            with self.timed('source_tree'):
+                self.prepare_source_tree()
+        except:
+            monitor.stop()
+            self.release_tmpfs_reservation()
+            raise
+        self._current_build['source_tree_seconds'] = int(self._current_build['timings']['source_tree'])
         try:
             if last_version == self._current_build['revision']:
                 self._logger.info("Build for revision %s already exists, skipping.",
@@ -267,37 +840,181 @@ class Builder(object):
                 self._logger.info("Found new revision %s",
                                   self._current_build['revision'])
 
-                self.update_version_file()
-                self.build()
-                self.find_build_artifacts()
-                self.publish_build_artifacts()
+                with self.timed('update_version_file'):
+                    self.update_version_file()
+                with self.timed('build'):
+                    try:
+                        self.build()
+                    finally:
+                        self._current_build['build_root_bytes'] = monitor.stop()
+                with self.timed('find_build_artifacts'):
+                    self.find_build_artifacts()
+                if len(self._config['extra_artifact_formats']) > 0:
+                    with self.timed('recompress_artifacts'):
+                        self.recompress_artifacts()
+                with self.timed('publish_build_artifacts'):
+                    self.publish_build_artifacts()
                 if ('coverity' in self._config['branches'][branch_name]
                     and self._config['branches'][branch_name]['coverity']
                     and len(self._current_build['artifacts']) > 0):
-                    try:
-                        Coverity.run_coverity(self._logger,
-                                              self._current_build['build_root'],
-                                              os.path.join(self._current_build['source_tree'],
-                                                           next(iter(self._current_build['artifacts'].keys()))),
-                                              self._config['coverity'])
-                    except Exception as e:
-                        self._logger.error("ERROR: Coverity submission failed: %s"
-                                           % (str(e)))
-                    else:
-                        self._logger.info("Successfully submitted Coverity build")
+                    with self.timed('stage_coverity'):
+                        self.stage_coverity()
                 self._logger.info("%s build of revision %s completed successfully" %
                                   (branch_name, self._current_build['revision']))
         except Exception as e:
             self._logger.error("FAILURE: %s: %s"
                                % (str(type(e)), str(e)))
-            self.publish_failed_build()
+            with self.timed('publish_failed_build'):
+                self.publish_failed_build()
             retval = Builder.BuildResult.FAILED
         finally:
-            self.cleanup()
-            self.remote_cleanup(build_history)
+            if not 'build_root_bytes' in self._current_build:
+                monitor.stop()
+            with self.timed('cleanup'):
+                self.cleanup()
+            self.release_tmpfs_reservation()
+            with self.timed('remote_cleanup'):
+                self.remote_cleanup(build_history)
         return retval
 
 
+    def choose_build_root_parent(self, build_history):
+        """Decide where to put the current build's build root
+
+        If config['tmpfs_path'] is set, the build root goes on that
+        (presumably tmpfs) file system when it looks like the build
+        fits: the largest build_root_bytes of the branch's earlier
+        builds, times config['tmpfs_margin'], plus space reserved by
+        other builds running on the tmpfs at the same time, must fit
+        both in the free space of the file system and in available
+        memory minus config['tmpfs_min_free_memory'].  Otherwise (or
+        if nothing is known about the branch's builds yet), the build
+        root goes in config['project_path'] on disk.  The choice is
+        recorded in _current_build['scratch_tier'].  Returns the
+        directory to create the build root in.
+
+        """
+        self._current_build['scratch_tier'] = 'disk'
+        tmpfs_path = self._config['tmpfs_path']
+        if tmpfs_path == None:
+            return self._config['project_path']
+
+        expected = 0
+        for build in build_history.values():
+            expected = max(expected, build.get('build_root_bytes', 0))
+        if expected == 0:
+            self._logger.debug("No build size history; building on disk")
+            return self._config['project_path']
+        needed = int(expected * self._config['tmpfs_margin'])
+
+        reservation_path = os.path.join(tmpfs_path, '.builder-reservations')
+        if not os.path.isdir(reservation_path):
+            os.makedirs(reservation_path)
+        with BuilderUtils.file_lock(reservation_path + '.lock'):
+            reserved = 0
+            for name in os.listdir(reservation_path):
+                reservation_file = os.path.join(reservation_path, name)
+                try:
+                    os.kill(int(name), 0)
+                except (ValueError, ProcessLookupError):
+                    # the build that made it is gone
+                    os.remove(reservation_file)
+                    continue
+                except PermissionError:
+                    pass
+                with open(reservation_file, 'r') as f:
+                    reserved += int(f.read())
+
+            info = os.statvfs(tmpfs_path)
+            available = info.f_bavail * info.f_frsize
+            memory = BuilderUtils.get_available_memory()
+            if memory != None:
+                available = min(available, memory - self._config['tmpfs_min_free_memory'])
+            self._logger.debug("tmpfs placement: need %d, reserved %d, available %d" %
+                               (needed, reserved, available))
+            if needed + reserved > available:
+                return self._config['project_path']
+
+            with open(os.path.join(reservation_path, str(os.getpid())), 'w') as f:
+                f.write('%d\n' % (needed))
+        self._current_build['scratch_tier'] = 'tmpfs'
+        return os.path.join(tmpfs_path, self._config['project_short_name'])
+
+
+    def release_tmpfs_reservation(self):
+        """Give back the tmpfs space reserved by choose_build_root_parent()"""
+        if self._current_build.get('scratch_tier') != 'tmpfs':
+            return
+        reservation_file = os.path.join(self._config['tmpfs_path'], '.builder-reservations',
+                                        str(os.getpid()))
+        if os.path.exists(reservation_file):
+            os.remove(reservation_file)
+
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Context manager to record how long a phase of the current build takes
+
+        The elapsed time (in seconds) is added to
+        _current_build['timings'][phase], whether or not the phase
+        raises an exception.  Phases may nest, and a phase that runs
+        more than once accumulates.  Every call() is timed as
+        'call <log name>', so subclasses get per-command timings
+        without doing anything.
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            timings = self._current_build['timings']
+            timings[phase] = round(timings.get(phase, 0) + time.time() - start, 3)
+
+
+    def stage_coverity(self):
+        """Prepare a Coverity run of the current build
+
+        Coverity runs in the background (see Coverity.CoverityQueue)
+        after the build root is long gone, so give it its own build
+        root with a copy of the source tarball.  run() picks the job
+        up from the build report and queues it.
+
+        """
+        branch_name = self._current_build['branch_name']
+        coverity_root = os.path.join(self._config['project_path'],
+                                     'coverity-%s-%s' % (branch_name,
+                                                         self._current_build['build_time']))
+        tarball = self.get_source_artifact()
+        if tarball == None:
+            tarball = next(iter(self._current_build['artifacts'].keys()))
+        os.makedirs(coverity_root)
+        source_tarball = os.path.join(coverity_root, tarball)
+        shutil.copyfile(os.path.join(self._current_build['source_tree'], tarball),
+                        source_tarball)
+        self._current_build['coverity_job'] = { 'build_root' : coverity_root,
+                                                'source_tarball' : source_tarball }
+        cache_file = self.get_configure_cache_file('coverity')
+        if cache_file != None:
+            self._current_build['coverity_job']['configure_cache_file'] = cache_file
+        self._logger.info("Queued Coverity analysis of %s" % (tarball))
+
+
+    def submit_coverity(self, branch_name, report):
+        """Queue a Coverity job staged by stage_coverity(), if any"""
+        if not 'coverity_job' in report:
+            return
+        if self._coverity_queue == None:
+            max_parallel = self._config['coverity'].get('max_parallel_jobs', 1)
+            self._coverity_queue = Coverity.CoverityQueue(max_parallel,
+                                                          self._config['email_log_level'])
+        job = report['coverity_job']
+        config = dict(self._config['coverity'])
+        if 'configure_cache_file' in job:
+            config['configure_cache_file'] = job['configure_cache_file']
+        self._coverity_queue.submit(branch_name, job['build_root'],
+                                    job['source_tarball'], config)
+
+
     def generate_build_time(self, build_unix_time):
         """Helper function to format time strings from unix time"""
         return datetime.datetime.utcfromtimestamp(build_unix_time).strftime("%Y%m%d%H%M")
@@ -321,6 +1038,20 @@ class Builder(object):
                                                         revision))
 
 
+    def generate_build_index_filename(self, branch_name):
+        """Helper function to build the build index filename
+
+        The build index is a single object per branch holding the
+        contents of every build history file for that branch, so that
+        the history can be loaded with one read instead of one read
+        per build.  Note that the name intentionally does not match
+        build-*.json.
+
+        """
+        return os.path.join(self._config['branches'][branch_name]['output_location'],
+                            'builds-index.json')
+
+
     def get_build_history(self):
         """Helper function to list all known builds for the current branch
 
@@ -329,39 +1060,157 @@ class Builder(object):
         Returns an empty list if there are no known builds for the
         current branch.
 
+        The build index is used for any build history file it knows
+        about; only files missing from the index are downloaded (all
+        at once, see BuildFiler.download_many_to_streams()).  If
+        the index is missing or does not match the list of build
+        history files, it is rebuilt and republished.
+
         """
         branch_name = self._current_build['branch_name']
         dirname = self._config['branches'][branch_name]['output_location']
         builds = self._filer.file_search(dirname, "build-*.json")
+        index = self.get_build_index()
         build_history = {}
+        ignored = []
+        stale = False
+        candidates = {}
+        missing = []
         for build in builds:
-            self._logger.debug("looking at data file %s" % build)
-            stream = self._filer.download_to_stream(build)
-            data = json.load(stream)
-            if not 'build_unix_time' in data:
-                continue
-            if not 'branch' in data:
+            name = os.path.basename(build)
+            if name in index['builds']:
+                candidates[name] = index['builds'][name]
+            elif name in index['ignored']:
+                ignored.append(name)
+            else:
+                missing.append(build)
+
+        # fetch everything the index did not know about in one batch
+        if len(missing) > 0:
+            stale = True
+            self._logger.debug("fetching %d build history files not in the index" % (len(missing)))
+            streams, errors = self._filer.download_many_to_streams(missing,
+                                                                   self._config['history_fetch_workers'])
+            for build, e in errors.items():
+                self._logger.warn("Could not read build history %s: %s" % (build, str(e)))
+            if len(errors) > 0:
+                # don't risk losing track of builds; fail like the
+                # one-at-a-time loop used to
+                raise next(iter(errors.values()))
+            for build, stream in streams.items():
+                candidates[os.path.basename(build)] = json.load(stream)
+
+        for name, data in candidates.items():
+            if (not 'build_unix_time' in data or not 'branch' in data
+                or data['branch'] != branch_name):
+                ignored.append(name)
                 continue
-            data_build_unix_time = data['build_unix_time']
-            data_branch_name = data['branch']
-            if data_branch_name == branch_name:
-                build_history[data_build_unix_time] = data
+            build_history[data['build_unix_time']] = data
+        if len(build_history) + len(ignored) != len(index['builds']) + len(index['ignored']):
+            stale = True
+
+        self._current_build['build_index_ignored'] = ignored
+        if stale:
+            self._logger.debug("build index for %s is stale, republishing" % (branch_name))
+            self.publish_build_index(build_history)
         return build_history
 
 
+    def get_build_index(self):
+        """Helper function to load the build index for the current branch
+
+        Returns a dictionary with a 'builds' key (build history file
+        name to build history object) and an 'ignored' key (build
+        history files that do not belong to this branch).  Both are
+        empty if there is no usable index.
+
+        """
+        branch_name = self._current_build['branch_name']
+        index = { 'builds' : {}, 'ignored' : [] }
+        try:
+            stream = self._filer.download_to_stream(self.generate_build_index_filename(branch_name))
+            data = json.load(stream)
+        except Exception as e:
+            self._logger.debug("No usable build index for %s: %s" % (branch_name, str(e)))
+            return index
+        if data.get('version') != 1:
+            return index
+        index['builds'] = data['builds']
+        index['ignored'] = data['ignored']
+        return index
+
+
+    def publish_build_index(self, build_history):
+        """Publish the build index for the current branch
+
+        Replaces the index with one generated from build_history.  The
+        index is written as a single object, so readers (including
+        the web front end) see either the old or the new index, never
+        a partial one.
+
+        """
+        branch_name = self._current_build['branch_name']
+        index = { 'version' : 1,
+                  'branch' : branch_name,
+                  'builds' : {},
+                  'ignored' : self._current_build.get('build_index_ignored', []) }
+        for build in build_history.values():
+            datafile = self.generate_build_history_filename(build['branch'],
+                                                            build['build_unix_time'],
+                                                            build['revision'])
+            index['builds'][os.path.basename(datafile)] = build
+        self._filer.upload_from_stream(self.generate_build_index_filename(branch_name),
+                                       json.dumps(index), {'Cache-Control' : 'max-age=600'})
+
+
+    def get_remote_revision(self):
+        """Helper function to find the remote HEAD of the current branch
+
+        Uses git ls-remote, which only transfers the ref listing.
+        Returns the full hash of the head of the branch on the remote
+        repository, or None if it could not be determined (in which
+        case the caller should do things the hard way).
+
+        """
+        remote_repository = self._current_build['remote_repository']
+        branch = self._current_build['branch']
+        try:
+            output = Git().ls_remote(remote_repository, 'refs/heads/' + branch)
+        except exc.GitCommandError as e:
+            self._logger.warn("Could not list remote refs of %s: %s" %
+                              (remote_repository, str(e)))
+            return None
+        for line in output.splitlines():
+            revision, ref = line.split(None, 1)
+            if ref == 'refs/heads/' + branch:
+                return revision
+        return None
+
+
     def prepare_source_tree(self):
         """Build a local source tree for the current branch
 
         Builds the current tree, including building all parent
         directories, checks out the source for the current branch, and
         sets _current_build['revision'] to the revision of the HEAD
-        for the current branch.
+        for the current branch.  If the mirror cache is enabled, the
+        clone (and submodule checkouts) borrow objects from a local
+        mirror and then dissociate from it, so that only new objects
+        come over the network.
+
+        See get_clone_mode() for shallow and partial clones.
 
         """
         branch_name = self._current_build['branch_name']
         remote_repository = self._current_build['remote_repository']
         source_tree = self._current_build['source_tree']
         branch = self._current_build['branch']
+        clone_mode = self.get_clone_mode()
+        clone_args = {}
+        if clone_mode == 'shallow':
+            clone_args = { 'depth' : 1, 'single_branch' : True, 'branch' : branch }
+        elif clone_mode == 'blobless':
+            clone_args = { 'filter' : 'blob:none' }
 
         # assume that the build tree doesn't exist.  Makedirs will
         # throw an exception if it does.
@@ -370,7 +1219,16 @@ class Builder(object):
 
         # get an up-to-date git repository
         self._logger.debug("Cloning from " + remote_repository)
-        repo = Repo.clone_from(remote_repository, source_tree)
+        with self.timed('mirror_update'):
+            mirror = self.get_mirror(remote_repository)
+        with self.timed('clone'):
+            if mirror != None:
+                with self._mirror_cache.lock(remote_repository, shared=True):
+                    repo = Repo.clone_from(remote_repository, source_tree,
+                                           reference=mirror, dissociate=True,
+                                           **clone_args)
+            else:
+                repo = Repo.clone_from(remote_repository, source_tree, **clone_args)
 
         # switch to the right branch and reset the HEAD to be
         # origin/<branch>/HEAD
@@ -380,13 +1238,100 @@ class Builder(object):
         repo.head.reference = repo.refs[branch]
 
         # And pull in all the right submodules
-        repo.git.submodule('update', '--init', '--recursive')
+        with self.timed('submodules'):
+            self.update_submodules(repo)
 
         # wish I could figure out how to do this without resorting to
         # shelling out to git :/
         self._current_build['revision'] = repo.git.rev_parse(repo.head.object.hexsha, short=7)
 
 
+    def get_clone_mode(self):
+        """Helper function to find how to clone the current branch
+
+        A nightly tarball only needs the tree at the branch HEAD, so
+        the full history (of the repository and every submodule) is
+        usually wasted work.  config['clone_mode'] can be set per
+        project, and overridden per branch (for branches whose
+        autogen looks at git history), to one of:
+
+          full     : clone everything (default)
+          shallow  : only the branch HEAD (--depth 1 --single-branch),
+                     with submodules cloned at depth 1
+          blobless : full history, but file contents are only fetched
+                     for the checked out tree (--filter=blob:none),
+                     for repository and submodules
+
+        """
+        branch_config = self._config['branches'][self._current_build['branch_name']]
+        clone_mode = branch_config.get('clone_mode', self._config['clone_mode'])
+        if not clone_mode in Builder.clone_modes:
+            raise ValueError("Unknown clone_mode %s (expected one of %s)" %
+                             (clone_mode, str(Builder.clone_modes)))
+        return clone_mode
+
+
+    def get_submodule_update_args(self):
+        """Helper function for the submodule update options matching get_clone_mode()"""
+        clone_mode = self.get_clone_mode()
+        if clone_mode == 'shallow':
+            return ['--depth', '1']
+        elif clone_mode == 'blobless':
+            return ['--filter=blob:none']
+        return []
+
+
+    def get_mirror(self, url):
+        """Helper function to find a local mirror of url
+
+        Returns the path to an up-to-date mirror of url from the mirror
+        cache, or None if the mirror cache is disabled or the mirror
+        could not be updated (in which case we just clone from the
+        remote, like in the good old days).
+
+        """
+        if self._mirror_cache == None:
+            return None
+        try:
+            return self._mirror_cache.update(url)
+        except Exception as e:
+            self._logger.warn("Could not update mirror of %s: %s" % (url, str(e)))
+            return None
+
+
+    def update_submodules(self, repo):
+        """Initialize and check out all submodules of repo, recursively
+
+        With the mirror cache enabled, each submodule is checked out
+        using a mirror of its own repository as a reference.
+
+        """
+        mode_args = self.get_submodule_update_args()
+        if self._mirror_cache == None:
+            repo.git.submodule('update', '--init', '--recursive', *mode_args)
+            return
+
+        if not os.path.exists(os.path.join(repo.working_tree_dir, '.gitmodules')):
+            return
+        # init resolves relative submodule URLs into .git/config, so
+        # read the URLs from there rather than from .gitmodules.
+        repo.git.submodule('init')
+        paths = repo.git.config('--file', '.gitmodules', '--get-regexp',
+                                r'^submodule\..*\.path$')
+        for line in paths.splitlines():
+            key, path = line.split(None, 1)
+            name = key[len('submodule.'):-len('.path')]
+            url = repo.git.config('--get', 'submodule.%s.url' % (name))
+            mirror = self.get_mirror(url)
+            if mirror != None:
+                with self._mirror_cache.lock(url, shared=True):
+                    repo.git.submodule('update', '--init', '--reference', mirror,
+                                       '--dissociate', *mode_args, '--', path)
+            else:
+                repo.git.submodule('update', '--init', *mode_args, '--', path)
+            self.update_submodules(Repo(os.path.join(repo.working_tree_dir, path)))
+
+
     def update_version_file(self):
         """Hook to update version file if needed before the actual build step.
 
@@ -419,13 +1364,199 @@ class Builder(object):
                 self.call(self._config['tarball_builder'], build_call=True)
             else:
                 self.call(["autoreconf", "-if"], build_call=True)
-                self.call(["./configure"], build_call=True)
-                self.call(["make", "distcheck"], build_call=True)
+                self.run_configure(["./configure"], build_call=True)
+                self.run_distcheck(["make", "distcheck"], build_call=True)
         finally:
             os.chdir(cwd)
 
 
-    def call(self, args, log_name=None, build_call=False, env=None):
+    def get_tool_versions(self, programs, env=None):
+        """Helper function to get the --version output of build tools
+
+        Runs every program in programs with --version (through call(),
+        so in the same environment as the build) and returns a list
+        of the outputs.  Programs that fail are reported as
+        unavailable rather than failing the build.
+
+        """
+        versions = []
+        for program in programs:
+            log_name = 'tool-%s-version' % (os.path.basename(program))
+            try:
+                self.call([program, '--version'], log_name=log_name,
+                          build_call=True, env=env)
+                with open(os.path.join(self._current_build['build_root'],
+                                       log_name + '-output.txt'), 'r') as f:
+                    versions.append('%s: %s' % (program, f.read()))
+            except Exception as e:
+                versions.append('%s: unavailable' % (program))
+        return versions
+
+
+    def get_configure_cache_file(self, stage, env=None):
+        """Helper function to find the autoconf cache file for a configure run
+
+        If config['configure_cache'] is set (a dictionary, which may
+        contain 'path'), returns the name of a persistent autoconf
+        cache file for stage (the top-level configure, the configure
+        run by distcheck, Coverity's configure, ...) of the current
+        branch; otherwise, returns None.  Cache files live in a
+        directory named after a hash of the compiler and autoconf
+        versions, and cache directories for any other toolchain are
+        removed, so a toolchain upgrade starts over with an empty
+        cache.
+
+        """
+        cache_config = self._config['configure_cache']
+        if cache_config == None:
+            return None
+
+        if not 'configure_cache_toolchain' in self._current_build:
+            if env == None:
+                env = os.environ
+            versions = self.get_tool_versions([env.get('CC', 'cc'), 'autoconf'], env)
+            self._current_build['configure_cache_toolchain'] = \
+                hashlib.sha256('\n'.join(versions).encode('utf-8')).hexdigest()[:16]
+        toolchain = self._current_build['configure_cache_toolchain']
+
+        branch_path = os.path.join(cache_config.get('path',
+                                                    os.path.join(self._config['scratch_path'],
+                                                                 'configure-cache')),
+                                   self._config['project_short_name'],
+                                   self._current_build['branch_name'])
+        toolchain_path = os.path.join(branch_path, toolchain)
+        if not os.path.isdir(toolchain_path):
+            if os.path.isdir(branch_path):
+                for name in os.listdir(branch_path):
+                    self._logger.info("Toolchain changed, dropping configure cache %s" % (name))
+                    BuilderUtils.remove_tree(os.path.join(branch_path, name))
+            os.makedirs(toolchain_path)
+        return os.path.join(toolchain_path, '%s.cache' % (stage))
+
+
+    def run_configure(self, args, build_call=False, env=None):
+        """Run configure, with the configure cache if enabled
+
+        Runs args (./configure and its arguments) through call(),
+        adding --cache-file if config['configure_cache'] is set.  A
+        stale cache can make configure fail (for example, if a
+        precious variable changed), so if configure fails with an
+        error after loading a cache file from an earlier run, the
+        cache file is removed and configure is run once more without
+        it.
+
+        """
+        cache_file = self.get_configure_cache_file('configure', env)
+        if cache_file == None:
+            self.call(args, build_call=build_call, env=env)
+            return
+
+        log_name = os.path.basename(args[0])
+        had_cache = os.path.exists(cache_file)
+        try:
+            self.call(args + ['--cache-file=%s' % (cache_file)], log_name=log_name,
+                      build_call=build_call, env=env)
+        except subprocess.CalledProcessError:
+            if not had_cache or not self.configure_cache_failed(log_name):
+                raise
+            self._logger.warn("configure failed with cache file %s; retrying without it" %
+                              (cache_file))
+            os.remove(cache_file)
+            self.call(args + ['--cache-file=%s' % (cache_file)], log_name=log_name,
+                      build_call=build_call, env=env)
+        self.record_configure_cache_stats('configure', log_name)
+
+
+    def get_distcheck_configure_flags(self, env=None):
+        """DISTCHECK_CONFIGURE_FLAGS as defined by the project
+
+        Asks make for the value from the Makefile in the current
+        directory, so that run_distcheck() can add to it rather than
+        replace it.  Returns '' if the project does not set it (or it
+        can not be determined).
+
+        """
+        makefile = ('nightly-print-distcheck-flags:\n'
+                    '\t$(info $(DISTCHECK_CONFIGURE_FLAGS))@:\n')
+        try:
+            output = subprocess.run(['make', '-s', '--no-print-directory', '-f', 'Makefile',
+                                     '-f', '-', 'nightly-print-distcheck-flags'],
+                                    input=makefile, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, env=env,
+                                    universal_newlines=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            self._logger.warn("Could not get DISTCHECK_CONFIGURE_FLAGS: %s" % (str(e)))
+            return ''
+        return output.strip()
+
+
+    def run_distcheck(self, args, build_call=False, env=None):
+        """Run make distcheck, with the configure cache if enabled
+
+        Runs args (make distcheck and any arguments) through call().
+        If config['configure_cache'] is set, --cache-file is added to
+        the project's own DISTCHECK_CONFIGURE_FLAGS (which would
+        otherwise be overridden by setting the variable on the make
+        command line).  Like run_configure(), if distcheck's configure
+        fails with an error after loading a cache file from an earlier
+        run, the cache file is removed and distcheck is run once more
+        without it, so a poisoned cache can not break every later
+        build.  Failures past configure (compile errors, failing
+        tests) are not retried, as distcheck can take hours.
+
+        """
+        cache_file = self.get_configure_cache_file('distcheck', env)
+        if cache_file == None:
+            self.call(args, build_call=build_call, env=env)
+            return
+
+        flags = self.get_distcheck_configure_flags(env)
+        flags = ('%s --cache-file=%s' % (flags, cache_file)).strip()
+        # make expands variables in command line assignments
+        cache_args = ['DISTCHECK_CONFIGURE_FLAGS=%s' % (flags.replace('$', '$$'))]
+        log_name = os.path.basename(args[0])
+        had_cache = os.path.exists(cache_file)
+        try:
+            self.call(args + cache_args, log_name=log_name,
+                      build_call=build_call, env=env)
+        except subprocess.CalledProcessError:
+            if not had_cache or not self.configure_cache_failed(log_name):
+                raise
+            self._logger.warn("distcheck failed with cache file %s; retrying without it" %
+                              (cache_file))
+            os.remove(cache_file)
+            self.call(args + cache_args, log_name=log_name,
+                      build_call=build_call, env=env)
+        self.record_configure_cache_stats('distcheck', log_name)
+
+
+    def configure_cache_failed(self, log_name):
+        """Did a configure run by call() log_name fail after loading its cache?"""
+        log_file = os.path.join(self._current_build['build_root'], log_name + '-output.txt')
+        try:
+            return BuilderUtils.configure_cache_failed(log_file)
+        except IOError:
+            return False
+
+
+    def record_configure_cache_stats(self, stage, log_name):
+        """Count the configure probes answered from the cache
+
+        Counts the 'checking ...' lines, and those answered with
+        '(cached)', in the output of call() log_name, and records them
+        under _current_build['configure_cache'][stage].
+
+        """
+        if self._config['configure_cache'] == None:
+            return
+        log_file = os.path.join(self._current_build['build_root'], log_name + '-output.txt')
+        stats = BuilderUtils.count_configure_probes(log_file)
+        self._current_build.setdefault('configure_cache', {})[stage] = stats
+        self._logger.info("configure cache (%s): %d of %d probes cached" %
+                          (stage, stats['cached'], stats['probes']))
+
+
+    def call(self, args, log_name=None, build_call=False, env=None, wrapper_args=None):
         """Modify shell executable string before calling
 
         Some projects (like Open MPI) use shell modules to configure
@@ -435,15 +1566,32 @@ class Builder(object):
         hook which can be used to add the shell wrapper function into
         the call arguments, resulting in the build system having the
         right environment at execution time.  The default is to call
-        args directly.
+        args directly.  A wrapper should be passed as wrapper_args
+        rather than prepended to args, so that logged_call() can tell
+        what program is really run (and hand make the jobserver).  The
+        wall time and resource usage of the command are recorded in
+        the current build under 'call <log name>'.
 
         """
         if log_name == None:
             log_file = args[0]
         else:
             log_file = log_name
+        phase = 'call ' + os.path.basename(log_file)
         log_file=os.path.join(self._current_build['build_root'], log_file + "-output.txt")
-        BuilderUtils.logged_call(args, log_file=log_file, env=env)
+        usage = None
+        with self.timed(phase):
+            try:
+                usage = BuilderUtils.logged_call(args, wrapper_args=wrapper_args,
+                                                 log_file=log_file, env=env)
+            except subprocess.CalledProcessError as e:
+                usage = getattr(e, 'resource_usage', None)
+                raise
+            finally:
+                if usage != None:
+                    resource_usage = self._current_build['resource_usage']
+                    BuilderUtils.merge_resource_usage(resource_usage.setdefault(phase, {}),
+                                                      usage)
 
 
     def find_build_artifacts(self):
@@ -453,8 +1601,10 @@ class Builder(object):
         build artifacts from the build step.  The
         Builder.find_build_artifacts() implementation will search for
         any .tar.gz and .tar.bz2 files in the top level of the build
-        tree.  Overload if the project builder can be more
-        specific.
+        tree (recompress_artifacts() adds any extra_artifact_formats
+        versions later).  Overload if the project builder can be more
+        specific.  Hashes of the artifacts are filled in by
+        publish_build_artifacts(), as they are uploaded.
 
         """
         self._current_build['artifacts'] = {}
@@ -463,14 +1613,110 @@ class Builder(object):
             if file.endswith(".tar.gz") or file.endswith(".tar.bz2"):
                 filename = os.path.join(source_tree, file)
                 info = os.stat(filename)
-                hashes = compute_hashes(filename)
                 self._current_build['artifacts'][file] = {}
-                self._current_build['artifacts'][file]['sha1'] = hashes['sha1']
-                self._current_build['artifacts'][file]['sha256'] = hashes['sha256']
-                self._current_build['artifacts'][file]['md5'] = hashes['md5']
                 self._current_build['artifacts'][file]['size'] = info.st_size
-                self._logger.debug("Found artifact %s, size: %d, md5: %s, sha1: %s sha256: %s"
-                                   % (file, info.st_size, hashes['md5'], hashes['sha1'], hashes['sha256']))
+                self._logger.debug("Found artifact %s, size: %d" % (file, info.st_size))
+
+
+    def get_source_artifact(self):
+        """Name of the artifact from the build step to derive others from
+
+        Returns the first artifact (in artifact_sources order, so
+        .tar.gz before .tar.bz2) that the build step produced, or None
+        if there is none.
+
+        """
+        for suffix, command in self.artifact_sources:
+            for artifact in sorted(self._current_build['artifacts'].keys()):
+                if artifact.endswith(suffix):
+                    return artifact
+        return None
+
+
+    def recompress_artifacts(self):
+        """Create the extra_artifact_formats versions of the tarball
+
+        make dist compresses with single-threaded gzip / bzip2, and
+        the build step is the wrong place to add formats.  Instead,
+        the source artifact (see get_source_artifact()) is
+        decompressed once and the stream is fed to one compressor per
+        format in config['extra_artifact_formats'], each pinned to its
+        own share of the CPUs and using a thread per CPU.  The new
+        tarballs are added to ._current_build['artifacts'] (so they are
+        published and hashed like the others) and the size,
+        compression ratio, and time of each format are recorded in
+        ._current_build['recompression'].  A failure is logged but does
+        not fail the build; the formats from the build step are still
+        published.
+
+        """
+        source = self.get_source_artifact()
+        if source == None:
+            self._logger.warn("No tarball to recompress")
+            return
+        for suffix, decompress_command in self.artifact_sources:
+            if source.endswith(suffix):
+                basename = source[:-len(suffix)]
+                break
+
+        formats = []
+        for name in self._config['extra_artifact_formats']:
+            if not name in self.artifact_formats:
+                raise ValueError('Unknown artifact format %s' % (name))
+            command, suffix = self.artifact_formats[name]
+            if basename + suffix in self._current_build['artifacts']:
+                continue
+            if shutil.which(command[0]) == None:
+                self._logger.warn("%s not found; not creating %s tarball" % (command[0], name))
+                continue
+            formats.append(name)
+        if len(formats) == 0:
+            return
+
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count()))
+        share = max(1, len(cpus) // len(formats))
+        source_tree = self._current_build['source_tree']
+        outputs = {}
+        for i, name in enumerate(formats):
+            command, suffix = self.artifact_formats[name]
+            format_cpus = cpus[i * share:(i + 1) * share]
+            if len(format_cpus) == 0:
+                format_cpus = cpus
+            outputs[name] = { 'command' : command + ['-T%d' % (len(format_cpus))],
+                              'filename' : os.path.join(source_tree, basename + suffix),
+                              'cpus' : set(format_cpus) }
+
+        try:
+            results = BuilderUtils.fan_out_compress(decompress_command +
+                                                    [os.path.join(source_tree, source)],
+                                                    outputs)
+        except Exception as e:
+            self._logger.error("Recompressing %s failed: %s" % (source, str(e)))
+            for output in outputs.values():
+                if os.path.exists(output['filename']):
+                    os.remove(output['filename'])
+            return
+
+        self._current_build['recompression'] = {}
+        for name, result in results.items():
+            artifact = os.path.basename(outputs[name]['filename'])
+            size = result['output_bytes']
+            self._current_build['artifacts'][artifact] = { 'size' : size }
+            usage = result['resource_usage']
+            self._current_build['recompression'][name] = {
+                'artifact' : artifact,
+                'size' : size,
+                'ratio' : round(result['input_bytes'] / float(max(size, 1)), 2),
+                'source_ratio' : round(size / float(max(os.stat(os.path.join(source_tree, source)).st_size, 1)), 3),
+                'wall_seconds' : usage['wall_seconds'],
+                'cpu_seconds' : round(usage['user_seconds'] + usage['system_seconds'], 3) }
+            self._logger.info("Created %s: %d bytes, ratio %.2f (%.1f%% of %s), %.1f seconds" %
+                              (artifact, size, self._current_build['recompression'][name]['ratio'],
+                               100 * self._current_build['recompression'][name]['source_ratio'],
+                               source, usage['wall_seconds']))
 
 
     def publish_build_artifacts(self):
@@ -478,11 +1724,14 @@ class Builder(object):
 
         Publish any build artifacts found by find_build_artifacts and
         create / publish the build history blob for the artifacts.
+        Artifact hashes are computed while uploading, so each artifact
+        is only read once.
         This function also creates the "latest_snapshot.txt" file,
         on the assumption that the current build is, in fact, the latest.
 
         """
         branch_name = self._current_build['branch_name']
+        publish_start = time.time()
 
         build_data = {}
         build_data['branch'] = self._current_build['branch']
@@ -490,6 +1739,12 @@ class Builder(object):
         build_data['revision'] = self._current_build['revision']
         build_data['build_unix_time'] = self._current_build['build_unix_time']
         build_data['delete_on'] = 0
+        build_data['source_tree_seconds'] = self._current_build['source_tree_seconds']
+        build_data['build_root_bytes'] = self._current_build['build_root_bytes']
+        build_data['scratch_tier'] = self._current_build['scratch_tier']
+        if 'recompression' in self._current_build:
+            build_data['recompression'] = self._current_build['recompression']
+        build_data['resource_usage'] = self._current_build['resource_usage']
         build_data['files'] = {}
 
         for build in self._current_build['artifacts']:
@@ -499,14 +1754,37 @@ class Builder(object):
                                            build)
             self._logger.debug("Publishing file %s (local: %s, remote: %s)" %
                                (build, local_filename, remote_filename))
-            self._filer.upload_from_file(local_filename, remote_filename)
-            build_data['files'][build] = self._current_build['artifacts'][build]
+            with self.timed('upload_artifacts'):
+                hashes = self._filer.upload_from_file_with_hashes(local_filename, remote_filename)
+            artifact = self._current_build['artifacts'][build]
+            artifact['sha1'] = hashes['sha1']
+            artifact['sha256'] = hashes['sha256']
+            artifact['md5'] = hashes['md5']
+            self._logger.debug("Published artifact %s, md5: %s, sha1: %s sha256: %s"
+                               % (build, hashes['md5'], hashes['sha1'], hashes['sha256']))
+            build_data['files'][build] = artifact
+
+        # Fill in the timings only now, so they include the artifact
+        # uploads.  This phase is still running, so record the time
+        # spent in it so far; cleanup and remote_cleanup happen after
+        # the build data is published, so their timings are only in
+        # the email.
+        timings = dict(self._current_build['timings'])
+        timings['publish_build_artifacts'] = round(timings.get('publish_build_artifacts', 0)
+                                                   + time.time() - publish_start, 3)
+        build_data['timings'] = timings
 
         datafile = self.generate_build_history_filename(self._current_build['branch_name'],
                                                         self._current_build['build_unix_time'],
                                                         self._current_build['revision'])
         self._filer.upload_from_stream(datafile, json.dumps(build_data), {'Cache-Control' : 'max-age=600'})
 
+        # add the new build to the history (which remote_cleanup()
+        # will also work from) and the build index
+        build_history = self._current_build['build_history']
+        build_history[build_data['build_unix_time']] = build_data
+        self.publish_build_index(build_history)
+
         latest_filename = os.path.join(self._config['branches'][branch_name]['output_location'],
                                        'latest_snapshot.txt')
         version_string = self._current_build['version_string'] + '\n'
@@ -558,13 +1836,13 @@ class Builder(object):
         Builds fail.  It happens to the best of us.  This function is
         called when something in the build failed (any step, from code
         checkout to finding build artifacts).  This function will
-        create a tarball of the build directory and publish it so that
-        future generations may see what went wrong and learn from our
-        mistakes.  After making a tarball of the directory, it uploads
-        the tarball to the remote storage and sets
-        ._current_build['failed tarball'] to the name (relative to
-        ._config['failed_build_prefix'] where the tarball was
-        uploaded.
+        stream a compressed tarball of the build directory to the
+        remote storage, so that future generations may see what went
+        wrong and learn from our mistakes.  Object files and the like
+        are left out; see FailedBuildArchiver and the
+        failed_build_compressor, failed_build_exclude, and
+        failed_build_include config options.  Statistics about the
+        archive are stored in ._current_build['failed_archive'].
 
         """
         if not 'failed_build_prefix' in self._config:
@@ -573,54 +1851,60 @@ class Builder(object):
 
         branch_name = self._current_build['branch_name']
         self._logger.debug("publishing failed build for %s" % (branch_name))
-        failed_tarball_name = "%s-%s-%s-failed.tar.gz" % (self._config['project_short_name'],
-                                                          branch_name,
-                                                          self._current_build['build_time'])
-        failed_tarball_path = os.path.join(self._config['project_path'],
-                                           failed_tarball_name)
-        cwd = os.getcwd()
-        os.chdir(self._current_build['build_root'])
-        try:
-            self.call(["tar", "czf", failed_tarball_path, "."],
-                      log_name="failed-tarball-tar")
-        finally:
-            os.chdir(cwd)
+        archiver = FailedBuildArchiver.FailedBuildArchiver(self._current_build['build_root'],
+                                                           compressor=self._config['failed_build_compressor'],
+                                                           exclude=self._config['failed_build_exclude'],
+                                                           include=self._config['failed_build_include'])
+        failed_tarball_name = "%s-%s-%s-failed%s" % (self._config['project_short_name'],
+                                                     branch_name,
+                                                     self._current_build['build_time'],
+                                                     archiver.get_suffix())
         remote_filename = os.path.join(self._config['failed_build_prefix'],
                                        failed_tarball_name)
 
-        self._filer.upload_from_file(failed_tarball_path, remote_filename)
-        os.remove(failed_tarball_path)
+        self._current_build['failed_archive'] = archiver.upload(self._filer, remote_filename)
+        self._logger.info("Archived failed build (%d bytes, %d bytes of build products skipped) in %.1f seconds" %
+                          (self._current_build['failed_archive']['compressed_bytes'],
+                           self._current_build['failed_archive']['skipped_bytes'],
+                           self._current_build['failed_archive']['seconds']))
 
         self._logger.warn('Build artifacts available at: %s' %
                           (self._config['failed_build_url'] + remote_filename))
 
 
+    def remove_tree(self, dirpath):
+        """Remove a scratch directory tree
+
+        With config['background_cleanup'], the tree is renamed into
+        config['trash_path'] and removed by a detached process, so the
+        next build can start right away.  Otherwise, it is removed in
+        the foreground by config['cleanup_workers'] threads.
+
+        """
+        if self._config['background_cleanup']:
+            BuilderUtils.remove_tree_in_background(dirpath,
+                                                   self._config['trash_path'],
+                                                   self._config['cleanup_workers'])
+        else:
+            BuilderUtils.remove_tree(dirpath, self._config['cleanup_workers'])
+
+
     def cleanup(self):
         """Clean up after ourselves
 
         If your builder subclass does anything crazy in the previous
         steps, override here.  Otherwise, deleting everything in the
-        build directory should be sufficient.
+        build root should be sufficient.  Only the current build's
+        root is removed, as other branches may be building in the
+        project directory at the same time; run() removes the project
+        directory once all builds are done.
 
         """
-        dirpath = self._config['project_path']
+        dirpath = self._current_build['build_root']
+        if not os.path.exists(dirpath):
+            return
         self._logger.debug("Deleting directory: %s" % (dirpath))
-        # deal with "make distcheck"'s stupid permissions.  Exception
-        # handling is inside the loop so that we do not skip some
-        # files on an error.  os.chmod will throw an error if it
-        # tries to follow a dangling symlink.
-        for root, dirs, files in os.walk(dirpath):
-            for momo in dirs:
-                try:
-                    os.chmod(os.path.join(root, momo), 0o700)
-                except:
-                    pass
-            for momo in files:
-                try:
-                    os.chmod(os.path.join(root, momo), 0o700)
-                except:
-                    pass
-        shutil.rmtree(dirpath)
+        self.remove_tree(dirpath)
 
 
     def remote_cleanup(self, build_history):
@@ -641,6 +1925,7 @@ class Builder(object):
             max_count = self._config['branches'][branch_name]['max_count']
         else:
             max_count = 10
+        expired_builds = False
         builds = sorted(build_history.keys())
         if len(builds) > max_count:
             builds = builds[0:len(builds) - max_count]
@@ -650,6 +1935,7 @@ class Builder(object):
                 build_history[key]['valid'] = False
                 # expire in one day
                 build_history[key]['delete_on'] = now + (24 * 60 * 60)
+                expired_builds = True
                 self._logger.debug("Expiring build %s" % (key))
                 filename = self.generate_build_history_filename(build_history[key]['branch'],
                                                                 build_history[key]['build_unix_time'],
@@ -657,6 +1943,7 @@ class Builder(object):
                 self._filer.upload_from_stream(filename,
                                                json.dumps(build_history[key]), {'Cache-Control' : 'max-age=600'})
 
+        removed_builds = []
         for build in build_history.keys():
             delete_on = build_history[build]['delete_on']
             if delete_on != 0 and delete_on < int(time.time()):
@@ -671,6 +1958,12 @@ class Builder(object):
                                                                 build_history[build]['revision'])
                 self._logger.debug("Removing data file %s" % (datafile))
                 self._filer.delete(datafile)
+                removed_builds.append(build)
+
+        for build in removed_builds:
+            del build_history[build]
+        if len(removed_builds) > 0 or expired_builds:
+            self.publish_build_index(build_history)
 
         # as a (maybe temporary?) hack, generate md5sum.txt and
         # sha1sum.txt files for all valid builds.  Do this in
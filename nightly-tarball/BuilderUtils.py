@@ -9,20 +9,274 @@
 import subprocess
 import logging
 import os
-import fileinput
+import collections
+import threading
+import fcntl
+import contextlib
+import shutil
+import tempfile
+import time
+import unittest
+import re
+import concurrent.futures
+
+
+_max_line_len = 64 * 1024
+
+# commands that get the jobserver pipe; anything else only takes a
+# job slot
+_jobserver_commands = ['make', 'gmake', 'cov-build']
+
+
+def _pump_output(pipe, output, tail, logger, errors):
+    # copy child output to the log file line by line, remembering only
+    # the last few lines, so memory use does not depend on how chatty
+    # the child is.  Long lines are split rather than buffered.  If
+    # writing the log fails (say, a full disk), keep draining the pipe
+    # so the child does not block forever, and leave the exception in
+    # errors for the caller to raise once the child is reaped.
+    for line in iter(lambda: pipe.readline(_max_line_len), b''):
+        if len(errors) == 0:
+            try:
+                output.write(line)
+            except Exception as e:
+                errors.append(e)
+        text = line.decode('utf-8', 'replace').rstrip('\n')
+        tail.append(text)
+        if logger != None:
+            logger.debug(text)
+    pipe.close()
+
+
+class JobServer(object):
+    """GNU make jobserver shared by everything run with logged_call()
+
+    A pipe holding one token per job slot.  Once registered with
+    set_jobserver(), every logged_call() takes a token for the
+    command it runs (so that a configure, a tar, or the first job of
+    a make counts against the budget as well).  Make and cov-build
+    are also passed the pipe, advertised in MAKEFLAGS, so that make
+    (including make distcheck's inner makes and cov-build's make)
+    takes tokens from the pipe for every additional job.  Forked
+    children (parallel builds, Coverity jobs) inherit the pipe, so
+    every build in the process tree shares one CPU budget.
+
+    A make that is killed never returns the tokens it took, so a
+    long-running process should start over with a new JobServer
+    from time to time (see Scheduler.build_project()).
+
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._read_fd, self._write_fd = os.pipe()
+        os.write(self._write_fd, b'+' * slots)
+
+
+    def fds(self):
+        """File descriptors children need to inherit"""
+        return (self._read_fd, self._write_fd)
+
+
+    def close(self):
+        """Close the pipe (children keep their own copies)"""
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+    def makeflags(self):
+        """MAKEFLAGS entries to point make at the jobserver
+
+        --jobserver-fds is for make before 4.2, --jobserver-auth for
+        everyone else.
+
+        """
+        return ('-j --jobserver-fds=%d,%d --jobserver-auth=%d,%d' %
+                (self._read_fd, self._write_fd, self._read_fd, self._write_fd))
+
+
+    def update_env(self, env):
+        """Return a copy of env (default: os.environ) with the jobserver in MAKEFLAGS"""
+        if env == None:
+            env = os.environ
+        env = dict(env)
+        if env.get('MAKEFLAGS', '') != '':
+            env['MAKEFLAGS'] = env['MAKEFLAGS'] + ' ' + self.makeflags()
+        else:
+            env['MAKEFLAGS'] = self.makeflags()
+        return env
+
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one job slot for the life of the context"""
+        token = os.read(self._read_fd, 1)
+        try:
+            yield
+        finally:
+            os.write(self._write_fd, token)
+
+
+_jobserver = None
+
+
+def set_jobserver(jobserver):
+    """Register the JobServer used by every logged_call() (None to disable)"""
+    global _jobserver
+    _jobserver = jobserver
+
+
+def get_jobserver():
+    """The JobServer registered with set_jobserver(), or None"""
+    return _jobserver
+
+
+def strip_make_jobs(args):
+    """Remove -j / --jobs options from a list of make arguments
+
+    An explicit job count makes make ignore the jobserver it inherited
+    and start its own, so drop them when a JobServer is in charge.
+
+    """
+    result = []
+    skip_count = False
+    for arg in args:
+        if skip_count:
+            skip_count = False
+            if re.match(r'^[0-9]+$', arg):
+                continue
+        if arg == '-j' or arg == '--jobs':
+            skip_count = True
+            continue
+        if re.match(r'^(-j[0-9]+|--jobs=[0-9]*)$', arg):
+            continue
+        result.append(arg)
+    return result
+
+
+def get_available_memory():
+    """Memory available for new allocations (MemAvailable), in bytes
+
+    Returns None if /proc/meminfo is not available.
+
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+class PeakUsageMonitor(object):
+    """Track the peak space used on the file system holding a path
+
+    Samples statvfs() of path every interval seconds from a thread
+    between start() and stop(), which returns the peak number of
+    bytes in use above what was in use at start().  Walking a build
+    tree to size it is expensive and misses short-lived peaks (like
+    the _build and _inst trees of make distcheck); this is cheap, but
+    includes anything else writing to the same file system at the
+    time, so it errs on the large side.
+
+    """
+
+    def __init__(self, path, interval=2):
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._baseline = 0
+        self.peak = 0
+
+
+    def _used(self):
+        info = os.statvfs(self._path)
+        return (info.f_blocks - info.f_bfree) * info.f_frsize
+
+
+    def _sample(self):
+        while True:
+            try:
+                self.peak = max(self.peak, self._used() - self._baseline)
+            except OSError:
+                pass
+            if self._stop.wait(self._interval):
+                break
+
+
+    def start(self):
+        self._baseline = self._used()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """Stop sampling and return the peak usage in bytes"""
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+def _resource_usage(rusage, wall_seconds):
+    return { 'wall_seconds' : round(wall_seconds, 3),
+             'user_seconds' : round(rusage.ru_utime, 3),
+             'system_seconds' : round(rusage.ru_stime, 3),
+             'max_rss_kb' : rusage.ru_maxrss,
+             'block_input' : rusage.ru_inblock,
+             'block_output' : rusage.ru_oublock,
+             'voluntary_switches' : rusage.ru_nvcsw,
+             'involuntary_switches' : rusage.ru_nivcsw }
+
+
+def merge_resource_usage(total, usage):
+    """Add the logged_call() resource usage usage into total
+
+    Times, block operations, and context switches are summed; peak
+    RSS is the largest seen.  Returns total.
+
+    """
+    for key, value in usage.items():
+        if key == 'max_rss_kb':
+            total[key] = max(total.get(key, 0), value)
+        elif isinstance(value, float):
+            total[key] = round(total.get(key, 0) + value, 3)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
 
 
 def logged_call(args,
                 wrapper_args=None,
                 log_file=None,
                 err_log_len=30,
-                env=None):
+                env=None,
+                forward_output=None):
     """Wrapper around check_call to log output
 
-    Wrap around check_call to capture stdout and stderr and save them
-    in log_file (or command-output.txt) with the given environment.
-    The amount of data saved from the capture and emitted to the log
-    stream is dependent on the status of the logging system.
+    Run args, capturing stdout and stderr and saving them in log_file
+    (or command-output.txt) with the given environment.  Output is
+    streamed to the file by a pump thread, which also keeps the last
+    err_log_len lines to emit to the log stream if the command fails.
+    If forward_output is True (default: if the logger is at DEBUG
+    level), every line is also passed to the log stream as it is
+    produced.
+
+    Returns a dictionary describing the resources used by the command
+    (and any of its descendants it waited for): wall, user, and
+    system time, peak RSS, block I/O operations, and context
+    switches.  Raises subprocess.CalledProcessError if the command
+    fails, with the same dictionary in its resource_usage attribute.
+    If writing the log file fails, the command still runs to
+    completion and the error is raised once it has exited.
+
+    If a JobServer is registered (see set_jobserver()), the command
+    waits for a job slot, and make-like commands can use the
+    jobserver for more.  Whether a command is make-like is decided by
+    args[0], not by any wrapper_args (like run-with-autotools.sh)
+    run in front of it.
 
     """
     logger = logging.getLogger('Builder.BuildUtils')
@@ -41,32 +295,596 @@ def logged_call(args,
         stdout_file = log_file
     else:
         stdout_file = '%s-output.txt' % (base_command)
-    stdout = open(stdout_file, 'w')
 
-    if env != None and 'CALL_DEBUG' in env:
-        return
+    if forward_output == None:
+        forward_output = logger.getEffectiveLevel() == logging.DEBUG
 
-    try:
-        subprocess.check_call(call_args, stdout=stdout, stderr=subprocess.STDOUT, env=env)
-    except:
-        stdout.close()
+    with open(stdout_file, 'wb') as stdout:
+        if env != None and 'CALL_DEBUG' in env:
+            return
+
+        jobserver = _jobserver
+        pass_fds = ()
+        slot = contextlib.nullcontext()
+        if jobserver != None:
+            if base_command in _jobserver_commands:
+                env = jobserver.update_env(env)
+                pass_fds = jobserver.fds()
+            slot = jobserver.slot()
+
+        tail = collections.deque(maxlen=err_log_len)
+        pump_errors = []
+        with slot:
+            start = time.time()
+            proc = subprocess.Popen(call_args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, env=env,
+                                    pass_fds=pass_fds)
+            pump = threading.Thread(target=_pump_output,
+                                    args=(proc.stdout, stdout, tail,
+                                          logger if forward_output else None,
+                                          pump_errors))
+            pump.start()
+            try:
+                # reap the child ourselves, rather than with
+                # proc.wait(), to get its resource usage
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+            finally:
+                pump.join()
+        if len(pump_errors) > 0:
+            raise pump_errors[0]
+    usage = _resource_usage(rusage, time.time() - start)
+
+    if proc.returncode != 0:
         logger.warn("Exceuting %s failed:" % (base_command))
-        if logger.getEffectiveLevel() == logging.DEBUG:
-            # caller wanted all output anyway (for debug), so give
-            # them everything
-            for line in fileinput.input(stdout_file):
-                logger.warn(line.rstrip('\n'))
+        for line in tail:
+            logger.warn(line)
+        error = subprocess.CalledProcessError(proc.returncode, call_args)
+        error.resource_usage = usage
+        raise error
+
+    return usage
+
+
+def fan_out_compress(source_command, outputs, chunk_size=1024 * 1024):
+    """Compress one stream into several files in parallel
+
+    Runs source_command (typically a decompressor writing a tarball
+    to stdout) once and copies its output into the stdin of every
+    compressor in outputs, a dictionary of name to a dictionary with
+    keys 'command' (the compressor, which must write to stdout),
+    'filename' (where to write its output), and optionally 'cpus' (a
+    set of CPU numbers to pin the compressor to).  Returns a
+    dictionary of name to a dictionary with the input and output
+    sizes and the resource usage (see logged_call()) of the
+    compressor.  Raises subprocess.CalledProcessError if any of the
+    commands fails; outputs are not cleaned up.
+
+    """
+    logger = logging.getLogger('Builder.BuildUtils')
+    logger.debug('Compressing output of %s into %s' %
+                 (str(source_command), ', '.join(outputs.keys())))
+
+    procs = {}
+    finished = {}
+    start = time.time()
+
+    def reap(name, proc):
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        finished[name] = _resource_usage(rusage, time.time() - start)
+
+    source = subprocess.Popen(source_command, stdout=subprocess.PIPE)
+    reapers = []
+    input_bytes = 0
+    try:
+        for name, output in outputs.items():
+            preexec_fn = None
+            if output.get('cpus') and hasattr(os, 'sched_setaffinity'):
+                preexec_fn = lambda cpus=output['cpus']: os.sched_setaffinity(0, cpus)
+            with open(output['filename'], 'wb') as f:
+                procs[name] = subprocess.Popen(output['command'], stdin=subprocess.PIPE,
+                                               stdout=f, preexec_fn=preexec_fn)
+            reaper = threading.Thread(target=reap, args=(name, procs[name]))
+            reaper.start()
+            reapers.append(reaper)
+
+        while True:
+            data = source.stdout.read(chunk_size)
+            if not data:
+                break
+            input_bytes += len(data)
+            for proc in procs.values():
+                proc.stdin.write(data)
+    finally:
+        source.stdout.close()
+        source.wait()
+        for proc in procs.values():
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        for reaper in reapers:
+            reaper.join()
+
+    if source.returncode != 0:
+        raise subprocess.CalledProcessError(source.returncode, source_command)
+    result = {}
+    for name, proc in procs.items():
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, outputs[name]['command'])
+        result[name] = { 'input_bytes' : input_bytes,
+                         'output_bytes' : os.stat(outputs[name]['filename']).st_size,
+                         'resource_usage' : finished[name] }
+    return result
+
+
+def count_configure_probes(log_file):
+    """Count configure probes in a log file
+
+    Returns a dictionary with the number of 'checking ...' lines
+    ('probes') in log_file, and how many of them were answered from
+    the autoconf cache ('cached').  Works for the output of any
+    command that runs configure, including make distcheck.
+
+    """
+    stats = { 'probes' : 0, 'cached' : 0 }
+    with open(log_file, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith('checking '):
+                stats['probes'] += 1
+                if '(cached)' in line:
+                    stats['cached'] += 1
+    return stats
+
+
+def configure_cache_failed(log_file):
+    """Did a configure that loaded a cache file fail?
+
+    True if log_file (the output of any command that runs configure,
+    including make distcheck) shows a configure stopping with an
+    error after a configure loaded an autoconf cache file.  A failure
+    anywhere else (a compile error, a failing test) can't be blamed
+    on the cache.
+
+    """
+    loaded = False
+    with open(log_file, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith('configure: loading cache '):
+                loaded = True
+            elif loaded and line.startswith('configure: error: '):
+                return True
+    return False
+
+
+@contextlib.contextmanager
+def file_lock(lock_file, shared=False, blocking=True):
+    """Hold an flock() lock on lock_file for the life of the context
+
+    Used to coordinate scratch state (mirrors, tool downloads, etc.)
+    that is shared between builder processes, including nightly
+    scripts for different projects running at the same time.  The
+    lock file is created if it does not exist and is never removed.
+    With blocking=False, raises BlockingIOError if the lock is
+    already held.
+
+    """
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if shared:
+            operation = fcntl.LOCK_SH
         else:
-            # caller wasn't going to get success output, so only give
-            # the last err_log_len lines to keep emails rationally
-            # sized
-            output = open(stdout_file, 'r')
-            lines = output.readlines()
-            for line in lines[-err_log_len:]:
-                logger.warn(line.rstrip('\n'))
-        raise
-    else:
-        stdout.close()
-        if logger.getEffectiveLevel() == logging.DEBUG:
-            for line in fileinput.input(stdout_file):
-                logger.debug(line.rstrip('\n'))
+            operation = fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _retry_with_chmod(func, name, dir_fd):
+    # make distcheck leaves read-only directories behind.  Only pay
+    # for a chmod when the removal actually fails.
+    try:
+        func(name, dir_fd=dir_fd)
+    except PermissionError:
+        os.fchmod(dir_fd, 0o700)
+        func(name, dir_fd=dir_fd)
+
+
+def _open_dir(name, dir_fd):
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+    try:
+        return os.open(name, flags, dir_fd=dir_fd)
+    except PermissionError:
+        os.chmod(name, 0o700, dir_fd=dir_fd)
+        return os.open(name, flags, dir_fd=dir_fd)
+
+
+def _remove_dir(name, parent_fd):
+    # remove the directory name (relative to parent_fd) and
+    # everything in it, in a single pass, without ever building a
+    # full pathname
+    fd = _open_dir(name, parent_fd)
+    try:
+        for entry in list(os.scandir(fd)):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    _remove_dir(entry.name, fd)
+                else:
+                    _retry_with_chmod(os.unlink, entry.name, fd)
+            except FileNotFoundError:
+                pass
+    finally:
+        os.close(fd)
+    _retry_with_chmod(os.rmdir, name, parent_fd)
+
+
+def _remove_path(path):
+    parent_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _remove_dir(os.path.basename(os.path.abspath(path)), parent_fd)
+    finally:
+        os.close(parent_fd)
+
+
+def remove_tree(path, max_workers=1, split_depth=2):
+    """Remove a directory tree
+
+    Faster replacement for the chmod-everything-then-rmtree dance.
+    The tree is removed in a single pass using directory file
+    descriptors, and permissions are only fixed up on directories
+    where a removal fails.  Symlinks are removed, never followed.
+    With max_workers greater than one, the subtrees split_depth levels
+    down are removed in parallel by a pool of threads (the unlink and
+    rmdir system calls drop the GIL).
+
+    """
+    if not os.path.lexists(path):
+        return
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.unlink(path)
+        return
+    if max_workers <= 1:
+        _remove_path(path)
+        return
+
+    # walk the top of the tree ourselves, removing files as we go and
+    # collecting the subtrees to hand to the pool
+    dirs = []
+    subtrees = []
+    frontier = [path]
+    for depth in range(split_depth):
+        next_frontier = []
+        for dirpath in frontier:
+            dirs.append(dirpath)
+            fd = _open_dir(dirpath, None)
+            try:
+                for entry in list(os.scandir(fd)):
+                    if entry.is_dir(follow_symlinks=False):
+                        next_frontier.append(os.path.join(dirpath, entry.name))
+                    else:
+                        _retry_with_chmod(os.unlink, entry.name, fd)
+            finally:
+                os.close(fd)
+        frontier = next_frontier
+    subtrees = frontier
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(_remove_path, subtree) for subtree in subtrees]:
+            future.result()
+
+    for dirpath in reversed(dirs):
+        parent_fd = os.open(os.path.dirname(os.path.abspath(dirpath)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            _retry_with_chmod(os.rmdir, os.path.basename(os.path.abspath(dirpath)), parent_fd)
+        finally:
+            os.close(parent_fd)
+
+
+def _empty_trash(trash_path, max_workers):
+    # only one reaper per trash directory; it keeps going until the
+    # trash is empty, so anything renamed in while it runs will be
+    # picked up.  A tree renamed in after the last listdir() but
+    # before the lock is released belongs to a reaper that found the
+    # lock held and gave up, so look again once the lock is released
+    # and go around if anything showed up.
+    while True:
+        try:
+            with file_lock(trash_path + '.lock', blocking=False):
+                while True:
+                    entries = os.listdir(trash_path)
+                    if len(entries) == 0:
+                        break
+                    for name in entries:
+                        remove_tree(os.path.join(trash_path, name), max_workers)
+        except BlockingIOError:
+            # whoever holds the lock will look again before exiting
+            return
+        if len(os.listdir(trash_path)) == 0:
+            return
+
+
+def remove_tree_in_background(path, trash_path, max_workers=1):
+    """Get a directory tree out of the way and remove it later
+
+    Renames path into trash_path (which should be on the same file
+    system) and returns immediately, leaving a detached process to
+    empty trash_path with remove_tree().  Anything left in trash_path
+    by an earlier, interrupted removal is cleaned up as well.  Falls
+    back to removing path in the foreground if it can't be renamed.
+
+    The reaper is started with os.fork(), even though the caller may
+    have other threads running (Coverity queue, parallel build
+    helpers, output pumps).  Only the forking thread exists in the
+    child, and any lock another thread held at the time stays held
+    forever, so the child must stick to system calls and the
+    thread-pool code in remove_tree(): no logging, no imports, and no
+    Builder state.
+
+    """
+    if not os.path.exists(trash_path):
+        os.makedirs(trash_path)
+    target = os.path.join(trash_path, '%s-%d-%d' % (os.path.basename(path),
+                                                    os.getpid(), time.time() * 1000000))
+    try:
+        os.rename(path, target)
+    except OSError:
+        remove_tree(path, max_workers)
+        return
+
+    # double fork, so that the reaper is not our child (and does not
+    # become a zombie we never wait for)
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return
+    try:
+        if os.fork() == 0:
+            os.setsid()
+            # let go of our caller's terminal, log files, and pipes
+            # (cron waits for its output pipe to close before it
+            # considers the job done)
+            null_fd = os.open(os.devnull, os.O_RDWR)
+            for fd in [0, 1, 2]:
+                os.dup2(null_fd, fd)
+            os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+            _empty_trash(trash_path, max_workers)
+    except BaseException:
+        pass
+    finally:
+        os._exit(0)
+
+
+class LoggedCallTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._log_file = os.path.join(self._tempdir, 'output.txt')
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def test_success(self):
+        usage = logged_call(['sh', '-c', 'for i in $(seq 1 1000) ; do echo line $i ; done'],
+                            log_file=self._log_file)
+        self.assertGreater(usage['max_rss_kb'], 0)
+        self.assertGreaterEqual(usage['wall_seconds'], 0)
+        with open(self._log_file, 'r') as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[-1], 'line 1000\n')
+
+
+    def test_failure_tail(self):
+        logger = logging.getLogger('Builder.BuildUtils')
+        with self.assertLogs(logger, level='WARNING') as logs:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                logged_call(['sh', '-c', 'for i in $(seq 1 100) ; do echo line $i 1>&2 ; done ; exit 3'],
+                            log_file=self._log_file, err_log_len=5)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertIn('user_seconds', cm.exception.resource_usage)
+        self.assertEqual(logs.output[1:],
+                         ['WARNING:Builder.BuildUtils:line %d' % (i) for i in range(96, 101)])
+
+
+    def test_forward(self):
+        logger = logging.getLogger('Builder.BuildUtils')
+        with self.assertLogs(logger, level='DEBUG') as logs:
+            logged_call(['echo', 'hello'], log_file=self._log_file,
+                        forward_output=True)
+        self.assertIn('DEBUG:Builder.BuildUtils:hello', logs.output)
+
+
+    def test_log_write_failure(self):
+        # far more output than fits in the pipe, so this hangs unless
+        # the pipe is drained after the first failed write
+        with self.assertRaises(OSError):
+            logged_call(['seq', '1', '1000000'], log_file='/dev/full')
+
+
+class ConfigureCacheFailedTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._log_file = os.path.join(self._tempdir, 'make-output.txt')
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def _check(self, lines):
+        with open(self._log_file, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return configure_cache_failed(self._log_file)
+
+
+    def test_configure_cache_failed(self):
+        self.assertTrue(self._check(['configure: loading cache /cache/distcheck.cache',
+                                     'checking for gcc... (cached) /nonexistent/cc',
+                                     'configure: error: C compiler cannot create executables']))
+        # no cache
+        self.assertFalse(self._check(['checking for gcc... gcc',
+                                      'configure: error: C compiler cannot create executables']))
+        # configure was fine; the build or tests failed
+        self.assertFalse(self._check(['configure: loading cache /cache/distcheck.cache',
+                                      'config.status: creating Makefile',
+                                      'foo.c:1:1: error: unknown type name',
+                                      'make: *** [Makefile:100: distcheck] Error 1']))
+
+
+class JobServerTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._jobserver = JobServer(3)
+        set_jobserver(self._jobserver)
+
+
+    def tearDown(self):
+        set_jobserver(None)
+        self._jobserver.close()
+        shutil.rmtree(self._tempdir)
+
+
+    def test_make(self):
+        makefile = os.path.join(self._tempdir, 'Makefile')
+        with open(makefile, 'w') as f:
+            f.write('all: a b\na b:\n\t@echo "$(MAKEFLAGS)"\n')
+        log_file = os.path.join(self._tempdir, 'make-output.txt')
+        logged_call(['make', '-f', makefile], log_file=log_file)
+        with open(log_file, 'r') as f:
+            self.assertIn('jobserver', f.read())
+        # every token should be back in the pipe
+        tokens = os.read(self._jobserver.fds()[0], 100)
+        os.write(self._jobserver.fds()[1], tokens)
+        self.assertEqual(len(tokens), 3)
+
+
+    def test_wrapped_make(self):
+        # like OMPIBuilder.call(): make run under run-with-autotools.sh
+        wrapper = os.path.join(self._tempdir, 'wrapper.sh')
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nshift\n"$@"\n')
+        os.chmod(wrapper, 0o755)
+        makefile = os.path.join(self._tempdir, 'Makefile')
+        with open(makefile, 'w') as f:
+            f.write('all:\n\t@echo "$(MAKEFLAGS)"\n')
+        log_file = os.path.join(self._tempdir, 'make-output.txt')
+        logged_call(['make', '-f', makefile], wrapper_args=[wrapper, 'autotools/test'],
+                    log_file=log_file)
+        with open(log_file, 'r') as f:
+            self.assertIn('jobserver', f.read())
+
+
+    def test_not_make(self):
+        log_file = os.path.join(self._tempdir, 'sh-output.txt')
+        logged_call(['sh', '-c', 'echo "$MAKEFLAGS"'], log_file=log_file)
+        with open(log_file, 'r') as f:
+            self.assertNotIn('jobserver', f.read())
+
+
+    def test_strip_make_jobs(self):
+        self.assertEqual(strip_make_jobs(['-j', '8', 'check']), ['check'])
+        self.assertEqual(strip_make_jobs(['-j8', 'V=1', '--jobs=2']), ['V=1'])
+        self.assertEqual(strip_make_jobs(['-j', 'check']), ['check'])
+
+
+class FanOutCompressTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def test_fan_out(self):
+        data = b'I love me some unit tests.\n' * 100000
+        source = os.path.join(self._tempdir, 'data.gz')
+        with open(source, 'wb') as f:
+            f.write(subprocess.check_output(['gzip', '-c'], input=data))
+        outputs = {}
+        for name in ['gzip', 'bzip2']:
+            outputs[name] = { 'command' : [name, '-c'],
+                              'filename' : os.path.join(self._tempdir, 'data.' + name),
+                              'cpus' : set([0]) }
+        results = fan_out_compress(['gzip', '-dc', source], outputs, chunk_size=4096)
+        for name in ['gzip', 'bzip2']:
+            self.assertEqual(results[name]['input_bytes'], len(data))
+            self.assertEqual(subprocess.check_output([name, '-dc', outputs[name]['filename']]),
+                             data)
+
+
+class RemoveTreeTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+
+
+    def _make_tree(self, root, outside):
+        # a small distcheck-like tree: nested directories, read-only
+        # directories, and a symlink that must not be followed
+        for i in range(3):
+            for j in range(3):
+                dirpath = os.path.join(root, 'd%d' % (i), 'e%d' % (j), 'f')
+                os.makedirs(dirpath)
+                with open(os.path.join(dirpath, 'file'), 'w') as f:
+                    f.write('data\n')
+        os.symlink(outside, os.path.join(root, 'd0', 'link'))
+        os.chmod(os.path.join(root, 'd1', 'e1', 'f'), 0o500)
+        os.chmod(os.path.join(root, 'd1', 'e1'), 0o500)
+        os.chmod(os.path.join(root, 'd2'), 0o000)
+
+
+    def _check(self, max_workers):
+        root = os.path.join(self._tempdir, 'root')
+        outside = os.path.join(self._tempdir, 'outside')
+        os.makedirs(outside)
+        with open(os.path.join(outside, 'keep'), 'w') as f:
+            f.write('keep me\n')
+        self._make_tree(root, outside)
+        remove_tree(root, max_workers)
+        self.assertFalse(os.path.lexists(root))
+        self.assertTrue(os.path.exists(os.path.join(outside, 'keep')))
+
+
+    def test_serial(self):
+        self._check(1)
+
+
+    def test_parallel(self):
+        self._check(4)
+
+
+    def test_background(self):
+        root = os.path.join(self._tempdir, 'root')
+        trash = os.path.join(self._tempdir, 'trash')
+        self._make_tree(root, self._tempdir)
+        remove_tree_in_background(root, trash)
+        self.assertFalse(os.path.lexists(root))
+        for i in range(100):
+            if len(os.listdir(trash)) == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(trash), [])
+
+
+    def test_empty_trash_locked(self):
+        trash = os.path.join(self._tempdir, 'trash')
+        self._make_tree(os.path.join(trash, 'root'), self._tempdir)
+        # another reaper is running; it gets to remove the tree
+        with file_lock(trash + '.lock'):
+            _empty_trash(trash, 1)
+            self.assertEqual(os.listdir(trash), ['root'])
+        _empty_trash(trash, 1)
+        self.assertEqual(os.listdir(trash), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,12 +13,241 @@ import argparse
 import logging
 import time
 import shlex
+import json
 import shutil
+import tempfile
+import contextlib
+import multiprocessing
 import requests
 import BuilderUtils
 
+# hashing is shared with the release scripts in dist/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'dist'))
+import hashutils
+
 
 _cov_filename = 'coverity_tools.tgz'
+_cov_lock_filename = 'coverity_tools.lock'
+_extracted_prefix = 'extracted-'
+
+
+_download_chunk_size = 1024 * 1024
+
+
+def get_remote_tool_digest(config, token):
+    """Ask the Coverity server for the md5 of the current tool tarball"""
+    values = { 'token' : token,
+               'project' : config['project_name'],
+               'md5' : '1' }
+    r = requests.post(config['tool_url'], data=values, timeout=60)
+    r.raise_for_status()
+    digest = r.text.strip().split()[0].lower()
+    if not re.match('^[0-9a-f]{32}$', digest):
+        raise Exception('Unexpected md5 response from %s' % (config['tool_url']))
+    return digest
+
+
+def download_tool(logger, config, token):
+    """Make sure tool_dir holds the current Coverity tool tarball
+
+    The tarball (2+ GB as of 2021) is shared by every project's
+    nightly script, so all of this happens under the tool_dir lock.
+    The server publishes the md5 of the current tarball, so the
+    tarball is only downloaded when that changes (if the md5 can't be
+    fetched, fall back to re-downloading once a day).  Downloads go to
+    a .part file, are resumed if interrupted, are checked against the
+    md5 (or, if the md5 can't be fetched, against the size the server
+    reports), and are then renamed into place, so readers never see a
+    partial tarball.  The body is streamed to disk; it never sits in
+    memory, which would bring our limited AWS VMs to their knees.
+
+    """
+    tool_dir = config['tool_dir']
+    tarball = os.path.join(tool_dir, _cov_filename)
+    partial = tarball + '.part'
+
+    with BuilderUtils.file_lock(os.path.join(tool_dir, _cov_lock_filename)):
+        try:
+            remote_digest = get_remote_tool_digest(config, token)
+        except Exception as e:
+            logger.warn('Could not get md5 of Coverity tool: %s' % (str(e)))
+            remote_digest = None
+
+        if os.path.exists(tarball):
+            if remote_digest == None:
+                if os.stat(tarball).st_mtime + (24 * 3600) > time.time():
+                    logger.debug('Reusing existing tarball')
+                    return
+            elif get_tool_digest(tool_dir) == remote_digest:
+                logger.debug('Existing tarball is current (md5 %s)' % (remote_digest))
+                return
+
+        # a partial download is only worth resuming if it is a
+        # download of the same tarball.  Without the md5 there is no
+        # telling, so resume anything from the last day (tool updates
+        # are rare) and rely on the size check.
+        partial_digest_file = partial + '.md5'
+        partial_digest = None
+        if os.path.exists(partial_digest_file):
+            with open(partial_digest_file, 'r') as f:
+                partial_digest = f.read().strip()
+        if os.path.exists(partial):
+            if remote_digest != None:
+                stale = partial_digest != remote_digest
+            else:
+                stale = os.stat(partial).st_mtime + (24 * 3600) < time.time()
+            if stale:
+                os.remove(partial)
+        if remote_digest != None:
+            with open(partial_digest_file, 'w') as f:
+                f.write(remote_digest + '\n')
+        elif not os.path.exists(partial) and os.path.exists(partial_digest_file):
+            os.remove(partial_digest_file)
+
+        logger.debug('Downloading %s' % (config['tool_url']))
+        expected_size = _download_resumable(logger, config, token, partial)
+
+        size = os.stat(partial).st_size
+        if expected_size != None and size != expected_size:
+            os.remove(partial)
+            raise Exception('Downloaded Coverity tool is %d bytes, expected %d' %
+                            (size, expected_size))
+        digest = hashutils.compute_hashes(partial, ['md5'])['md5']
+        if remote_digest != None and digest != remote_digest:
+            os.remove(partial)
+            raise Exception('Downloaded Coverity tool has md5 %s, expected %s' %
+                            (digest, remote_digest))
+        os.rename(partial, tarball)
+        if os.path.exists(partial_digest_file):
+            os.remove(partial_digest_file)
+        # save get_tool_digest() from hashing the tarball again
+        info = os.stat(tarball)
+        with open(tarball + '.md5', 'w') as f:
+            f.write('%s\n%d %d\n' % (digest, info.st_size, info.st_mtime_ns))
+
+
+def _content_range_total(r):
+    # total size from a Content-Range header ('bytes 0-9/10' or
+    # 'bytes */10'), or None if the server didn't say
+    match = re.match(r'^bytes [0-9*-]+/([0-9]+)$', r.headers.get('Content-Range', ''))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def _download_resumable(logger, config, token, partial):
+    # returns the size of the complete tarball, or None if the server
+    # didn't say
+    values = { 'token' : token,
+               'project' : config['project_name'] }
+    headers = {}
+    offset = 0
+    if os.path.exists(partial):
+        offset = os.stat(partial).st_size
+    if offset > 0:
+        logger.debug('Resuming download at byte %d' % (offset))
+        headers['Range'] = 'bytes=%d-' % (offset)
+
+    with requests.post(config['tool_url'], data=values, headers=headers,
+                       stream=True, timeout=600) as r:
+        if r.status_code == 416:
+            # we already have everything
+            return _content_range_total(r)
+        r.raise_for_status()
+        if r.status_code == 206:
+            mode = 'ab'
+            expected_size = _content_range_total(r)
+        else:
+            # server ignored the range; start over
+            mode = 'wb'
+            expected_size = None
+            if 'Content-Length' in r.headers:
+                expected_size = int(r.headers['Content-Length'])
+        if r.headers.get('Content-Encoding', 'identity') != 'identity':
+            # sizes are of the encoded body, not what we write
+            expected_size = None
+        with open(partial, mode) as f:
+            for chunk in r.iter_content(chunk_size=_download_chunk_size):
+                f.write(chunk)
+    return expected_size
+
+
+def get_tool_digest(tool_dir):
+    """md5 of the downloaded tool tarball
+
+    Hashing a multi-GB tarball is not free, so the digest is cached in
+    a file next to the tarball and only recomputed when the size or
+    mtime of the tarball changes.
+
+    """
+    tarball = os.path.join(tool_dir, _cov_filename)
+    digest_file = tarball + '.md5'
+    info = os.stat(tarball)
+    stamp = '%d %d' % (info.st_size, info.st_mtime_ns)
+    if os.path.exists(digest_file):
+        with open(digest_file, 'r') as f:
+            lines = f.read().splitlines()
+        if len(lines) == 2 and lines[1] == stamp:
+            return lines[0]
+    digest = hashutils.compute_hashes(tarball, ['md5'])['md5']
+    with open(digest_file, 'w') as f:
+        f.write('%s\n%s\n' % (digest, stamp))
+    return digest
+
+
+@contextlib.contextmanager
+def extracted_tool(logger, tool_dir, build_root):
+    """Provide the bin directory of an extracted copy of the tool
+
+    The tool tarball is extracted once per version into
+    tool_dir/extracted-<md5 of tarball>, by extracting into a
+    temporary directory and renaming it into place, so nobody ever
+    sees a partial extraction.  The extracted tree is shared (read
+    only) by every Coverity run that uses that version; each run
+    holds a shared lock on it, and older versions are removed once
+    nobody is using them.
+
+    """
+    tarball = os.path.join(tool_dir, _cov_filename)
+    with contextlib.ExitStack() as stack:
+        with BuilderUtils.file_lock(os.path.join(tool_dir, _cov_lock_filename)):
+            digest = get_tool_digest(tool_dir)
+            extract_dir = os.path.join(tool_dir, _extracted_prefix + digest)
+            if not os.path.isdir(extract_dir):
+                logger.debug('Expanding %s into %s' % (_cov_filename, extract_dir))
+                tmp_dir = tempfile.mkdtemp(prefix='.extracting-', dir=tool_dir)
+                BuilderUtils.logged_call(['tar', 'xf', tarball, '-C', tmp_dir],
+                                         log_file=os.path.join(build_root, 'coverity-tools-untar-output.txt'))
+                os.rename(tmp_dir, extract_dir)
+            stack.enter_context(BuilderUtils.file_lock(extract_dir + '.lock', shared=True))
+
+            for name in os.listdir(tool_dir):
+                path = os.path.join(tool_dir, name)
+                if name.startswith('.extracting-'):
+                    # leftovers from an interrupted extraction
+                    shutil.rmtree(path, ignore_errors=True)
+                elif (name.startswith(_extracted_prefix) and path != extract_dir
+                      and os.path.isdir(path)):
+                    try:
+                        with BuilderUtils.file_lock(path + '.lock', blocking=False):
+                            logger.debug('Removing old tool version %s' % (path))
+                            shutil.rmtree(path, ignore_errors=True)
+                            os.remove(path + '.lock')
+                    except BlockingIOError:
+                        logger.debug('Old tool version %s still in use' % (path))
+
+        # The name of the top-level directory in the tarball changes
+        # every time Coverity releases a new version of the tool.  So
+        # search around and hope we find something.
+        cov_path = ''
+        for name in os.listdir(extract_dir):
+            if name.startswith('cov-'):
+                cov_path = os.path.join(extract_dir, name, 'bin')
+                break
+        logger.debug('Found Coverity path %s' % (cov_path))
+        yield cov_path
+
 
 def run_coverity_internal(logger, build_root, source_tarball, config):
     # read the token file
@@ -28,56 +257,28 @@ def run_coverity_internal(logger, build_root, source_tarball, config):
     # get the tool
     if not os.path.isdir(config['tool_dir']):
         os.makedirs(config['tool_dir'])
-    os.chdir(config['tool_dir'])
-    timestamp = 0
-    if os.path.exists(_cov_filename):
-        timestamp  = os.stat(_cov_filename).st_mtime
-    if (timestamp + (24 * 3600)) > int(time.time()):
-        logger.debug('Reusing existing tarball')
-    else:
-        logger.debug('Downloading %s' % (config['tool_url']))
-        # As of 9 Aug 2021, this file is 2+GB.  Downloading it all
-        # into a Python script and then writing it out to disk is not
-        # a good idea on our limited resources AWS VM (meaning: it
-        # brings the VM to a crawl).  From
-        # https://stackoverflow.com/questions/38969164/coverity-scan-for-projects-outside-github,
-        # we can use a command line tool to download, instead.  It's
-        # not very Pythonic, but it doesn't bring our VM to its knees.
-        cmd = [
-            'wget',
-            config["tool_url"],
-            '--post-data',
-            f'token={token}&project={config["project_name"]}',
-            '-O',
-            _cov_filename
-        ]
-        BuilderUtils.logged_call(cmd,
-                                 log_file=os.path.join(build_root, 'coverity-tools-download-output.txt'))
+    download_tool(logger, config, token)
 
     # make sure we have a build root
     if not os.path.isdir(build_root):
         os.makedirs(build_root)
     os.chdir(build_root)
 
-    # The name of the top-level directory in the tarball changes every
-    # time Coverity releases a new version of the tool.  So search
-    # around and hope we find something.
-    logger.debug('Expanding ' + _cov_filename)
-    BuilderUtils.logged_call(['tar', 'xf', os.path.join(config['tool_dir'], _cov_filename)],
-                             log_file=os.path.join(build_root, 'coverity-tools-untar-output.txt'))
-    cov_path=''
-    for file in os.listdir(build_root):
-        if file.startswith('cov-'):
-            cov_path = os.path.join(build_root, file, 'bin')
-            break
-    logger.debug('Found Coverity path %s' % (cov_path))
+    with extracted_tool(logger, config['tool_dir'], build_root) as cov_path:
+        return run_coverity_build(logger, build_root, source_tarball, config, token, cov_path)
+
 
+def run_coverity_build(logger, build_root, source_tarball, config, token, cov_path):
     child_env = os.environ.copy()
     child_env['PATH'] = cov_path + ':' + child_env['PATH']
 
+    # resource usage of each step, to help size build instances and
+    # tune make_args
+    usage = {}
+
     logger.debug('Extracting build tarball: %s' % (source_tarball))
-    BuilderUtils.logged_call(['tar', 'xf', source_tarball],
-                             log_file=os.path.join(build_root, 'coverity-source-untar-output.txt'))
+    usage['untar'] = BuilderUtils.logged_call(['tar', 'xf', source_tarball],
+                                              log_file=os.path.join(build_root, 'coverity-source-untar-output.txt'))
 
     # guess the directory based on the tarball name.  Don't worry
     # about the exception, because we want out in that case anyway...
@@ -90,20 +291,37 @@ def run_coverity_internal(logger, build_root, source_tarball, config):
     args = ['./configure']
     if 'configure_args' in config:
         args.extend(shlex.split(config['configure_args']))
-    BuilderUtils.logged_call(args, env=child_env,
-                             log_file=os.path.join(build_root, 'coverity-configure-output.txt'))
+    if 'configure_cache_file' in config:
+        args.append('--cache-file=%s' % (config['configure_cache_file']))
+    configure_log = os.path.join(build_root, 'coverity-configure-output.txt')
+    try:
+        usage['configure'] = BuilderUtils.logged_call(args, env=child_env,
+                                                      log_file=configure_log)
+    except:
+        # don't let a bad cache break tomorrow's run, too
+        if 'configure_cache_file' in config and os.path.exists(config['configure_cache_file']):
+            os.remove(config['configure_cache_file'])
+        raise
+    if 'configure_cache_file' in config:
+        stats = BuilderUtils.count_configure_probes(configure_log)
+        logger.info('configure cache: %d of %d probes cached' %
+                    (stats['cached'], stats['probes']))
 
     logger.debug('coverity build')
     args = ['cov-build', '--dir', 'cov-int', 'make']
     if 'make_args' in config:
-        args.extend(shlex.split(config['make_args']))
-    BuilderUtils.logged_call(args, env=child_env,
-                             log_file=os.path.join(build_root, 'coverity-make-output.txt'))
+        make_args = shlex.split(config['make_args'])
+        if BuilderUtils.get_jobserver() != None:
+            # the jobserver decides how many jobs we get
+            make_args = BuilderUtils.strip_make_jobs(make_args)
+        args.extend(make_args)
+    usage['cov-build'] = BuilderUtils.logged_call(args, env=child_env,
+                                                  log_file=os.path.join(build_root, 'coverity-make-output.txt'))
 
     logger.debug('bundling results')
     results_tarball = os.path.join(build_root, 'analyzed.tar.bz2')
-    BuilderUtils.logged_call(['tar', 'jcf', results_tarball, 'cov-int'],
-                             log_file=os.path.join(build_root, 'coverity-results-tar-output.txt'))
+    usage['results-tar'] = BuilderUtils.logged_call(['tar', 'jcf', results_tarball, 'cov-int'],
+                                                    log_file=os.path.join(build_root, 'coverity-results-tar-output.txt'))
 
     logger.debug('submitting results')
     url = 'https://scan.coverity.com/builds?project=' + config['project_name']
@@ -115,22 +333,120 @@ def run_coverity_internal(logger, build_root, source_tarball, config):
     r = requests.post(url, files=files, data=values)
     r.raise_for_status()
 
+    return usage
+
 
 def run_coverity(logger, build_root, source_tarball, config):
     """Run coverity test and submit results
 
     Run Coverity test and submit results to their server.  Can be run
     either standalone (with a tarball as a target) or integrated into
-    the Builder class.
+    the Builder class.  Returns the resource usage (see
+    BuilderUtils.logged_call()) of each step of the build.
 
     """
     cwd = os.getcwd()
     try:
-        run_coverity_internal(logger, build_root, source_tarball, config)
+        return run_coverity_internal(logger, build_root, source_tarball, config)
     finally:
         os.chdir(cwd)
 
 
+def _run_queued_coverity(slots, build_root, source_tarball, config, log_file, usage_file,
+                         log_level):
+    # body of a CoverityQueue child.  Send everything (including
+    # BuilderUtils output) to the job's log file instead of the
+    # parent's log streams, wait for a free slot, and report success
+    # or failure through the exit code (and resource usage through
+    # usage_file).
+    builder_logger = logging.getLogger('Builder')
+    for handler in list(builder_logger.handlers):
+        builder_logger.removeHandler(handler)
+    handler = logging.FileHandler(log_file, 'w')
+    handler.setLevel(log_level)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    builder_logger.addHandler(handler)
+    logger = logging.getLogger('Builder.Coverity')
+
+    with slots:
+        start = time.time()
+        try:
+            usage = run_coverity(logger, build_root, source_tarball, config)
+        except Exception as e:
+            logger.error("ERROR: Coverity submission failed: %s" % (str(e)))
+            sys.exit(1)
+        logger.info("Successfully submitted Coverity build (%d seconds)" %
+                    (int(time.time() - start)))
+        if usage != None:
+            with open(usage_file, 'w') as f:
+                json.dump(usage, f)
+
+
+class CoverityQueue(object):
+    """Run Coverity submissions in the background
+
+    Coverity analysis (configure, cov-build make, submission) usually
+    takes longer than building the tarball, so the Builder queues it
+    here and moves on to the next branch.  Every submitted job runs in
+    its own forked process, with its own build root and log file, but
+    at most max_parallel of them do real work at the same time.  Call
+    wait() to collect the results.
+
+    """
+
+    def __init__(self, max_parallel=1, log_level='INFO'):
+        self._ctx = multiprocessing.get_context('fork')
+        self._slots = self._ctx.BoundedSemaphore(max_parallel)
+        self._log_level = log_level
+        self._jobs = []
+
+
+    def submit(self, name, build_root, source_tarball, config):
+        """Queue a Coverity run of source_tarball in build_root"""
+        if not os.path.isdir(build_root):
+            os.makedirs(build_root)
+        log_file = os.path.join(build_root, 'coverity-output.log')
+        usage_file = os.path.join(build_root, 'coverity-usage.json')
+        process = self._ctx.Process(target=_run_queued_coverity,
+                                    args=(self._slots, build_root, source_tarball,
+                                          config, log_file, usage_file, self._log_level))
+        process.start()
+        self._jobs.append({ 'name' : name,
+                            'process' : process,
+                            'log_file' : log_file,
+                            'usage_file' : usage_file,
+                            'start' : time.time() })
+
+
+    def wait(self):
+        """Wait for all queued jobs
+
+        Returns a list (in submission order) of dictionaries with the
+        job name, whether it succeeded, how long it took from
+        submission, its log output, and the resource usage of each
+        step (or None if the job did not get that far).
+
+        """
+        results = []
+        for job in self._jobs:
+            job['process'].join()
+            output = ''
+            if os.path.exists(job['log_file']):
+                with open(job['log_file'], 'r') as log:
+                    output = log.read()
+            resource_usage = None
+            if os.path.exists(job['usage_file']):
+                with open(job['usage_file'], 'r') as f:
+                    resource_usage = json.load(f)
+            results.append({ 'name' : job['name'],
+                             'success' : job['process'].exitcode == 0,
+                             'seconds' : int(time.time() - job['start']),
+                             'output' : output,
+                             'resource_usage' : resource_usage })
+        self._jobs = []
+        return results
+
+
 if __name__ == '__main__':
     config = { 'tool_url' : 'https://scan.coverity.com/download/cxx/linux64',
                'log_level' : 'INFO' }
@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+# Tests for Coverity.py, whose __main__ is the submission script.
+#
+
+import os
+import re
+import shutil
+import tempfile
+import hashlib
+import logging
+import threading
+import unittest
+import http.server
+import urllib.parse
+import Coverity
+
+
+class _ToolServer(http.server.BaseHTTPRequestHandler):
+    # stand-in for the Coverity download endpoint, with just enough
+    # HTTP to test Coverity.download_tool()
+    content = b''
+    seen = []
+    md5_available = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        values = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        _ToolServer.seen.append((values, self.headers.get('Range')))
+        if values.get('md5') == ['1']:
+            if _ToolServer.md5_available:
+                body = hashlib.md5(_ToolServer.content).hexdigest().encode() + b'\n'
+                self.send_response(200)
+            else:
+                body = b''
+                self.send_response(503)
+        elif self.headers.get('Range') != None:
+            start = int(re.match('bytes=([0-9]+)-', self.headers.get('Range')).group(1))
+            body = _ToolServer.content[start:]
+            if len(body) == 0:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % (len(_ToolServer.content)))
+            else:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                                 (start, len(_ToolServer.content) - 1, len(_ToolServer.content)))
+        else:
+            body = _ToolServer.content
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadToolTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._server = http.server.HTTPServer(('127.0.0.1', 0), _ToolServer)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        _ToolServer.content = os.urandom(3 * Coverity._download_chunk_size + 123)
+        _ToolServer.seen = []
+        _ToolServer.md5_available = True
+        self._config = { 'tool_dir' : self._tempdir,
+                         'tool_url' : 'http://127.0.0.1:%d/download' % (self._server.server_port),
+                         'project_name' : 'test' }
+        self._logger = logging.getLogger('Builder.Coverity')
+
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        shutil.rmtree(self._tempdir)
+
+
+    def _tarball(self):
+        with open(os.path.join(self._tempdir, Coverity._cov_filename), 'rb') as f:
+            return f.read()
+
+
+    def _downloads(self):
+        return [r for r in _ToolServer.seen if r[0].get('md5') != ['1']]
+
+
+    def test_download_and_reuse(self):
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(self._tarball(), _ToolServer.content)
+        self.assertEqual(len(self._downloads()), 1)
+
+        # unchanged on the server; no new download
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(len(self._downloads()), 1)
+
+        # new version on the server
+        _ToolServer.content = os.urandom(1000)
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(self._tarball(), _ToolServer.content)
+        self.assertEqual(len(self._downloads()), 2)
+
+
+    def test_resume(self):
+        partial = os.path.join(self._tempdir, Coverity._cov_filename + '.part')
+        with open(partial, 'wb') as f:
+            f.write(_ToolServer.content[:Coverity._download_chunk_size])
+        with open(partial + '.md5', 'w') as f:
+            f.write(hashlib.md5(_ToolServer.content).hexdigest() + '\n')
+
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(self._tarball(), _ToolServer.content)
+        self.assertEqual(self._downloads()[0][1], 'bytes=%d-' % (Coverity._download_chunk_size))
+        self.assertFalse(os.path.exists(partial))
+
+
+    def test_stale_partial(self):
+        partial = os.path.join(self._tempdir, Coverity._cov_filename + '.part')
+        with open(partial, 'wb') as f:
+            f.write(b'left over from some other version')
+        with open(partial + '.md5', 'w') as f:
+            f.write('0' * 32 + '\n')
+
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(self._tarball(), _ToolServer.content)
+        self.assertEqual(self._downloads()[0][1], None)
+
+
+    def test_resume_without_md5(self):
+        _ToolServer.md5_available = False
+        partial = os.path.join(self._tempdir, Coverity._cov_filename + '.part')
+        with open(partial, 'wb') as f:
+            f.write(_ToolServer.content[:Coverity._download_chunk_size])
+
+        Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertEqual(self._tarball(), _ToolServer.content)
+        self.assertEqual(self._downloads()[0][1], 'bytes=%d-' % (Coverity._download_chunk_size))
+        self.assertFalse(os.path.exists(partial))
+
+
+    def test_bad_size_without_md5(self):
+        _ToolServer.md5_available = False
+        partial = os.path.join(self._tempdir, Coverity._cov_filename + '.part')
+        with open(partial, 'wb') as f:
+            f.write(b'x' * (len(_ToolServer.content) + 1))
+
+        with self.assertRaises(Exception):
+            Coverity.download_tool(self._logger, self._config, 'token')
+        self.assertFalse(os.path.exists(partial))
+        self.assertFalse(os.path.exists(os.path.join(self._tempdir, Coverity._cov_filename)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+
+import BuildFiler
+import unittest
+import logging
+import fnmatch
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger('Builder.FailedBuildArchiver')
+
+
+class FailedBuildArchiver(object):
+    """Stream a compressed archive of a build tree to a BuildFiler
+
+    A failed build tree can be several GB after make distcheck, most
+    of it object files and libraries that anyone debugging the
+    failure would rebuild anyway.  Files and directories matching one
+    of the exclude patterns are left out of the archive, unless they
+    also match one of the include patterns.  Patterns are fnmatch
+    patterns, matched against both the basename and the path relative
+    to the root of the tree.
+
+    The tar stream is written from a thread into an external,
+    multi-threaded compressor (zstd or pigz, falling back to gzip),
+    and the compressor's output is handed straight to the filer's
+    upload_from_fileobj(), so nothing is written to local disk and the
+    upload (multipart for S3) runs while the tree is still being
+    read.
+
+    """
+
+    default_exclude = ['*.o', '*.lo', '*.obj', '*.a', '*.so', '*.so.*',
+                       '*.dylib', '*.gch', '.git']
+
+    default_include = ['*.log']
+
+    # name : (command, archive suffix), in order of preference
+    compressors = { 'zstd' : (['zstd', '-q', '-c', '-T0', '-3'], '.tar.zst'),
+                    'pigz' : (['pigz', '-c'], '.tar.gz'),
+                    'gzip' : (['gzip', '-c'], '.tar.gz') }
+    compressor_preference = ['zstd', 'pigz', 'gzip']
+
+    def __init__(self, root, compressor=None, exclude=None, include=None):
+        """Create an archiver for the tree at root
+
+        compressor is the name of one of compressors; by default, the
+        first one in compressor_preference that is installed is used.
+        exclude and include default to default_exclude and
+        default_include.
+
+        """
+        self._root = root
+        if compressor == None:
+            for name in self.compressor_preference:
+                if shutil.which(self.compressors[name][0][0]) != None:
+                    compressor = name
+                    break
+            else:
+                raise RuntimeError('None of %s found' % (', '.join(self.compressor_preference)))
+        elif not compressor in self.compressors:
+            raise ValueError('Unknown compressor %s' % (compressor))
+        self._compressor = compressor
+        self._exclude = self.default_exclude if exclude == None else exclude
+        self._include = self.default_include if include == None else include
+        self.stats = { 'compressor' : compressor,
+                       'files' : 0,
+                       'bytes' : 0,
+                       'skipped_files' : 0,
+                       'skipped_bytes' : 0,
+                       'compressed_bytes' : 0,
+                       'seconds' : 0 }
+
+
+    def get_suffix(self):
+        """Archive suffix (.tar.zst, .tar.gz) for the selected compressor"""
+        return self.compressors[self._compressor][1]
+
+
+    def _matches(self, patterns, relpath):
+        basename = os.path.basename(relpath)
+        for pattern in patterns:
+            if fnmatch.fnmatch(basename, pattern) or fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
+
+
+    def is_excluded(self, relpath):
+        """Should the file or directory at relpath be left out?"""
+        return (self._matches(self._exclude, relpath)
+                and not self._matches(self._include, relpath))
+
+
+    def _size(self, pathname):
+        # for the skipped statistics only
+        if os.path.islink(pathname) or not os.path.isdir(pathname):
+            return os.lstat(pathname).st_size
+        total = 0
+        for root, dirs, files in os.walk(pathname):
+            for name in files:
+                total += os.lstat(os.path.join(root, name)).st_size
+        return total
+
+
+    def _skip(self, pathname):
+        self.stats['skipped_files'] += 1
+        try:
+            self.stats['skipped_bytes'] += self._size(pathname)
+        except OSError:
+            pass
+
+
+    def _add(self, tar, pathname, relpath):
+        info = tar.gettarinfo(pathname, arcname=relpath)
+        if info == None:
+            # sockets and other things tar can not store
+            return
+        if info.isreg():
+            with open(pathname, 'rb') as f:
+                tar.addfile(info, f)
+            self.stats['files'] += 1
+            self.stats['bytes'] += info.size
+        else:
+            tar.addfile(info)
+
+
+    def write_tar(self, fileobj):
+        """Write an (uncompressed) tar stream of the tree to fileobj"""
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            for root, dirs, files in os.walk(self._root):
+                for name in sorted(dirs):
+                    pathname = os.path.join(root, name)
+                    relpath = os.path.relpath(pathname, self._root)
+                    if self.is_excluded(relpath):
+                        dirs.remove(name)
+                        self._skip(pathname)
+                        continue
+                    try:
+                        self._add(tar, pathname, relpath)
+                    except OSError as e:
+                        logger.warn("Could not archive %s: %s" % (relpath, str(e)))
+                for name in sorted(files):
+                    pathname = os.path.join(root, name)
+                    relpath = os.path.relpath(pathname, self._root)
+                    if self.is_excluded(relpath):
+                        self._skip(pathname)
+                        continue
+                    try:
+                        self._add(tar, pathname, relpath)
+                    except OSError as e:
+                        # files can vanish or be unreadable in a
+                        # broken build tree; archive what we can.
+                        logger.warn("Could not archive %s: %s" % (relpath, str(e)))
+
+
+    def upload(self, filer, remote_filename):
+        """Archive the tree and upload it to filer as remote_filename
+
+        Returns the stats dictionary (file and byte counts of what was
+        archived and skipped, the compressed size, and the elapsed
+        time).  On failure, any partial upload is deleted and the
+        exception is raised.
+
+        """
+        start_time = time.time()
+        command = self.compressors[self._compressor][0]
+        logger.debug("Archiving %s with %s" % (self._root, ' '.join(command)))
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                bufsize=1024 * 1024)
+        writer_error = []
+
+        def writer():
+            try:
+                self.write_tar(proc.stdin)
+            except Exception as e:
+                writer_error.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        counter = _CountingReader(proc.stdout)
+        try:
+            filer.upload_from_fileobj(counter, remote_filename)
+        except:
+            proc.kill()
+            thread.join()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+        thread.join()
+        returncode = proc.wait()
+
+        if len(writer_error) > 0 or returncode != 0:
+            try:
+                filer.delete(remote_filename)
+            except Exception as e:
+                logger.debug("Could not delete partial upload %s: %s" % (remote_filename, str(e)))
+            if len(writer_error) > 0:
+                raise writer_error[0]
+            raise subprocess.CalledProcessError(returncode, command)
+
+        self.stats['compressed_bytes'] = counter.bytes_read
+        self.stats['seconds'] = round(time.time() - start_time, 3)
+        logger.debug("Archived %d files (%d bytes) into %d bytes in %.1f seconds; skipped %d (%d bytes)" %
+                     (self.stats['files'], self.stats['bytes'], self.stats['compressed_bytes'],
+                      self.stats['seconds'], self.stats['skipped_files'],
+                      self.stats['skipped_bytes']))
+        return self.stats
+
+
+class _CountingReader(object):
+    # The filer reads the compressor output through this so we know
+    # the compressed size without asking the filer.
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.bytes_read = 0
+
+
+    def readable(self):
+        return True
+
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class FailedBuildArchiverTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._tree = os.path.join(self._tempdir, 'tree')
+        for name, data in [('src/foo.c', 'int foo;\n'),
+                           ('src/foo.o', 'x' * 1000),
+                           ('src/.libs/libfoo.so.1', 'x' * 1000),
+                           ('src/.git/HEAD', 'ref\n'),
+                           ('config.log', 'configure: error\n'),
+                           ('test/test-suite.log', 'FAIL\n'),
+                           ('test/ignored.log.o', 'x')]:
+            pathname = os.path.join(self._tree, name)
+            if not os.path.isdir(os.path.dirname(pathname)):
+                os.makedirs(os.path.dirname(pathname))
+            with open(pathname, 'w') as f:
+                f.write(data)
+        # only the tests need the mock filer
+        import MockBuildFiler
+        self._filer = MockBuildFiler.MockBuildFiler()
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def _upload(self, compressor):
+        archiver = FailedBuildArchiver(self._tree, compressor=compressor,
+                                       include=['*.log', 'test/*.o'])
+        stats = archiver.upload(self._filer, 'failed' + archiver.get_suffix())
+        local = os.path.join(self._tempdir, 'failed' + archiver.get_suffix())
+        self._filer.download_to_file('failed' + archiver.get_suffix(), local)
+        if compressor == 'zstd':
+            tarball = local[:-4]
+            subprocess.check_call(['zstd', '-q', '-d', local, '-o', tarball])
+        else:
+            tarball = local
+        with tarfile.open(tarball, 'r') as tar:
+            names = sorted(tar.getnames())
+        return stats, names
+
+
+    def test_upload(self):
+        compressors = ['gzip']
+        if shutil.which('zstd') != None:
+            compressors.append('zstd')
+        for compressor in compressors:
+            stats, names = self._upload(compressor)
+            self.assertEqual(names, ['config.log', 'src', 'src/.libs', 'src/foo.c',
+                                     'test', 'test/ignored.log.o', 'test/test-suite.log'])
+            self.assertEqual(stats['skipped_files'], 3)
+            self.assertEqual(stats['skipped_bytes'], 2004)
+            self.assertEqual(stats['files'], 4)
+
+
+    def test_upload_failure(self):
+        class BrokenFiler(BuildFiler.BuildFiler):
+            def upload_from_fileobj(self, fileobj, remote_filename, properties = {}):
+                fileobj.read(10)
+                raise IOError('connection reset')
+
+        archiver = FailedBuildArchiver(self._tree, compressor='gzip')
+        self.assertRaises(IOError, archiver.upload, BrokenFiler(), 'failed.tar.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+
+import os
+import tempfile
+import shutil
+import unittest
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class MetricsExporter(object):
+    """Collect metrics and write them as an OpenMetrics text file
+
+    Minimal OpenMetrics text format writer, intended for the
+    node_exporter textfile collector (which reads every *.prom file in
+    a directory).  Samples are grouped into metric families, in the
+    order the families were first used.  write_textfile() writes to a
+    temporary file and renames it into place, so the collector never
+    sees a partial file.
+
+    """
+
+    def __init__(self):
+        self._families = {}
+
+
+    def add(self, name, value, labels={}, help=None, metric_type='gauge'):
+        """Add a sample
+
+        Adds a sample with value value and labels labels (a dictionary
+        of label name to value) to the metric family name, creating
+        the family (with the given help text and type) if needed.
+
+        """
+        if not name in self._families:
+            self._families[name] = { 'type' : metric_type,
+                                     'help' : help,
+                                     'samples' : [] }
+        self._families[name]['samples'].append((dict(labels), value))
+
+
+    def render(self):
+        """Return the collected metrics in OpenMetrics text format"""
+        lines = []
+        for name, family in self._families.items():
+            lines.append('# TYPE %s %s' % (name, family['type']))
+            if family['help'] != None:
+                help = family['help'].replace('\\', '\\\\').replace('\n', '\\n')
+                lines.append('# HELP %s %s' % (name, help))
+            for labels, value in family['samples']:
+                if len(labels) > 0:
+                    label_string = ','.join('%s="%s"' % (key, _escape_label_value(labels[key]))
+                                            for key in sorted(labels.keys()))
+                    lines.append('%s{%s} %s' % (name, label_string, _format_value(value)))
+                else:
+                    lines.append('%s %s' % (name, _format_value(value)))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+    def write_textfile(self, filename):
+        """Atomically replace filename with the collected metrics"""
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.',
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_filename, 0o644)
+            os.rename(tmp_filename, filename)
+        except:
+            os.remove(tmp_filename)
+            raise
+
+
+class MetricsExporterTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def test_render(self):
+        exporter = MetricsExporter()
+        exporter.add('nightly_build_result', 1,
+                     { 'branch' : 'main', 'result' : 'SUCCESS' },
+                     help='Result of the last build')
+        exporter.add('nightly_build_result', 0,
+                     { 'branch' : 'main', 'result' : 'FAILED' })
+        exporter.add('nightly_build_run_duration_seconds', 12.5)
+        exporter.add('nightly_build_label_test', True, { 'name' : 'a "quoted"\\name' })
+        self.assertEqual(exporter.render(),
+                         '# TYPE nightly_build_result gauge\n'
+                         '# HELP nightly_build_result Result of the last build\n'
+                         'nightly_build_result{branch="main",result="SUCCESS"} 1\n'
+                         'nightly_build_result{branch="main",result="FAILED"} 0\n'
+                         '# TYPE nightly_build_run_duration_seconds gauge\n'
+                         'nightly_build_run_duration_seconds 12.5\n'
+                         '# TYPE nightly_build_label_test gauge\n'
+                         'nightly_build_label_test{name="a \\"quoted\\"\\\\name"} 1\n'
+                         '# EOF\n')
+
+
+    def test_write_textfile(self):
+        filename = os.path.join(self._tempdir, 'metrics', 'nightly.prom')
+        exporter = MetricsExporter()
+        exporter.add('nightly_build_run_duration_seconds', 1)
+        exporter.write_textfile(filename)
+        exporter.write_textfile(filename)
+        self.assertEqual(os.listdir(os.path.dirname(filename)), ['nightly.prom'])
+        with open(filename, 'r') as f:
+            self.assertEqual(f.read(), exporter.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+
+import BuilderUtils
+import unittest
+import logging
+import os
+import re
+import shutil
+import tempfile
+from git import Repo
+
+
+logger = logging.getLogger('Builder.MirrorCache')
+
+
+class MirrorCache(object):
+    """Local bare mirrors of remote git repositories
+
+    Keeps a `git clone --mirror` of every repository the builder
+    clones (including submodules) under cache_path, so that branch
+    checkouts can use the mirror as a --reference instead of pulling
+    the full history over the network every time.  Each mirror is
+    fetched at most once per run_id; every process that shares a run
+    id (such as the children of a parallel Builder run) will reuse
+    that fetch.  Mirrors are protected by a lock file next to the
+    mirror, so that nightly scripts for different projects can share
+    a cache.
+
+    """
+
+    def __init__(self, cache_path, run_id):
+        self._cache_path = cache_path
+        self._run_id = str(run_id)
+        if not os.path.exists(self._cache_path):
+            os.makedirs(self._cache_path)
+
+
+    def mirror_path(self, url):
+        """Path of the mirror for url
+
+        Mirrors are named after the URL (minus the scheme), so that a
+        human poking around the cache directory can tell what's what.
+
+        """
+        name = re.sub(r'^[a-z+]+://', '', url.rstrip('/'))
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', name)
+        if not name.endswith('.git'):
+            name += '.git'
+        return os.path.join(self._cache_path, name)
+
+
+    def lock(self, url, shared=False):
+        """Lock the mirror for url
+
+        Take the lock shared while reading from the mirror (cloning
+        with --reference), so that a fetch from another process does
+        not run underneath the clone.
+
+        """
+        return BuilderUtils.file_lock(self.mirror_path(url) + '.lock', shared=shared)
+
+
+    def update(self, url):
+        """Create or refresh the mirror for url
+
+        Creates the mirror if it does not exist yet, or fetches into
+        it if it has not already been fetched during this run.
+        Returns the path to the mirror.
+
+        """
+        path = self.mirror_path(url)
+        stamp_file = os.path.join(path, 'nightly-fetch-run')
+        with self.lock(url):
+            if os.path.isdir(path):
+                if os.path.exists(stamp_file):
+                    with open(stamp_file, 'r') as stamp:
+                        if stamp.read().strip() == self._run_id:
+                            logger.debug("-> mirror %s already fetched this run" % (path))
+                            return path
+                logger.debug("-> fetching mirror %s" % (path))
+                Repo(path).git.remote('update', '--prune')
+            else:
+                # clone to a temporary name so that an interrupted
+                # clone does not leave a broken mirror behind.
+                logger.debug("-> creating mirror %s from %s" % (path, url))
+                tmp_path = path + '.tmp'
+                if os.path.exists(tmp_path):
+                    shutil.rmtree(tmp_path)
+                Repo.clone_from(url, tmp_path, mirror=True)
+                os.rename(tmp_path, path)
+            with open(stamp_file, 'w') as stamp:
+                stamp.write(self._run_id + '\n')
+        return path
+
+
+class MirrorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._origin_path = os.path.join(self._tempdir, 'origin')
+        self._origin = Repo.init(self._origin_path)
+        self._commit('first')
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def _commit(self, message):
+        filename = os.path.join(self._origin_path, 'file.txt')
+        with open(filename, 'w') as f:
+            f.write(message + '\n')
+        self._origin.index.add([filename])
+        return self._origin.index.commit(message).hexsha
+
+
+    def test_mirror_path(self):
+        cache = MirrorCache(os.path.join(self._tempdir, 'cache'), 1)
+        path = cache.mirror_path('https://github.com/open-mpi/ompi.git')
+        self.assertEqual(os.path.basename(path), 'github.com_open-mpi_ompi.git')
+
+
+    def test_fetch_once_per_run(self):
+        cache_path = os.path.join(self._tempdir, 'cache')
+        cache = MirrorCache(cache_path, 1)
+        path = cache.update(self._origin_path)
+        first = self._origin.head.commit.hexsha
+        self.assertEqual(Repo(path).head.commit.hexsha, first)
+
+        # same run: the mirror should not be fetched again
+        second = self._commit('second')
+        cache.update(self._origin_path)
+        self.assertEqual(Repo(path).head.commit.hexsha, first)
+
+        # new run: the mirror should pick up the new commit
+        cache = MirrorCache(cache_path, 2)
+        cache.update(self._origin_path)
+        self.assertEqual(Repo(path).head.commit.hexsha, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@
 # Additional copyrights may follow
 
 import BuildFiler
+import hashutils
 import unittest
 import logging
 import time
@@ -30,9 +31,11 @@ class MockBuildFiler(BuildFiler.BuildFiler):
 
     def __init__(self, basename=None, clean_on_delete=True):
         logger.debug("-> creating LocalBuildFiler")
+        super(MockBuildFiler, self).__init__()
         testtime = str(time.time())
         self._stream_map = { }
         self._file_map = { }
+        self._properties = { }
         if basename == None:
             self._basename = tempfile.mkdtemp()
         else:
@@ -58,7 +61,10 @@ class MockBuildFiler(BuildFiler.BuildFiler):
         """
         logger.debug("-> downloading to stream: " + filename)
         pathname = os.path.join(self._basename, filename)
-        return open(pathname, "r")
+        stream = open(pathname, "r")
+        self.record_request('download_to_stream',
+                            downloaded_bytes=os.fstat(stream.fileno()).st_size)
+        return stream
 
 
     def upload_from_stream(self, filename, data, properties = {}):
@@ -76,6 +82,8 @@ class MockBuildFiler(BuildFiler.BuildFiler):
             os.makedirs(dirname)
         with open(pathname, "w") as text_file:
             text_file.write(data)
+        self._properties[filename] = dict(properties)
+        self.record_request('upload_from_stream', uploaded_bytes=len(data))
 
 
     def download_to_file(self, remote_filename, local_filename):
@@ -90,6 +98,8 @@ class MockBuildFiler(BuildFiler.BuildFiler):
                      + " local: " + local_filename)
         remote_pathname = os.path.join(self._basename, remote_filename)
         shutil.copyfile(remote_pathname, local_filename)
+        self.record_request('download_to_file',
+                            downloaded_bytes=os.path.getsize(local_filename))
 
 
     def upload_from_file(self, local_filename, remote_filename, properties = {}):
@@ -104,6 +114,54 @@ class MockBuildFiler(BuildFiler.BuildFiler):
         if not os.access(dirname, os.F_OK):
             os.makedirs(dirname)
         shutil.copyfile(local_filename, remote_pathname)
+        self._properties[remote_filename] = dict(properties)
+        self.record_request('upload_from_file',
+                            uploaded_bytes=os.path.getsize(local_filename))
+
+
+    def upload_from_fileobj(self, fileobj, remote_filename, properties = {}):
+        """Upload from a file object
+
+        Copy everything read from fileobj to basename/remote_filename.
+        """
+        logger.debug("-> uploading from file object, remote: " + remote_filename)
+        remote_pathname = os.path.join(self._basename, remote_filename)
+        dirname = os.path.dirname(remote_pathname)
+        if not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        with open(remote_pathname, "wb") as remote_file:
+            shutil.copyfileobj(fileobj, remote_file)
+            uploaded_bytes = remote_file.tell()
+        self._properties[remote_filename] = dict(properties)
+        self.record_request('upload_from_fileobj', uploaded_bytes=uploaded_bytes)
+
+
+    def get_properties(self, filename):
+        """Get the properties the object was uploaded with
+
+        Properties are only kept in memory, so objects uploaded by
+        another instance have none.
+        """
+        pathname = os.path.join(self._basename, filename)
+        self.record_request('get_properties')
+        if not os.path.exists(pathname):
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        return dict(self._properties.get(filename, {}))
+
+
+    def copy(self, source_filename, remote_filename, properties = {}):
+        """Copy basename/source_filename to basename/remote_filename"""
+        logger.debug("-> copying %s to %s" % (source_filename, remote_filename))
+        source_pathname = os.path.join(self._basename, source_filename)
+        if not os.path.exists(source_pathname):
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), source_filename)
+        remote_pathname = os.path.join(self._basename, remote_filename)
+        dirname = os.path.dirname(remote_pathname)
+        if not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        shutil.copyfile(source_pathname, remote_pathname)
+        self._properties[remote_filename] = dict(properties)
+        self.record_request('copy')
 
 
     def delete(self, filename):
@@ -115,8 +173,11 @@ class MockBuildFiler(BuildFiler.BuildFiler):
 
         """
         logger.debug("-> deleting build history " + filename)
+        self.forget_dedup(filename)
         pathname = os.path.join(self._basename, filename)
         os.remove(pathname)
+        self._properties.pop(filename, None)
+        self.record_request('delete')
 
 
     def file_search(self, dirname, blob):
@@ -127,6 +188,7 @@ class MockBuildFiler(BuildFiler.BuildFiler):
         """
         remote_pathname = os.path.join(self._basename, dirname, blob)
         retval = glob.glob(remote_pathname)
+        self.record_request('file_search')
         logger.debug("retval: %s" % (str(retval)))
         return retval
 
@@ -156,6 +218,21 @@ class MockBuildFilerTest(unittest.TestCase):
             self.fail()
 
 
+    def test_request_stats(self):
+        filer = MockBuildFiler()
+        filer.upload_from_stream("foo/stats.txt", "12345")
+        filer.download_to_stream("foo/stats.txt").close()
+        filer.file_search("foo", "*.txt")
+        stats = filer.get_request_stats()
+        self.assertEqual(stats['requests'], { 'upload_from_stream' : 1,
+                                              'download_to_stream' : 1,
+                                              'file_search' : 1 })
+        self.assertEqual(stats['uploaded_bytes'], 5)
+        self.assertEqual(stats['downloaded_bytes'], 5)
+        filer.reset_request_stats()
+        self.assertEqual(filer.get_request_stats()['requests'], {})
+
+
     def test_stream_read_write(self):
         filename = "foo/test-abc.txt"
         input_string = "I love me some unit tests.\n"
@@ -180,6 +257,70 @@ class MockBuildFilerTest(unittest.TestCase):
             self.fail()
 
 
+    def test_file_hashed_write(self):
+        remote_filename = "foo/test-hashed.txt"
+        pathname = os.path.join(self._tempdir, "foobar.txt")
+        input_string = "I love me some unit tests.\n"
+        filer = MockBuildFiler()
+
+        with open(pathname, "w") as text_file:
+            text_file.write(input_string)
+        hashes = filer.upload_from_file_with_hashes(pathname, remote_filename)
+        self.assertEqual(hashes, hashutils.compute_hashes(pathname))
+
+        body = filer.download_to_stream(remote_filename)
+        output_string = body.read()
+        filer.delete(remote_filename)
+        self.assertEqual(input_string, output_string,
+                         input_string + " != " + output_string)
+
+
+    def test_dedup(self):
+        pathname = os.path.join(self._tempdir, "dedup.txt")
+        with open(pathname, "w") as text_file:
+            text_file.write("I love me some unit tests.\n")
+        index_file = os.path.join(self._tempdir, "dedup-index.json")
+        filer = MockBuildFiler()
+        filer.enable_dedup(index_file)
+
+        hashes = filer.upload_from_file_with_hashes(pathname, "foo/a.txt")
+        self.assertEqual(hashes, hashutils.compute_hashes(pathname))
+        # same name and content: nothing to do (known from the index)
+        filer.upload_from_file_with_hashes(pathname, "foo/a.txt")
+        # same content, new name: remote copy
+        filer.upload_from_file_with_hashes(pathname, "bar/a.txt")
+        stats = filer.get_request_stats()
+        self.assertEqual(stats['requests'].get('upload_from_fileobj'), 1)
+        self.assertEqual(stats['requests'].get('copy'), 1)
+        self.assertEqual(stats['dedup_hits'], 2)
+        self.assertEqual(stats['dedup_saved_bytes'], 2 * os.path.getsize(pathname))
+        with open(os.path.join(filer._basename, "bar/a.txt"), "r") as f:
+            self.assertEqual(f.read(), "I love me some unit tests.\n")
+
+        # a deleted object is dropped from the index, and re-uploaded
+        filer.delete("foo/a.txt")
+        filer.delete("bar/a.txt")
+        filer.upload_from_file_with_hashes(pathname, "foo/a.txt")
+        self.assertEqual(filer.get_request_stats()['requests'].get('upload_from_fileobj'), 2)
+
+
+    def test_download_many(self):
+        filer = MockBuildFiler()
+        filenames = []
+        for i in range(10):
+            filename = "foo/test-%d.txt" % (i)
+            filer.upload_from_stream(filename, "test %d\n" % (i))
+            filenames.append(filename)
+        filenames.append("foo/file-that-should-not-exist.txt")
+
+        streams, errors = filer.download_many_to_streams(filenames, max_workers=4)
+        self.assertEqual(len(streams), 10)
+        for i in range(10):
+            self.assertEqual(streams["foo/test-%d.txt" % (i)].read(), "test %d\n" % (i))
+        self.assertEqual(list(errors.keys()), ["foo/file-that-should-not-exist.txt"])
+        self.assertEqual(errors["foo/file-that-should-not-exist.txt"].errno, errno.ENOENT)
+
+
     def test_file_bad_get(self):
         pathname = os.path.join(self._tempdir, "foobar.txt")
 
@@ -7,6 +7,7 @@
 
 import Builder
 import S3BuildFiler
+import AutogenCache
 import os
 import re
 import shutil
@@ -25,6 +26,9 @@ class OMPIBuilder(Builder.Builder):
 
     """
 
+    # tools whose versions are part of the autogen cache key
+    autotools_programs = ['autoconf', 'automake', 'libtoolize', 'm4']
+
     def update_version_file(self):
         """Update version file in the OMPI/PMIx way
 
@@ -77,8 +81,8 @@ class OMPIBuilder(Builder.Builder):
             child_env = os.environ.copy()
             child_env['USER'] = self._config['project_very_short_name'] + 'builder'
 
-            self.call([self._config['autogen']], build_call=True, env=child_env)
-            self.call(['./configure'], build_call=True, env=child_env)
+            self.run_autogen(child_env)
+            self.run_configure(['./configure'], build_call=True, env=child_env)
 
             # Do make distcheck (which will invoke config/distscript.csh to set
             # the right values in VERSION).  distcheck does many things; we need
@@ -88,24 +92,72 @@ class OMPIBuilder(Builder.Builder):
             # setup, we don't.  But be advised that this may need to change in the
             # future...
             child_env['LD_LIBRARY_PATH'] = ''
-            self.call(['make', 'distcheck'], build_call=True, env=child_env)
+            self.run_distcheck(['make', 'distcheck'], build_call=True, env=child_env)
         finally:
             os.chdir(cwd)
 
 
+    def run_autogen(self, env):
+        """Run config['autogen'] in the source tree, or restore its output
+
+        If config['autogen_cache'] is set (a dictionary, which may
+        contain 'path', 'max_size' in bytes, and 'refresh_command'),
+        autogen outputs are cached by AutogenCache, keyed by the
+        committed files of the source tree other than plain source
+        code and the versions of the tools in autotools_programs.  On
+        a cache hit, autogen is not run; instead, the refresh command
+        (default: autoconf --force) regenerates configure, which
+        embeds the nightly version string from the VERSION file.
+        Must be called from the top of the source tree.
+
+        """
+        cache_config = self._config.get('autogen_cache')
+        if cache_config == None:
+            self.call([self._config['autogen']], build_call=True, env=env)
+            return
+
+        source_tree = self._current_build['source_tree']
+        cache = AutogenCache.AutogenCache(cache_config.get('path',
+                                                           os.path.join(self._config['scratch_path'],
+                                                                        'autogen-cache')),
+                                          cache_config.get('max_size', 4 * 1024 * 1024 * 1024))
+        extra = [self._config['autogen'], env.get('USER', '')]
+        extra.extend(self.get_tool_versions(self.autotools_programs, env))
+        key = cache.compute_key(source_tree, extra)
+
+        try:
+            hit = cache.restore(key, source_tree)
+        except Exception as e:
+            self._logger.warn("Could not restore autogen output %s: %s" % (key, str(e)))
+            hit = False
+        if hit:
+            self._logger.info("Autogen cache hit (%s)" % (key))
+            self._current_build['autogen_cache'] = 'hit'
+            self.call(cache_config.get('refresh_command', ['autoconf', '--force']),
+                      log_name='autogen-cache-refresh', build_call=True, env=env)
+            return
+
+        self._logger.info("Autogen cache miss (%s)" % (key))
+        self._current_build['autogen_cache'] = 'miss'
+        before = cache.snapshot(source_tree)
+        self.call([self._config['autogen']], build_call=True, env=env)
+        try:
+            cache.store(key, source_tree, before)
+        except Exception as e:
+            self._logger.warn("Could not store autogen output %s: %s" % (key, str(e)))
+
+
     def call(self, args, log_name=None, build_call=False, env=None):
         """OMPI wrapper around call
 
         Add wrapper to properly set up autotools for OMPI/PMIx/hwloc,
         then call the base Builder.call()
         """
+        wrapper_args = None
         if build_call:
             run_with_autotools = os.path.join(self._config['builder_tools'], 'run-with-autotools.sh')
-            full_args = [run_with_autotools, 'autotools/%s-%s' %
-                         (self._config['project_very_short_name'], self._current_build['branch_name'])]
-            full_args.extend(args)
+            wrapper_args = [run_with_autotools, 'autotools/%s-%s' %
+                            (self._config['project_very_short_name'], self._current_build['branch_name'])]
             if log_name == None:
                 log_name = os.path.basename(args[0])
-        else:
-            full_args = args
-        super(OMPIBuilder, self).call(full_args, log_name, env=env)
+        super(OMPIBuilder, self).call(args, log_name, env=env, wrapper_args=wrapper_args)
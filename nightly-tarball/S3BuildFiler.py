@@ -7,6 +7,7 @@
 #
 
 import BuildFiler
+import hashutils
 import unittest
 import logging
 import boto3
@@ -30,12 +31,24 @@ class S3BuildFiler(BuildFiler.BuildFiler):
 
     """
 
-    def __init__(self, Bucket, Basename):
-        logger.debug("-> creating S3BuildFiler with bucket_name=", Bucket,
-                     " base_name=", Basename)
+    def __init__(self, Bucket, Basename, Client=None):
+        """Create an S3BuildFiler
+
+        Client is an existing boto3 S3 client to use.  Creating a
+        client is not free (credential lookup, endpoint setup), so a
+        long-running process filing for several projects should share
+        one; boto3 clients are thread safe.  By default, a new client
+        is created.
+
+        """
+        logger.debug("-> creating S3BuildFiler with bucket_name=%s base_name=%s" %
+                     (Bucket, Basename))
+        super(S3BuildFiler, self).__init__()
         self._bucket = Bucket
         self._basename = Basename
-        self._s3 = boto3.client('s3')
+        if Client == None:
+            Client = boto3.client('s3')
+        self._s3 = Client
 
 
     def download_to_stream(self, filename):
@@ -50,6 +63,7 @@ class S3BuildFiler(BuildFiler.BuildFiler):
         key = self._basename + filename
         try:
             response = self._s3.get_object(Bucket=self._bucket, Key=key)
+            self.record_request('get_object', downloaded_bytes=response.get('ContentLength', 0))
         except botocore.exceptions.ClientError as e:
             code = e.response['Error']['Code']
             if code == "NoSuchKey" or code == "NoSuchBucket":
@@ -75,6 +89,7 @@ class S3BuildFiler(BuildFiler.BuildFiler):
                                     Metadata=properties)
             else:
                 self._s3.put_object(Bucket=self._bucket, Key=key, Body=data)
+            self.record_request('put_object', uploaded_bytes=len(data))
         except botocore.exceptions.ClientError as e:
             code = e.response['Error']['Code']
             if code == "NoSuchBucket":
@@ -95,6 +110,8 @@ class S3BuildFiler(BuildFiler.BuildFiler):
         key = self._basename + remote_filename
         try:
             self._s3.download_file(self._bucket, key, local_filename)
+            self.record_request('download_file',
+                                downloaded_bytes=os.path.getsize(local_filename))
         except botocore.exceptions.ClientError as e:
             code = e.response['Error']['Code']
             if code == "NoSuchKey" or code == "NoSuchBucket" or code == "404":
@@ -114,6 +131,37 @@ class S3BuildFiler(BuildFiler.BuildFiler):
         key = self._basename + remote_filename
         try:
             self._s3.upload_file(local_filename, self._bucket, key)
+            self.record_request('upload_file',
+                                uploaded_bytes=os.path.getsize(local_filename))
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "NoSuchBucket":
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT),
+                              remote_filename)
+            else:
+                raise
+
+
+    def upload_from_fileobj(self, fileobj, remote_filename, properties = {}):
+        """Upload from a file object
+
+        Upload everything read from fileobj to S3 as
+        basename/remote_filename.  boto3 switches to a multipart
+        upload for large objects; either way, a non-seekable fileobj
+        is read exactly once, in order.
+
+        """
+        logger.debug("-> uploading from file object, remote: " + remote_filename)
+        key = self._basename + remote_filename
+        # hashing reader with no algorithms, just to count bytes
+        reader = hashutils.HashingReader(fileobj, [])
+        try:
+            if len(properties) > 0:
+                self._s3.upload_fileobj(reader, self._bucket, key,
+                                        ExtraArgs={'Metadata' : properties})
+            else:
+                self._s3.upload_fileobj(reader, self._bucket, key)
+            self.record_request('upload_fileobj', uploaded_bytes=reader.bytes_read)
         except botocore.exceptions.ClientError as e:
             code = e.response['Error']['Code']
             if code == "NoSuchBucket":
@@ -123,6 +171,47 @@ class S3BuildFiler(BuildFiler.BuildFiler):
                 raise
 
 
+    def get_properties(self, filename):
+        """Get the user metadata of basename/filename"""
+        logger.debug("-> getting properties of: " + filename)
+        key = self._basename + filename
+        try:
+            response = self._s3.head_object(Bucket=self._bucket, Key=key)
+            self.record_request('head_object')
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "NoSuchKey" or code == "NoSuchBucket" or code == "404":
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+            else:
+                raise
+        return response.get('Metadata', {})
+
+
+    def copy(self, source_filename, remote_filename, properties = {}):
+        """Copy basename/source_filename to basename/remote_filename
+
+        The copy happens inside S3 (multipart for large objects), so
+        no data is transferred through this host.  The new object
+        gets properties as its metadata.
+
+        """
+        logger.debug("-> copying %s to %s" % (source_filename, remote_filename))
+        source = { 'Bucket' : self._bucket,
+                   'Key' : self._basename + source_filename }
+        key = self._basename + remote_filename
+        try:
+            self._s3.copy(source, self._bucket, key,
+                          ExtraArgs={ 'Metadata' : properties,
+                                      'MetadataDirective' : 'REPLACE' })
+            self.record_request('copy_object')
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "NoSuchKey" or code == "NoSuchBucket" or code == "404":
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), source_filename)
+            else:
+                raise
+
+
     def delete(self, filename):
         """Delete file
 
@@ -133,9 +222,11 @@ class S3BuildFiler(BuildFiler.BuildFiler):
 
         """
         logger.debug("-> deleting file: " + filename)
+        self.forget_dedup(filename)
         key = self._basename + filename
         try:
             self._s3.delete_object(Bucket=self._bucket, Key=key)
+            self.record_request('delete_object')
         except botocore.exceptions.ClientError as e:
             code = e.response['Error']['Code']
             if code == "NoSuchKey" or code == "NoSuchBucket":
@@ -161,6 +252,7 @@ class S3BuildFiler(BuildFiler.BuildFiler):
         regex = re.sub('\*', '.*', regex)
         retval = []
         results = self._s3.list_objects(Bucket=self._bucket, Prefix=full_prefix)
+        self.record_request('list_objects')
         if not 'Contents' in results:
             return []
         blobs = results['Contents']
@@ -220,6 +312,29 @@ class S3BuildFilerTest(unittest.TestCase):
                          input_string + " != " + output_string)
 
 
+    def test_file_hashed_write(self):
+        remote_filename = "cleaned-nightly/" + self._testtime + "/test-hashed.txt"
+        pathname = "/tmp/test-hashed-" + self._testtime + ".txt"
+        input_string = "I love me some unit tests.\n"
+
+        filer = S3BuildFiler(self._bucket, self._basename)
+        with open(pathname, "w") as text_file:
+            text_file.write(input_string)
+        hashes = filer.upload_from_file_with_hashes(pathname, remote_filename)
+        expected = hashutils.compute_hashes(pathname)
+        os.remove(pathname)
+
+        try:
+            body = filer.download_to_stream(remote_filename)
+            output_string = body.read()
+        finally:
+            filer.delete(remote_filename)
+
+        self.assertEqual(hashes, expected)
+        self.assertEqual(input_string, output_string,
+                         input_string + " != " + output_string)
+
+
     def test_file_bad_get(self):
         pathname = "/tmp/test-" + self._testtime + ".txt"
 
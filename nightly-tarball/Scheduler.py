@@ -0,0 +1,434 @@
+#
+# Copyright (c) 2026      Amazon.com, Inc. or its affiliates.  All Rights
+#                         Reserved.
+#
+# Additional copyrights may follow
+#
+
+import Builder
+import BuilderUtils
+import MirrorCache
+import unittest
+import importlib.machinery
+import importlib.util
+import logging
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import types
+from git import Git, exc
+
+
+logger = logging.getLogger('Builder.Scheduler')
+
+
+def load_project(script):
+    """Load a *-nightly-tarball script as a module
+
+    The scripts only build when run as __main__, so loading one just
+    defines its config_data and create_builder().
+
+    """
+    name = 'nightly_' + os.path.basename(script).replace('-', '_')
+    loader = importlib.machinery.SourceFileLoader(name, script)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class Scheduler(object):
+    """Build projects when their branches change
+
+    Long-running replacement for running every *-nightly-tarball
+    script from cron.  Each project is a module (see load_project())
+    with a config_data dictionary and a create_builder(config,
+    s3_client, args, mirror_cache) function.  Every branch is polled
+    with git ls-remote (one call per project covers all of its
+    branches) every poll_interval seconds, which a branch can
+    override with a 'poll_interval' key in its config.  When the head
+    of a branch moved since it was last built, the project's builder
+    is run for just the changed branches, so the usual email and
+    reports only cover those.  A failed build is retried after
+    retry_interval seconds or when triggered.  Builds run one project at a time; use
+    max_parallel_builds / job_slots in the project config for
+    parallelism within a project.  Every build gets a new jobserver
+    sized by its own project's job_slots.
+
+    Builders share one S3 client and, during a pass, one MirrorCache,
+    so a repository used by several projects (like a submodule) is
+    fetched once per pass.  The head revisions last built are kept in
+    state_path, so a restart does not rebuild everything.
+
+    A push hook can ask for an immediate poll by creating a file in
+    <state_path>/triggers named after the project short name (all
+    branches) or <project short name>@<branch>.  The directory is
+    checked every trigger_check_interval seconds.
+
+    """
+
+    _base_options = { 'poll_interval' : 900,
+                      'retry_interval' : 24 * 3600,
+                      'trigger_check_interval' : 10,
+                      'mirror_path' : None }
+
+    def __init__(self, config, projects, s3_client=None):
+        """Create a scheduler
+
+        config must have a 'state_path'.  projects is a list of
+        project modules.  s3_client is passed to every
+        create_builder().
+
+        """
+        self._config = self._base_options.copy()
+        self._config.update(config)
+        self._projects = {}
+        for project in projects:
+            self._projects[project.config_data['project_short_name']] = project
+        self._s3_client = s3_client
+        self._state_file = os.path.join(self._config['state_path'], 'scheduler-state.json')
+        self._trigger_path = os.path.join(self._config['state_path'], 'triggers')
+        if not os.path.exists(self._trigger_path):
+            os.makedirs(self._trigger_path)
+        self._state = self._load_state()
+
+
+    def _load_state(self):
+        try:
+            with open(self._state_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _save_state(self):
+        tmp_file = self._state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._state, f)
+        os.rename(tmp_file, self._state_file)
+
+
+    def _branch_state(self, project_name, branch_name):
+        return self._state.setdefault(project_name, {}).setdefault(branch_name, {})
+
+
+    def get_poll_interval(self, project_name, branch_name):
+        """Seconds between polls of a branch"""
+        branch_config = self._projects[project_name].config_data['branches'][branch_name]
+        return branch_config.get('poll_interval', self._config['poll_interval'])
+
+
+    def get_triggers(self):
+        """Consume the trigger files
+
+        Returns a set of (project, branch) tuples, with None as the
+        branch for a trigger of the whole project.
+
+        """
+        triggers = set()
+        for name in os.listdir(self._trigger_path):
+            try:
+                os.remove(os.path.join(self._trigger_path, name))
+            except FileNotFoundError:
+                continue
+            project_name, sep, branch_name = name.partition('@')
+            if not project_name in self._projects:
+                logger.warn("Ignoring trigger for unknown project %s" % (name))
+                continue
+            triggers.add((project_name, branch_name if sep != '' else None))
+        return triggers
+
+
+    def get_remote_heads(self, repository):
+        """Map of branch name to head revision of a remote repository
+
+        Returns None if the remote could not be listed.
+        """
+        try:
+            output = Git().ls_remote('--heads', repository)
+        except exc.GitCommandError as e:
+            logger.warn("Could not list remote refs of %s: %s" % (repository, str(e)))
+            return None
+        heads = {}
+        for line in output.splitlines():
+            revision, ref = line.split(None, 1)
+            heads[ref[len('refs/heads/'):]] = revision
+        return heads
+
+
+    def poll_project(self, project_name, now, triggers=set()):
+        """Find the branches of a project that need a build
+
+        Polls the branches that are due (or triggered) and returns a
+        dictionary of branch name to new head revision for those
+        whose head is not the one last built.  A head whose build
+        failed is retried after retry_interval seconds (like the next
+        cron run would), or right away if the branch was triggered.
+
+        """
+        config = self._projects[project_name].config_data
+        due = []
+        triggered = []
+        for branch_name in config['branches']:
+            state = self._branch_state(project_name, branch_name)
+            if (project_name, None) in triggers or (project_name, branch_name) in triggers:
+                triggered.append(branch_name)
+                due.append(branch_name)
+            elif now - state.get('last_poll', 0) >= self.get_poll_interval(project_name, branch_name):
+                due.append(branch_name)
+        if len(due) == 0:
+            return {}
+
+        # count a failed poll as a poll, so an unreachable remote is
+        # retried after the poll interval, not in a busy loop
+        for branch_name in due:
+            self._branch_state(project_name, branch_name)['last_poll'] = now
+        heads = self.get_remote_heads(config['repository'])
+        if heads == None:
+            return {}
+        changed = {}
+        for branch_name in due:
+            state = self._branch_state(project_name, branch_name)
+            if not branch_name in heads:
+                logger.warn("%s: branch %s not found on remote" % (project_name, branch_name))
+            elif heads[branch_name] == state.get('revision'):
+                continue
+            elif (heads[branch_name] == state.get('failed_revision')
+                  and not branch_name in triggered
+                  and now - state['failed_time'] < self._config['retry_interval']):
+                continue
+            else:
+                changed[branch_name] = heads[branch_name]
+        return changed
+
+
+    def build_project(self, project_name, changed, mirror_cache):
+        """Run the builder of a project for the changed branches"""
+        project = self._projects[project_name]
+        config = dict(project.config_data)
+        config['branches'] = dict((branch_name, project.config_data['branches'][branch_name])
+                                  for branch_name in changed)
+        logger.info("Building %s branches %s" % (project_name, ', '.join(sorted(changed))))
+        if not config.get('use_mirror_cache', True):
+            mirror_cache = None
+        # let the builder set up a jobserver from this project's
+        # job_slots, rather than inherit one from an earlier build
+        # (which may also have lost tokens to a killed make)
+        BuilderUtils.set_jobserver(None)
+        try:
+            builder = project.create_builder(config, s3_client=self._s3_client, args=[],
+                                             mirror_cache=mirror_cache)
+            try:
+                results = builder.run()
+            finally:
+                builder.close()
+        finally:
+            jobserver = BuilderUtils.get_jobserver()
+            BuilderUtils.set_jobserver(None)
+            if jobserver != None:
+                jobserver.close()
+        # only a published (or already published) revision counts as
+        # built; see poll_project() for when failures are retried.  A
+        # branch with no result never ran (an earlier build threw an
+        # exception), so leave it for the next poll.
+        for branch_name, revision in changed.items():
+            state = self._branch_state(project_name, branch_name)
+            result = results.get(branch_name)
+            if result in [Builder.Builder.BuildResult.SUCCESS, Builder.Builder.BuildResult.SKIPPED]:
+                state['revision'] = revision
+                state.pop('failed_revision', None)
+                state.pop('failed_time', None)
+            elif result != None:
+                state['failed_revision'] = revision
+                state['failed_time'] = time.time()
+        self._save_state()
+
+
+    def run_once(self, triggers=set()):
+        """Poll every due branch and build what changed
+
+        Returns the number of projects built.
+        """
+        now = time.time()
+        mirror_cache = None
+        built = 0
+        for project_name in sorted(self._projects.keys()):
+            changed = self.poll_project(project_name, now, triggers)
+            self._save_state()
+            if len(changed) == 0:
+                continue
+            if mirror_cache == None:
+                mirror_cache = self.get_mirror_cache(now)
+            try:
+                self.build_project(project_name, changed, mirror_cache)
+                built += 1
+            except Exception as e:
+                logger.error("Build of %s failed: %s" % (project_name, str(e)))
+        return built
+
+
+    def get_mirror_cache(self, now):
+        """MirrorCache shared by every build of one pass
+
+        A new run id per pass means every mirror is fetched at most
+        once per pass, however many projects use it.
+        """
+        mirror_path = self._config['mirror_path']
+        if mirror_path == None:
+            for project in self._projects.values():
+                if not project.config_data.get('use_mirror_cache', True):
+                    continue
+                mirror_path = os.path.join(os.path.expandvars(project.config_data['scratch_path']),
+                                           'mirrors')
+                break
+            else:
+                return None
+        return MirrorCache.MirrorCache(mirror_path, 'scheduler-%d-%d' % (os.getpid(), int(now)))
+
+
+    def next_poll_time(self):
+        """Time at which the next branch is due for a poll"""
+        next_time = None
+        for project_name, project in self._projects.items():
+            for branch_name in project.config_data['branches']:
+                state = self._branch_state(project_name, branch_name)
+                due = state.get('last_poll', 0) + self.get_poll_interval(project_name, branch_name)
+                if next_time == None or due < next_time:
+                    next_time = due
+        return next_time
+
+
+    def run(self):
+        """Run forever"""
+        logger.info("Scheduling projects %s" % (', '.join(sorted(self._projects.keys()))))
+        triggers = set()
+        while True:
+            self.run_once(triggers)
+            triggers = set()
+            while len(triggers) == 0 and time.time() < self.next_poll_time():
+                time.sleep(min(self._config['trigger_check_interval'],
+                               max(0, self.next_poll_time() - time.time())))
+                triggers = self.get_triggers()
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._repo = os.path.join(self._tempdir, 'repo')
+        os.makedirs(self._repo)
+        self._git('init', '-q', '-b', 'main')
+        self._commit()
+        self._git('branch', 'v1')
+        self._builds = []
+        self._failing = set()
+        self._not_run = set()
+
+        builds = self._builds
+        failing = self._failing
+        not_run = self._not_run
+        jobservers = self._jobservers = []
+        class FakeBuilder(object):
+            def __init__(self, config):
+                self._config = config
+                # like Builder.__init__ with job_slots set
+                if BuilderUtils.get_jobserver() == None:
+                    BuilderUtils.set_jobserver(BuilderUtils.JobServer(config['job_slots']))
+                jobservers.append(BuilderUtils.get_jobserver())
+            def run(self):
+                builds.append(sorted(self._config['branches'].keys()))
+                return dict((branch_name,
+                             Builder.Builder.BuildResult.FAILED if branch_name in failing
+                             else Builder.Builder.BuildResult.SUCCESS)
+                            for branch_name in self._config['branches']
+                            if not branch_name in not_run)
+            def close(self):
+                pass
+
+        self._project = types.ModuleType('fake_project')
+        self._project.config_data = { 'project_short_name' : 'fake',
+                                      'repository' : self._repo,
+                                      'scratch_path' : self._tempdir,
+                                      'job_slots' : 2,
+                                      'branches' : { 'main' : { 'poll_interval' : 60 },
+                                                     'v1' : { } } }
+        self._project.create_builder = (lambda config, s3_client=None, args=None, mirror_cache=None:
+                                        FakeBuilder(config))
+        self._scheduler = Scheduler({ 'state_path' : os.path.join(self._tempdir, 'state'),
+                                      'poll_interval' : 3600 },
+                                    [self._project])
+
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+
+    def _git(self, *args):
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] +
+                              list(args), cwd=self._repo, stdout=subprocess.DEVNULL)
+
+
+    def _commit(self):
+        self._git('commit', '-q', '--allow-empty', '-m', 'commit')
+
+
+    def test_poll(self):
+        self.assertEqual(self._scheduler.run_once(), 1)
+        self.assertEqual(self._builds, [['main', 'v1']])
+        # nothing changed
+        self.assertEqual(self._scheduler.run_once(), 0)
+        # main changed, but it is not due for a poll yet
+        self._commit()
+        self.assertEqual(self._scheduler.run_once(), 0)
+        # a trigger forces the poll
+        open(os.path.join(self._tempdir, 'state', 'triggers', 'fake@main'), 'w').close()
+        self.assertEqual(self._scheduler.run_once(self._scheduler.get_triggers()), 1)
+        self.assertEqual(self._builds[-1], ['main'])
+        self.assertEqual(self._scheduler.get_triggers(), set())
+
+
+    def test_failed_build(self):
+        self._failing.add('main')
+        self.assertEqual(self._scheduler.run_once(), 1)
+        # due again, but the failure is not retried before retry_interval
+        self._project.config_data['branches']['main']['poll_interval'] = 0
+        self.assertEqual(self._scheduler.run_once(), 0)
+        # unless triggered
+        self.assertEqual(self._scheduler.run_once(set([('fake', 'main')])), 1)
+        self._failing.clear()
+        self.assertEqual(self._scheduler.run_once(set([('fake', 'main')])), 1)
+        self.assertEqual(self._scheduler.run_once(set([('fake', 'main')])), 0)
+        self.assertEqual(self._builds, [['main', 'v1'], ['main'], ['main']])
+
+
+    def test_branch_not_run(self):
+        self._not_run.add('v1')
+        self.assertEqual(self._scheduler.run_once(), 1)
+        self.assertNotIn('failed_revision', self._scheduler._branch_state('fake', 'v1'))
+        # retried at the next poll, not after retry_interval
+        self._not_run.clear()
+        self._project.config_data['branches']['v1']['poll_interval'] = 0
+        self.assertEqual(self._scheduler.run_once(), 1)
+        self.assertEqual(self._builds, [['main', 'v1'], ['v1']])
+        self.assertEqual(self._scheduler.run_once(), 0)
+
+
+    def test_fresh_jobserver(self):
+        self._scheduler.run_once()
+        self._commit()
+        self._scheduler.run_once(set([('fake', None)]))
+        self.assertEqual(len(self._jobservers), 2)
+        self.assertIsNot(self._jobservers[0], self._jobservers[1])
+        self.assertEqual(BuilderUtils.get_jobserver(), None)
+
+
+    def test_poll_failure(self):
+        self._project.config_data['repository'] = os.path.join(self._tempdir, 'missing')
+        self.assertEqual(self._scheduler.run_once(), 0)
+        self.assertTrue(self._scheduler.next_poll_time() > time.time())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -36,4 +36,4 @@ fi
 module unload autotools
 module load $module_name
 
-$program_name "${arguments[*]}"
+$program_name "${arguments[@]}"